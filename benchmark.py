@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+""" benchmark md5s3stash and the thumbnail server
+    against a local http server for the source files and a minimal
+    in-memory s3 stand-in, so numbers from different commits can be
+    compared without a network or an AWS account in the way
+"""
+import sys
+import os
+import argparse
+import hashlib
+import json
+import logging
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import urllib2
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+import boto
+import boto.s3.connection
+import magic
+import tornado.httpserver
+import tornado.ioloop
+import tornado.testing
+import tornado.web
+from PIL import Image
+import md5s3stash
+
+os.environ.setdefault('BUCKET_BASE', 'bench')
+import thumbnail
+
+BENCHMARKS = ['checkChunks', 'image_info', 'image_info_uncached', 's3move',
+              'md5s3stash', 'thumbnail', 'original']
+
+# defaults: source file sizes in KB, thumbnail source images in pixels,
+# objects per run, and threads (or concurrent clients)
+SIZES = [16, 1024, 16384]
+IMAGE_SIZES = ['640x480', '2000x1500', '6000x4000']
+COUNT = 20
+CONCURRENCY = [1, 8]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='benchmark md5s3stash and the thumbnail server')
+    parser.add_argument('benchmark', nargs='*',
+                        help='benchmarks to run, of {0} (default all)'.format(
+                            ', '.join(BENCHMARKS)))
+    parser.add_argument('-o', '--output', required=False,
+                        help='file to save the results in as JSON')
+    parser.add_argument('--compare', required=False,
+                        help='JSON from an earlier run to compare against')
+    parser.add_argument('--sizes', type=int_list, default=SIZES,
+                        help='comma separated source file sizes in KB')
+    parser.add_argument('--image_sizes', type=str_list, default=IMAGE_SIZES,
+                        help='comma separated WIDTHxHEIGHT of source images')
+    parser.add_argument('--count', type=int, default=COUNT,
+                        help='objects in each run')
+    parser.add_argument('--concurrency', type=int_list, default=CONCURRENCY,
+                        help='comma separated numbers of concurrent calls')
+    argv = parser.parse_args(argv)
+    for name in argv.benchmark:
+        if name not in BENCHMARKS:
+            parser.error('no such benchmark: {0}'.format(name))
+    # every 404 HEAD for a key that isn't stashed yet would be logged
+    logging.basicConfig(level=logging.ERROR)
+
+    results = run(argv.benchmark or BENCHMARKS, argv.sizes, argv.image_sizes,
+                  argv.count, argv.concurrency, report=print_result)
+    saved = dict(commit=git_commit(), python=sys.version.split()[0],
+                 time=time.strftime('%Y-%m-%dT%H:%M:%S'), results=results)
+    if argv.output:
+        with open(argv.output, 'w') as f:
+            json.dump(saved, f, indent=2, sort_keys=True)
+    if argv.compare:
+        with open(argv.compare) as f:
+            compare(json.load(f), saved)
+
+
+def int_list(text):
+    return [int(n) for n in text.split(',')]
+
+
+def str_list(text):
+    return [n.strip() for n in text.split(',')]
+
+
+def run(benchmarks, sizes, image_sizes, count, concurrency, report=None):
+    """ run `benchmarks` over files of each of `sizes` KB (or images of
+        each of `image_sizes`), `count` objects at each level of
+        `concurrency`; returns a list of result dicts (see `measure`)
+        `report` is called with each result as it is ready
+    """
+    results = []
+    with Stage(sizes, image_sizes, count) as stage:
+        for name in benchmarks:
+            for (size, items) in stage.workload(name):
+                for jobs in concurrency:
+                    FakeS3Handler.objects.clear()
+                    stage.stash_images()
+                    result = measure(getattr(stage, 'bench_' + name), items,
+                                     jobs)
+                    result.update(benchmark=name, size=size)
+                    results.append(result)
+                    if report is not None:
+                        report(result)
+    return results
+
+
+def measure(fn, items, jobs):
+    """ call `fn` on each of `items` from `jobs` threads; `fn` returns the
+        number of bytes it moved.  returns the count, bytes, wall time,
+        objects and MB per second and the p50 and p99 latency in ms
+    """
+    latencies = []
+
+    def timed(item):
+        start = time.time()
+        nbytes = fn(item)
+        latencies.append(time.time() - start)
+        return nbytes
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        nbytes = sum(pool.map(timed, items))
+    seconds = time.time() - start
+    return dict(
+        concurrency=jobs,
+        count=len(items),
+        bytes=nbytes,
+        seconds=round(seconds, 4),
+        objects_per_sec=round(len(items) / seconds, 2),
+        mb_per_sec=round(nbytes / seconds / 1024 / 1024, 2),
+        p50_ms=round(percentile(latencies, 50) * 1000, 2),
+        p99_ms=round(percentile(latencies, 99) * 1000, 2),
+    )
+
+
+def percentile(values, pct):
+    """ nearest rank percentile """
+    values = sorted(values)
+    rank = max(int(round(pct / 100.0 * len(values))), 1)
+    return values[rank - 1]
+
+
+def print_result(result):
+    print('{benchmark:<20} {size:>10} x{concurrency:<3} '
+          '{objects_per_sec:>9.2f} obj/s {mb_per_sec:>9.2f} MB/s '
+          'p50 {p50_ms:>9.2f}ms p99 {p99_ms:>9.2f}ms'.format(**result))
+
+
+def compare(before, after):
+    """ print the change in objects/sec for each run in both results """
+    old = dict(((r['benchmark'], r['size'], r['concurrency']), r)
+               for r in before['results'])
+    print('compared to {0}'.format(before.get('commit')))
+    for result in after['results']:
+        key = (result['benchmark'], result['size'], result['concurrency'])
+        if key in old:
+            change = (result['objects_per_sec'] /
+                      old[key]['objects_per_sec'] - 1) * 100
+            print('{0:<20} {1:>10} x{2:<3} {3:+8.1f}%'.format(
+                key[0], key[1], key[2], change))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Stage(object):
+    """ the local servers and files the benchmarks run against: source
+        files over http, an s3 stand-in, and a thumbnail server using it
+    """
+    bucket = 'bench'
+
+    def __init__(self, sizes, image_sizes, count):
+        self.sizes = sizes
+        self.image_sizes = image_sizes
+        self.count = count
+
+    def __enter__(self):
+        self.tempdir = tempfile.mkdtemp()
+        # one random body per size; each object gets its own first bytes
+        for size in self.sizes:
+            FixtureHandler.bodies[str(size)] = os.urandom(size * 1024)
+        self.images = {}
+        for size in self.image_sizes:
+            (w, h) = [int(n) for n in size.split('x')]
+            noise = Image.effect_noise((w, h), 64)
+            out = BytesIO()
+            Image.merge('RGB', [noise] * 3).save(out, 'JPEG', quality=90)
+            body = out.getvalue()
+            md5 = hashlib.md5(body).hexdigest()
+            path = os.path.join(self.tempdir, md5)
+            with open(path, 'wb') as f:
+                f.write(body)
+            self.images[size] = (md5, path, body)
+        self.sources = serve(tornado.web.Application([
+            (r'/fixtures/(\d+)/(\d+)', FixtureHandler),
+            (r'/([^/]+)/(.+)', FakeS3Handler),
+            (r'/([^/]+)/?', FakeS3Handler),
+        ]))
+        self.environ = dict(os.environ)
+        os.environ.update(BUCKET_BASE=self.bucket, BUCKET_SCHEME='simple',
+                          S3_ENDPOINT='127.0.0.1:{0}'.format(self.sources))
+        self.thumbnails = serve(thumbnail.ThumbnailApplication(
+            render_cache_size=0, timeout=60, max_requests=200))
+        self.conn = md5s3stash.StashSession(boto.connect_s3(
+            aws_access_key_id='bench', aws_secret_access_key='bench',
+            host='127.0.0.1', port=self.sources, is_secure=False,
+            calling_format=boto.s3.connection.OrdinaryCallingFormat()))
+        return self
+
+    def __exit__(self, *exc_info):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        FixtureHandler.bodies.clear()
+        FakeS3Handler.objects.clear()
+        shutil.rmtree(self.tempdir)
+
+    def stash_images(self):
+        """ put the source images where the thumbnail server looks """
+        for (md5, path, body) in self.images.values():
+            FakeS3Handler.objects[(self.bucket, md5)] = (b'image/jpeg', body)
+
+    def workload(self, name):
+        """ yield (size, items) for each size benchmark `name` runs at """
+        if name in ['image_info', 'image_info_uncached', 'thumbnail']:
+            for size in self.image_sizes:
+                yield (size, [self.images[size]] * self.count)
+        elif name == 's3move':
+            for size in self.sizes:
+                path = os.path.join(self.tempdir, str(size))
+                with open(path, 'wb') as f:
+                    f.write(FixtureHandler.bodies[str(size)])
+                yield (size, [(path, n) for n in range(self.count)])
+        elif name == 'original':
+            for size in self.sizes:
+                yield (size, [(size, n) for n in range(self.count)])
+        else:
+            for size in self.sizes:
+                yield (size, [
+                    'http://127.0.0.1:{0}/fixtures/{1}/{2}'.format(
+                        self.sources, size, n)
+                    for n in range(self.count)
+                ])
+
+    def bench_checkChunks(self, url):
+        # a fresh cache, or the second run would only get 304s
+        (path, md5, mime) = md5s3stash.checkChunks(url, cache={})
+        nbytes = os.path.getsize(path)
+        os.remove(path)
+        return nbytes
+
+    def bench_image_info(self, image):
+        md5s3stash.image_info(image[1])
+        return len(image[2])
+
+    def bench_image_info_uncached(self, image):
+        # what image_info did before ImageProbe, to compare against
+        magic.Magic(mime=True).from_file(image[1])
+        Image.open(image[1]).size
+        return len(image[2])
+
+    def bench_s3move(self, item):
+        (path, n) = item
+        s3_url = 's3://{0}/{1}'.format(self.bucket, n)
+        md5s3stash.s3move(path, s3_url, 'application/octet-stream', self.conn)
+        return os.path.getsize(path)
+
+    def bench_md5s3stash(self, url):
+        report = md5s3stash.md5s3stash(url, self.bucket, conn=self.conn,
+                                       url_cache={}, hash_cache={})
+        return len(FakeS3Handler.objects[(self.bucket, report.md5)][1])
+
+    def bench_thumbnail(self, image):
+        self.fetch('/clip/150x150/{0}'.format(image[0]))
+        # MB/s of source images rendered
+        return len(image[2])
+
+    def bench_original(self, item):
+        # a different md5 for each, so nothing can be cached along the way
+        body = FixtureHandler.body(*item)
+        md5 = hashlib.md5(body).hexdigest()
+        FakeS3Handler.objects[(self.bucket, md5)] = (
+            b'application/octet-stream', body)
+        return self.fetch('/original/{0}'.format(md5))
+
+    def fetch(self, path):
+        resp = urllib2.urlopen(
+            'http://127.0.0.1:{0}{1}'.format(self.thumbnails, path))
+        try:
+            return len(resp.read())
+        finally:
+            resp.close()
+
+
+def serve(app):
+    """ run `app` on its own IOLoop in a daemon thread; returns the port """
+    (sock, port) = tornado.testing.bind_unused_port()
+    started = threading.Event()
+
+    def loop():
+        io_loop = tornado.ioloop.IOLoop()
+        io_loop.make_current()
+        server = tornado.httpserver.HTTPServer(app)
+        server.add_sockets([sock])
+        started.set()
+        io_loop.start()
+    thread = threading.Thread(target=loop)
+    thread.daemon = True
+    thread.start()
+    started.wait()
+    return port
+
+
+class FixtureHandler(tornado.web.RequestHandler):
+    """ /fixtures/{KB}/{n}: KB of random bytes, different for each n """
+    bodies = {}
+
+    @classmethod
+    def body(cls, size, n):
+        base = cls.bodies[str(size)]
+        prefix = '{0:016d}'.format(int(n)).encode('ascii')
+        return prefix + base[len(prefix):]
+
+    def get(self, size, n):
+        self.set_header('Content-Type', 'application/octet-stream')
+        self.write(self.body(size, n))
+
+
+class FakeS3Handler(tornado.web.RequestHandler):
+    """ just enough of s3, path style, for boto's get_key, new_key and
+        set_contents_from_* and for the thumbnail server's GETs
+    """
+    objects = {}  # (bucket, key): (content type, body)
+
+    def put(self, bucket, key=None):
+        if key is None:
+            return  # create_bucket
+        body = self.request.body
+        FakeS3Handler.objects[(bucket, key)] = (
+            self.request.headers.get('Content-Type'), body)
+        self.set_header('ETag', '"{0}"'.format(hashlib.md5(body).hexdigest()))
+
+    def head(self, bucket, key=None):
+        self.lookup(bucket, key)
+
+    def get(self, bucket, key=None):
+        body = self.lookup(bucket, key)
+        byte_range = self.request.headers.get('Range')
+        if byte_range:
+            (start, end) = byte_range[len('bytes='):].split('-')
+            body = body[int(start):int(end) + 1]
+            self.set_status(206)
+            self.set_header('Content-Length', len(body))
+        self.write(body)
+
+    def lookup(self, bucket, key):
+        if (bucket, key) not in FakeS3Handler.objects:
+            raise tornado.web.HTTPError(404)
+        (content_type, body) = FakeS3Handler.objects[(bucket, key)]
+        if content_type:
+            self.set_header('Content-Type', content_type)
+        self.set_header('ETag', '"{0}"'.format(hashlib.md5(body).hexdigest()))
+        self.set_header('Content-Length', len(body))
+        return body
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,25 +9,156 @@ import argparse
 import tempfile
 import urllib2
 import urllib
+import httplib
+import socket
 import urlparse
 import base64
+import binascii
+import errno
+import email.utils
+import io
+import json
 import logging
 import hashlib
+import sqlite3
+import threading
+import time
+import Queue
+import functools
 import basin
 import boto
 import magic
+import pilbox.errors
+import pilbox.image
+import tornado.gen
+import tornado.httpclient
+import tornado.ioloop
+import tornado.locks
 from PIL import Image
-from collections import namedtuple
+from collections import namedtuple, deque, MutableMapping
+from contextlib import contextmanager
+from concurrent.futures import (ThreadPoolExecutor, wait, as_completed,
+                                FIRST_COMPLETED)
 import re
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 regex_s3 = re.compile(r's3.*amazonaws.com')
+regex_md5 = re.compile(r'^[a-f\d]{32}$')
+regex_derivative = re.compile(r'^(adapt|clip|crop|fill|scale)/(\d+)x(\d+)$')
+
+
+
+class StashReport(
+        namedtuple('StashReport', 'url, md5, s3_url, mime_type, dimensions')):
+    """ what `md5s3stash` did with a url; `digests` are the hex digests
+        of the extra algorithms it was asked for, and `timings` the
+        `Timings.as_dict` of the call when it was asked for """
+    digests = None
+    timings = None
+
+
+StashError = namedtuple('StashError', 'url, error')
+MigrateReport = namedtuple('MigrateReport', 'source, destination, action')
+InventoryEntry = namedtuple('InventoryEntry', 'md5, size, etag, mime_type')
+RevalidateReport = namedtuple('RevalidateReport', 'url, changed')
+
+# the 36 bucket labels of the `multibucket` scheme
+BUCKET_SHARDS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+# the first two hex digits an md5 can start with
+MD5_PREFIXES = [a + b for a in '0123456789abcdef' for b in '0123456789abcdef']
+
+# how much of the start of each file `ChunkProbe` keeps to sniff it
+PROBE_HEADER_SIZE = 256 * 1024
+
+# files bigger than this go up to s3 as a multipart upload, in parts of
+# MULTIPART_PART_SIZE (s3 wants at least 5MB for all but the last part)
+# sent MULTIPART_JOBS at a time, each part tried MULTIPART_RETRIES extra times
+MULTIPART_THRESHOLD = 100 * 1024 * 1024
+MULTIPART_PART_SIZE = 16 * 1024 * 1024
+MULTIPART_JOBS = 4
+MULTIPART_RETRIES = 3
+
+# idle keep-alive connections a `Downloader` holds on to for each host,
+# and its socket timeout in seconds
+DOWNLOAD_POOL_SIZE = 4
+DOWNLOAD_TIMEOUT = 60
+
+# a `Downloader` tries a url that answers 429 or 503 DOWNLOAD_RETRIES more
+# times, after the Retry-After the host asks for, or else BACKOFF_BASE
+# seconds doubling each time; no wait is longer than BACKOFF_MAX
+RETRY_CODES = (429, 503)
+DOWNLOAD_RETRIES = 5
+BACKOFF_BASE = 1
+BACKOFF_MAX = 300
+
+# a `HostScheduler` starts each host at HOST_CONCURRENCY downloads at a time.
+# It allows one more for each round of responses that come back quickly,
+# and backs off when responses take LATENCY_FACTOR times longer than the
+# quickest it has seen, and by half on errors and throttling
+HOST_CONCURRENCY = 2
+LATENCY_FACTOR = 3
+
+# default limits for `async_stash_many`: transfers in flight at once overall
+# and per source host, and how long one download may take in seconds
+ASYNC_CONCURRENCY = 200
+ASYNC_PER_HOST = 8
+ASYNC_REQUEST_TIMEOUT = 3600
+
+# thumbnails are decoded at no less than this many times their size, so that
+# resizing still has some detail to work with
+DRAFT_GAP = 2
+
+# how much `checkChunks` reads at a time, and how many chunks a `Hasher`
+# thread may fall behind the download before the download waits for it
+READ_SIZE = 64 * 1024
+HASH_QUEUE_SIZE = 16
+
+# `migrate` lists MIGRATE_LIST_JOBS shard buckets at a time and copies
+# MIGRATE_JOBS keys at a time, noting its place in each shard every
+# MIGRATE_CHECKPOINT_EVERY keys.  s3 copies up to COPY_LIMIT bytes in one
+# request, bigger files are copied in parts of MIGRATE_PART_SIZE
+MIGRATE_JOBS = 32
+MIGRATE_LIST_JOBS = 6
+MIGRATE_CHECKPOINT_EVERY = 1000
+COPY_LIMIT = 5 * 1024 * 1024 * 1024
+MIGRATE_PART_SIZE = 512 * 1024 * 1024
+
+# how many entries a `SqliteCache` keeps before dropping the least recently
+# used
+CACHE_SIZE = 1000000
+
+# a full `SqliteCache` drops this fraction of its entries at a time
+CACHE_EVICT_FRACTION = 0.1
+
+# reads a `SqliteCache` notes as uses before writing them out in one go
+CACHE_TOUCH_BATCH = 1000
 
 
 def main(argv=None):
+    commands = dict(migrate=migrate_main, inventory=inventory_main)
+    if argv is None and sys.argv[1:2] and sys.argv[1] in commands:
+        return commands[sys.argv[1]](sys.argv[2:])
     parser = argparse.ArgumentParser(
-        description='content addressable storage in AWS S3')
-    parser.add_argument('url', nargs='+',
+        description='content addressable storage in AWS S3',
+        epilog='see `md5s3stash migrate -h` to move files stashed with the '
+               'multibucket scheme to the simple scheme, and `md5s3stash '
+               'inventory -h` to make a local list of what is stashed')
+    parser.add_argument('url', nargs='*',
                         help='URL or path of source file to stash')
+    parser.add_argument(
+        '-m', '--manifest', required=False,
+        help='file listing URLs to stash, one per line (JSON lines with '
+             'a "url", or tab separated with the URL first)'
+    )
+    parser.add_argument(
+        '--journal', required=False,
+        help='where to record finished URLs so an interrupted --manifest '
+             'run can pick up where it left off (default MANIFEST.journal)'
+    )
     parser.add_argument('-b', '--bucket_base', nargs="?",
                         help='this must be a unique name in all of AWS S3')
     parser.add_argument('-s', '--bucket_scheme', nargs="?",
@@ -50,12 +181,81 @@ def main(argv=None):
                         help='username for downloads requiring BasicAuth')
     parser.add_argument('-p', '--password', required=False,
                         help='password for downloads requiring BasicAuth')
+    parser.add_argument('-j', '--jobs', type=int, default=1, required=False,
+                        help='number of files to stash concurrently')
+    parser.add_argument(
+        '--rate', type=float, required=False,
+        help='most downloads to start per second from any one host'
+    )
+    parser.add_argument(
+        '-c', '--cache', required=False,
+        help='sqlite file to keep the url and hash caches in between runs'
+    )
+    parser.add_argument('--cache_size', type=int, default=CACHE_SIZE,
+                        required=False,
+                        help='most entries to keep in each cache')
+    parser.add_argument(
+        '--spool_size', type=int, default=0, required=False,
+        help='keep files under this many KB in memory instead of in tempdir'
+    )
+    parser.add_argument(
+        '--multipart_threshold', type=int, required=False,
+        default=MULTIPART_THRESHOLD // (1024 * 1024),
+        help='files over this many MB are uploaded in parallel parts'
+    )
+    parser.add_argument(
+        '--inventory', required=False,
+        help='file made by `md5s3stash inventory`, to look up what is '
+             'stashed already in rather than asking s3'
+    )
+    parser.add_argument(
+        '--read_size', type=int, default=READ_SIZE // 1024, required=False,
+        help='KB to read from the source at a time'
+    )
+    parser.add_argument(
+        '--digests', type=digest_list, default=[], required=False,
+        help='comma separated hashlib algorithms to compute along with the '
+             'md5, e.g. sha256'
+    )
+    parser.add_argument(
+        '--timings', action='store_true', required=False,
+        help='add a column to each row with the seconds and bytes spent in '
+             'each stage, as JSON'
+    )
+    parser.add_argument(
+        '--metrics', required=False,
+        help='file to write the run\'s cumulative counters to at the end '
+             '(- for stderr)'
+    )
+    parser.add_argument(
+        '--metrics_format', default='prometheus', required=False,
+        choices=['prometheus', 'statsd'],
+        help='format for --metrics'
+    )
+    parser.add_argument(
+        '--derivatives', type=derivative_list, required=False,
+        help='thumbnails to render from each image and stash next to it, '
+             'comma separated as mode/WIDTHxHEIGHT, e.g. '
+             'clip/150x150,fill/300x300'
+    )
+    parser.add_argument(
+        '--revalidate_only', action='store_true', required=False,
+        help='only ask each source, with a conditional GET, whether it '
+             'changed since the --cache saw it; stash nothing'
+    )
 
     if argv is None:
         argv = parser.parse_args()
+        if not (argv.url or argv.manifest):
+            parser.error('a url or a --manifest is needed')
+    if argv.revalidate_only and not argv.cache:
+        # without one there is nothing to revalidate against
+        parser.error('--revalidate_only needs --cache')
 
     if argv.bucket_base:
         bucket_base = argv.bucket_base
+    elif argv.revalidate_only:
+        bucket_base = None  # nothing is stashed
     else:
         assert 'BUCKET_BASE' in os.environ, "`-b` or `BUCKET_BASE` must be set"
         bucket_base = os.environ['BUCKET_BASE']
@@ -78,13 +278,193 @@ def main(argv=None):
         raise ValueError('Invalid log level: %s' % argv.loglevel)
     logging.basicConfig(level=numeric_level, )
 
-    # if being used in a library, probably want to be able to recycle
-    # connection?
-    conn = boto.connect_s3()
-    for url in argv.url:
-        print("{0}\t{1}\t{2}\t{3}".format(
-            *md5s3stash(url, bucket_base, conn, url_auth=auth, bucket_scheme=argv.bucket_scheme)
-        ))
+    caches = {}
+    if argv.cache:
+        caches = dict(
+            url_cache=SqliteCache(argv.cache, 'url_cache', argv.cache_size),
+            hash_cache=SqliteCache(argv.cache, 'hash_cache', argv.cache_size),
+        )
+
+    if argv.revalidate_only:
+        return revalidate_main(argv, auth, caches.get('url_cache', {}))
+
+    if argv.inventory:
+        try:
+            caches['stashed'] = Inventory(argv.inventory, bucket_base,
+                                          argv.bucket_scheme)
+        except (IOError, ValueError) as e:
+            parser.error(str(e))
+
+    options = dict(
+        jobs=argv.jobs,
+        rate=argv.rate,
+        url_auth=auth,
+        bucket_scheme=argv.bucket_scheme,
+        multipart_threshold=argv.multipart_threshold * 1024 * 1024,
+        spool_size=argv.spool_size * 1024,
+        derivatives=argv.derivatives,
+        timings=argv.timings,
+        read_size=argv.read_size * 1024,
+        digests=argv.digests,
+        **caches
+    )
+    if argv.manifest:
+        journal = argv.journal or '{0}.journal'.format(argv.manifest)
+        reports = stash_manifest(argv.manifest, journal, bucket_base,
+                                 **options)
+    else:
+        reports = stash_many(argv.url, bucket_base, **options)
+
+    errors = 0
+    for report in reports:
+        if isinstance(report, StashError):
+            errors += 1
+            sys.stderr.write("Stash Error: {0}\t{1}\n".format(*report))
+            continue
+        print(report_row(report))
+    for name in ['url_cache', 'hash_cache']:
+        if name in caches:
+            caches[name].flush()
+    if argv.metrics:
+        if argv.metrics_format == 'statsd':
+            exported = metrics.statsd()
+        else:
+            exported = metrics.prometheus()
+        if argv.metrics == '-':
+            sys.stderr.write(exported)
+        else:
+            with open(argv.metrics, 'w') as f:
+                f.write(exported)
+    return 1 if errors else None
+
+
+def revalidate_main(argv, auth, url_cache):
+    """ the --revalidate_only half of `main`, prints a changed or
+        unchanged row for each url and how many changed at the end """
+    urls = read_manifest(argv.manifest) if argv.manifest else argv.url
+    (errors, changed, total) = (0, 0, 0)
+    for report in revalidate_many(urls, jobs=argv.jobs, url_auth=auth,
+                                  url_cache=url_cache, rate=argv.rate):
+        if isinstance(report, StashError):
+            errors += 1
+            sys.stderr.write("Revalidate Error: {0}\t{1}\n".format(*report))
+            continue
+        total += 1
+        changed += report.changed
+        print("{0}\t{1}".format(
+            report.url, 'changed' if report.changed else 'unchanged'))
+    url_cache.flush()
+    sys.stderr.write("{0} of {1} urls changed\n".format(changed, total))
+    return 1 if errors else None
+
+
+def migrate_main(args=None):
+    parser = argparse.ArgumentParser(
+        prog='md5s3stash migrate',
+        description='copy files stashed with the multibucket scheme to the '
+                    'simple scheme, server side')
+    parser.add_argument('-b', '--bucket_base', nargs="?",
+                        help='bucket_base of the 36 multibucket buckets')
+    parser.add_argument('--to', required=True,
+                        help='bucket_base (bucket/path) to copy them to')
+    parser.add_argument('-j', '--jobs', type=int, default=MIGRATE_JOBS,
+                        required=False,
+                        help='number of files to copy concurrently')
+    parser.add_argument('--list_jobs', type=int, default=MIGRATE_LIST_JOBS,
+                        required=False,
+                        help='number of buckets to list concurrently')
+    parser.add_argument(
+        '--checkpoint', required=False,
+        help='file to note progress in, so an interrupted run can pick up '
+             'where it left off'
+    )
+    parser.add_argument('--loglevel', default='ERROR', required=False)
+    argv = parser.parse_args(args)
+
+    if argv.bucket_base:
+        bucket_base = argv.bucket_base
+    else:
+        assert 'BUCKET_BASE' in os.environ, "`-b` or `BUCKET_BASE` must be set"
+        bucket_base = os.environ['BUCKET_BASE']
+    numeric_level = getattr(logging, argv.loglevel.upper(), None)
+    if not isinstance(numeric_level, int):
+        raise ValueError('Invalid log level: %s' % argv.loglevel)
+    logging.basicConfig(level=numeric_level, )
+
+    errors = 0
+    for report in migrate(bucket_base, argv.to, jobs=argv.jobs,
+                          list_jobs=argv.list_jobs,
+                          checkpoint=argv.checkpoint):
+        if isinstance(report, StashError):
+            errors += 1
+            sys.stderr.write("Migrate Error: {0}\t{1}\n".format(*report))
+            continue
+        print("{0}\t{1}\t{2}".format(*report))
+    return 1 if errors else None
+
+
+def inventory_main(args=None):
+    parser = argparse.ArgumentParser(
+        prog='md5s3stash inventory',
+        description='list what is stashed into a local sqlite file, for '
+                    'md5s3stash --inventory and the thumbnail server')
+    parser.add_argument('inventory', help='sqlite file to write')
+    parser.add_argument('-b', '--bucket_base', nargs="?",
+                        help='this must be a unique name in all of AWS S3')
+    parser.add_argument(
+        '-s', '--bucket_scheme', action='append',
+        choices=['simple', 'multibucket'],
+        help='layout to list, give it twice for both (default simple)'
+    )
+    parser.add_argument('-j', '--jobs', type=int, default=MIGRATE_LIST_JOBS,
+                        required=False,
+                        help='number of listings to run concurrently')
+    parser.add_argument(
+        '--content_types', action='store_true', required=False,
+        help='also look up the content type of each file, with a HEAD each'
+    )
+    parser.add_argument('--loglevel', default='ERROR', required=False)
+    argv = parser.parse_args(args)
+
+    if argv.bucket_base:
+        bucket_base = argv.bucket_base
+    else:
+        assert 'BUCKET_BASE' in os.environ, "`-b` or `BUCKET_BASE` must be set"
+        bucket_base = os.environ['BUCKET_BASE']
+    numeric_level = getattr(logging, argv.loglevel.upper(), None)
+    if not isinstance(numeric_level, int):
+        raise ValueError('Invalid log level: %s' % argv.loglevel)
+    logging.basicConfig(level=numeric_level, )
+
+    inventory = build_inventory(
+        argv.inventory, bucket_base,
+        bucket_schemes=argv.bucket_scheme or ['simple'], jobs=argv.jobs,
+        content_types=argv.content_types)
+    print("{0}\t{1}".format(argv.inventory, len(inventory)))
+
+
+def report_row(report):
+    """ the tab separated line printed for a `StashReport`; its `digests`
+        and `timings`, when there are any, go in a fifth column as JSON """
+    row = "{0}\t{1}\t{2}\t{3}".format(*report)
+    extra = dict((name, getattr(report, name))
+                 for name in ['digests', 'timings']
+                 if getattr(report, name) is not None)
+    if extra:
+        row = "{0}\t{1}".format(row, json.dumps(extra, sort_keys=True))
+    return row
+
+
+def digest_list(text):
+    """ the list of hashlib algorithms in the comma separated `text` """
+    names = [name.strip().lower() for name in text.split(',') if name.strip()]
+    for name in names:
+        try:
+            hashlib.new(name)
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                'no such digest: {0}'.format(name))
+    return names
 
 
 def md5s3stash(
@@ -94,36 +474,504 @@ def md5s3stash(
         url_auth=None,
         url_cache={},
         hash_cache={},
-        bucket_scheme='simple'
+        bucket_scheme='simple',
+        multipart_threshold=MULTIPART_THRESHOLD,
+        stashed=None,
+        downloader=None,
+        spool_size=None,
+        derivatives=None,
+        timings=False,
+        read_size=READ_SIZE,
+        digests=None
     ):
     """ stash a file at `url` in the named `bucket_base` ,
-        `conn` is an optional boto.connect_s3()
+        `conn` is an optional boto.connect_s3() or `StashSession`
         `url_auth` is optional Basic auth ('<username>', '<password'>) tuple
         to use if the url to download requires authentication.
         `url_cache` is an object with a dict interface, keyed on url
-            url_cache[url] = { md5: ..., If-None-Match: etag, If-Modified-Since: date }
+            url_cache[url] = { md5: ..., If-None-Match: etag,
+                               If-Modified-Since: date,
+                               mime_type: ..., dimensions: ... }
         `hash_cache` is an obhect with dict interface, keyed on md5
             hash_cache[md5] = ( s3_url, mime_type, dimensions )
         `bucket_scheme` is text string 'simple' or 'multibucket'
+        `multipart_threshold` is the size in bytes above which the file is
+            sent to s3 as a multipart upload
+        `stashed` is an optional object that answers `md5 in stashed` for
+            files that are already in s3 (a set from `list_stashed`, some
+            local index, ...); these are not checked for or sent to s3 again
+        `downloader` is an optional `Downloader` to reuse http connections
+        `spool_size` files smaller than this many bytes are kept in memory
+            rather than in a temp file
+        `derivatives` is an optional list of thumbnails ('mode/WxH') to
+            render from an image and stash next to it, see `derivative_url`
+        `timings` if True, the seconds and bytes spent in each stage are
+            attached to the report as `report.timings`; they are added
+            to the module's `metrics` either way
+        `read_size` is how many bytes to read from the source at a time
+        `digests` is an optional list of hashlib algorithms (such as
+            'sha256') to compute in the same pass as the md5; the hex
+            digests are kept in both caches and are `report.digests`
+        a url that answers "304 Not Modified" is reported from the caches,
+        see `cached_report`, without a temp file, s3 request or image probe
     """
-    StashReport = namedtuple('StashReport', 'url, md5, s3_url, mime_type, dimensions')
-    (file_path, md5, mime_type) = checkChunks(url, url_auth, url_cache)
+    probe = ChunkProbe()
+    timer = Timings()
+    extra = dict((name, None) for name in digests or [])
+
+    def download():
+        chunks = checkChunks(url, url_auth, url_cache, probe=probe,
+                             downloader=downloader, spool_size=spool_size,
+                             timer=timer, read_size=read_size, digests=extra)
+        if not chunks:
+            raise IOError('could not download {0}'.format(url))
+        return chunks
+
     try:
-        return StashReport(url, md5, *hash_cache[md5])
-    except KeyError:
-        pass
-    s3_url = md5_to_s3_url(md5, bucket_base, bucket_scheme=bucket_scheme)
-    if conn is None:
-        conn = boto.connect_s3()
-    s3move(file_path, s3_url, mime_type, conn)
-    (mime, dimensions) = image_info(file_path)
-    os.remove(file_path)  # safer than rmtree
-    hash_cache[md5] = (s3_url, mime, dimensions)
-    report = StashReport(url, md5, *hash_cache[md5])
+        chunks = download()
+        report = None
+        if chunks[0] is None:
+            # 304 Not Modified; the report is what it was last time
+            report = cached_report(url, chunks[1], bucket_base, url_cache,
+                                   hash_cache, bucket_scheme, digests=extra)
+            if report is None:
+                # neither cache remembers enough, get the whole file again
+                forget_validators(url_cache, url)
+                chunks = download()
+                if chunks[0] is None:
+                    raise IOError(
+                        '{0} answered 304 to a plain GET'.format(url))
+        if report is None:
+            report = stash_download(
+                url, chunks, probe, bucket_base, conn=conn,
+                hash_cache=hash_cache, bucket_scheme=bucket_scheme,
+                multipart_threshold=multipart_threshold, stashed=stashed,
+                derivatives=derivatives, timer=timer, digests=extra)
+            remember_report(url_cache, report)
+    finally:
+        metrics.record(timer)
+    if timings:
+        report.timings = timer.as_dict()
+    return report
+
+
+def stash_download(url, chunks, probe, bucket_base, conn=None, hash_cache={},
+                   bucket_scheme='simple',
+                   multipart_threshold=MULTIPART_THRESHOLD, stashed=None,
+                   derivatives=None, timer=None, digests=None):
+    """ the rest of `md5s3stash` once `url` has been downloaded;
+        `chunks` is what `checkChunks` returned, and `probe` the `ChunkProbe`
+        it was given. The downloaded file is cleaned up.
+        `timer` is an optional `Timings` to record each stage in
+        `digests` the extra digests `checkChunks` filled in, if any
+    """
+    if timer is None:
+        timer = Timings()
+    (file_path, md5, mime_type) = chunks
+    try:
+        try:
+            # an entry may have the digests dict on the end
+            report = StashReport(url, md5, *hash_cache[md5][:3])
+            timer.count('hash_cache_hits')
+            if digests:
+                report.digests = digests
+                if len(hash_cache[md5]) < 4:
+                    hash_cache[md5] = tuple(hash_cache[md5]) + (digests,)
+            return report
+        except KeyError:
+            timer.count('hash_cache_misses')
+        s3_url = md5_to_s3_url(md5, bucket_base, bucket_scheme=bucket_scheme)
+        if stashed is not None and md5 in stashed:
+            logging.getLogger('MD5S3:stash').debug('already stashed %s' % md5)
+            timer.count('dedup_skips')
+        else:
+            if conn is None:
+                conn = boto.connect_s3()
+            s3move(file_path, s3_url, mime_type, conn, md5=md5,
+                   multipart_threshold=multipart_threshold, timer=timer)
+        with timer.stage('probe'):
+            (mime, dimensions) = probe.info(file_path)
+        if derivatives and mime and mime.startswith('image/'):
+            if conn is None:
+                conn = boto.connect_s3()
+            with timer.stage('derivatives'):
+                stash_derivatives(file_path, s3_url, derivatives, conn)
+    finally:
+        # even when the hash cache already knew it
+        if hasattr(file_path, 'read'):
+            file_path.close()
+        else:
+            os.remove(file_path)  # safer than rmtree
+    if digests:
+        hash_cache[md5] = (s3_url, mime, dimensions, digests)
+    else:
+        hash_cache[md5] = (s3_url, mime, dimensions)
+    report = StashReport(url, md5, s3_url, mime, dimensions)
+    if digests:
+        report.digests = digests
+    timer.count('stashes')
     logging.getLogger('MD5S3:stash').info(report)
     return report
 
 
+def cached_report(url, md5, bucket_base, url_cache={}, hash_cache={},
+                  bucket_scheme='simple', digests=None):
+    """ the `StashReport` for `url`, which has not changed since it was
+        stashed as `md5`, from the `hash_cache` entry for `md5` or else the
+        `url_cache` entry for `url`; None when neither remembers enough
+        (nor all the extra `digests` asked for) to make it up
+    """
+    if digests and None in digests.values():
+        return None
+    try:
+        report = StashReport(url, md5, *hash_cache[md5][:3])
+    except KeyError:
+        thisurl = url_cache.get(url, {})
+        if 'mime_type' not in thisurl:
+            return None
+        dimensions = thisurl.get('dimensions')
+        report = StashReport(
+            url, md5,
+            md5_to_s3_url(md5, bucket_base, bucket_scheme=bucket_scheme),
+            thisurl['mime_type'], tuple(dimensions) if dimensions else None)
+    if digests:
+        report.digests = digests
+    return report
+
+
+def remember_report(url_cache, report):
+    """ keep the mime type and dimensions of `report` in the url cache
+        entry for its url, for `cached_report` """
+    thisurl = url_cache.get(report.url)
+    if thisurl is None:
+        return
+    thisurl['mime_type'] = report.mime_type
+    thisurl['dimensions'] = report.dimensions
+    url_cache[report.url] = thisurl
+
+
+def forget_validators(url_cache, url):
+    """ drop the validators from the url cache entry for `url`, so the next
+        GET of it is not a conditional one """
+    thisurl = url_cache.get(url)
+    if thisurl is None:
+        return
+    thisurl.pop('If-None-Match', None)
+    thisurl.pop('If-Modified-Since', None)
+    url_cache[url] = thisurl
+
+
+def stash_many(urls, bucket_base, jobs=1, conn=None, **kwargs):
+    """ stash each url in `urls` with a bounded pool of `jobs` threads
+        yields a `StashReport` for each url as it completes (so not
+        necessarily in the order given), or a `StashError` for a url that
+        could not be stashed; one bad url does not stop the run.
+        `urls` can be any iterable, it is consumed as work is scheduled
+        `conn` is an optional boto.connect_s3() or `StashSession`, by
+            default the workers share a new `StashSession`
+        `rate` is the most downloads to start per second from one host
+        other keyword arguments are passed on to `md5s3stash`; unless a
+        `downloader` is given the workers share a new `Downloader`, which
+        adjusts how many of them download from each host at once
+    """
+    if conn is None:
+        conn = StashSession()
+    rate = kwargs.pop('rate', None)
+    if kwargs.get('downloader') is None:
+        kwargs['downloader'] = Downloader(
+            pool_size=jobs,
+            scheduler=HostScheduler(max_concurrency=jobs, rate=rate))
+
+    def stash(url):
+        try:
+            return md5s3stash(url, bucket_base, conn=conn, **kwargs)
+        except Exception as e:
+            logging.getLogger('MD5S3:stash_many').exception(url)
+            metrics.add('errors_total')
+            return StashError(url, e)
+
+    return run_bounded(stash, urls, jobs)
+
+
+def run_bounded(fn, items, jobs=1):
+    """ yield `fn(item)` for each of `items`, from a pool of `jobs` threads
+        in the order they complete; `items` is consumed as work is
+        scheduled, a couple per thread ahead """
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        pending = set()
+        for item in items:
+            pending.add(pool.submit(fn, item))
+            # don't queue up the whole harvest; keep the workers fed
+            if len(pending) >= jobs * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in as_completed(pending):
+            yield future.result()
+
+
+def revalidate(url, auth=None, cache={}, downloader=None):
+    """ True if `url` has changed since it was stashed, going by a
+        conditional GET with the validators `cache` has for it; the body
+        is not read.  A url `cache` has no validators for has changed as
+        far as anyone can tell, and is not asked.
+        `downloader` is an optional `Downloader` to send the GET with
+    """
+    thisurl = cache.get(url, {})
+    if 'md5' not in thisurl or not ('If-None-Match' in thisurl or
+                                    'If-Modified-Since' in thisurl):
+        return True
+    if downloader is None:
+        resp = urlopen_with_auth(url, auth=auth, cache=cache)
+    else:
+        resp = downloader.open(url, auth=auth, cache=cache)
+    try:
+        return resp.getcode() != 304
+    finally:
+        resp.close()
+
+
+def revalidate_many(urls, jobs=1, url_auth=None, url_cache={}, rate=None,
+                    downloader=None):
+    """ `revalidate` each url in `urls` with a bounded pool of `jobs`
+        threads, like `stash_many`; yields a `RevalidateReport` for each
+        url as it completes, or a `StashError` for one that could not be
+        checked.  Nothing is downloaded or stashed.
+    """
+    if downloader is None:
+        downloader = Downloader(
+            pool_size=jobs,
+            scheduler=HostScheduler(max_concurrency=jobs, rate=rate))
+
+    def check(url):
+        try:
+            changed = revalidate(url, url_auth, url_cache, downloader)
+        except Exception as e:
+            logging.getLogger('MD5S3:revalidate_many').exception(url)
+            metrics.add('errors_total')
+            return StashError(url, e)
+        metrics.add('changed_total' if changed else 'unchanged_total')
+        return RevalidateReport(url, changed)
+
+    return run_bounded(check, urls, jobs)
+
+
+def read_manifest(path):
+    """ yield the urls listed in the manifest file at `path`
+        each line is either JSON with a "url", or tab separated with the url
+        first (so earlier output of md5s3stash works as a manifest too);
+        blank lines and lines starting with # are skipped
+    """
+    with io.open(path, encoding='utf-8') as manifest:
+        for line in manifest:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('{'):
+                yield json.loads(line)['url']
+            else:
+                yield line.split('\t')[0]
+
+
+def read_journal(path):
+    """ the set of urls with a finished row in the journal at `path` """
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with io.open(path, encoding='utf-8') as journal:
+        for line in journal:
+            # a line without its newline was cut off by a crash
+            if line.endswith('\n'):
+                done.add(line.split('\t')[0])
+    return done
+
+
+def drop_torn_line(path):
+    """ cut the last line of the file at `path` off if a crash left it
+        without its newline, so what is appended next starts a line of its
+        own rather than finishing that one """
+    if not os.path.exists(path):
+        return
+    with open(path, 'r+b') as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        if not end:
+            return
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) == b'\n':
+            return
+        while end > 0:
+            start = max(0, end - 4096)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b'\n')
+            if newline >= 0:
+                f.truncate(start + newline + 1)
+                return
+            end = start
+        f.truncate(0)
+
+
+def stash_manifest(manifest, journal, bucket_base, **kwargs):
+    """ stash the urls listed in the file `manifest` (see `read_manifest`)
+        with `stash_many`, appending the row for each one to the file
+        `journal` as soon as it is done.  Run it again with the same
+        journal after a crash and urls already in the journal are skipped,
+        while the ones that were in flight (or failed) are tried again.
+        yields the same as `stash_many`
+    """
+    done = read_journal(journal)
+    todo = (url for url in read_manifest(manifest) if url not in done)
+    # the row a crash cut short is not done; don't let it look it
+    drop_torn_line(journal)
+    with io.open(journal, 'a', encoding='utf-8') as out:
+        for report in stash_many(todo, bucket_base, **kwargs):
+            if not isinstance(report, StashError):
+                out.write(report_row(report) + '\n')
+                out.flush()
+            yield report
+
+
+class AsyncLimits(object):
+    """ how many `async_stash` calls may be in flight at once, in total
+        (`concurrency`) and downloading from any one host (`per_host`)
+    """
+    def __init__(self, concurrency=ASYNC_CONCURRENCY, per_host=ASYNC_PER_HOST):
+        self.total = tornado.locks.Semaphore(concurrency)
+        self.per_host = per_host
+        self.hosts = {}
+
+    def host(self, url):
+        netloc = urlparse.urlparse(url).netloc
+        if netloc not in self.hosts:
+            self.hosts[netloc] = tornado.locks.Semaphore(self.per_host)
+        return self.hosts[netloc]
+
+
+@tornado.gen.coroutine
+def async_stash(
+        url,
+        bucket_base,
+        conn=None,
+        url_auth=None,
+        url_cache={},
+        hash_cache={},
+        bucket_scheme='simple',
+        multipart_threshold=MULTIPART_THRESHOLD,
+        stashed=None,
+        spool_size=None,
+        http_client=None,
+        limits=None,
+        executor=None,
+        derivatives=None,
+        timings=False,
+        digests=None
+    ):
+    """ a tornado coroutine version of `md5s3stash`, takes the same
+        arguments but `downloader` and `read_size`, and resolves to the same
+        `StashReport`.
+        http(s) urls are downloaded and hashed on the IOLoop; other urls, and
+        the blocking boto calls, run on `executor` (the IOLoop's default
+        thread pool if None)
+        `http_client` is an optional tornado AsyncHTTPClient
+        `limits` is an optional `AsyncLimits` shared between calls
+    """
+    if limits is None:
+        limits = AsyncLimits()
+    if conn is None:
+        conn = StashSession()
+    loop = tornado.ioloop.IOLoop.current()
+    probe = ChunkProbe()
+    timer = Timings()
+    extra = dict((name, None) for name in digests or [])
+
+    @tornado.gen.coroutine
+    def download():
+        if urlparse.urlparse(url).scheme in ['http', 'https']:
+            with (yield limits.host(url).acquire()):
+                chunks = yield async_check_chunks(
+                    url, url_auth, url_cache, probe=probe,
+                    spool_size=spool_size, http_client=http_client,
+                    timer=timer, digests=extra)
+        else:
+            chunks = yield loop.run_in_executor(
+                executor, functools.partial(
+                    checkChunks, url, url_auth, url_cache, probe=probe,
+                    spool_size=spool_size, timer=timer, digests=extra))
+        if not chunks:
+            raise IOError('could not download {0}'.format(url))
+        raise tornado.gen.Return(chunks)
+
+    with (yield limits.total.acquire()):
+        try:
+            chunks = yield download()
+            report = None
+            if chunks[0] is None:
+                # 304 Not Modified, see `md5s3stash`
+                report = cached_report(url, chunks[1], bucket_base,
+                                       url_cache, hash_cache, bucket_scheme,
+                                       digests=extra)
+                if report is None:
+                    forget_validators(url_cache, url)
+                    chunks = yield download()
+                    if chunks[0] is None:
+                        raise IOError(
+                            '{0} answered 304 to a plain GET'.format(url))
+            if report is None:
+                report = yield loop.run_in_executor(
+                    executor, functools.partial(
+                        stash_download, url, chunks, probe, bucket_base,
+                        conn=conn, hash_cache=hash_cache,
+                        bucket_scheme=bucket_scheme,
+                        multipart_threshold=multipart_threshold,
+                        stashed=stashed, derivatives=derivatives, timer=timer,
+                        digests=extra))
+                remember_report(url_cache, report)
+        finally:
+            metrics.record(timer)
+    if timings:
+        report.timings = timer.as_dict()
+    raise tornado.gen.Return(report)
+
+
+@tornado.gen.coroutine
+def async_stash_many(urls, bucket_base, concurrency=ASYNC_CONCURRENCY,
+                     per_host=ASYNC_PER_HOST, on_report=None, conn=None,
+                     **kwargs):
+    """ a tornado coroutine that runs `async_stash` over `urls`, at most
+        `concurrency` at a time and `per_host` for any one source host.
+        `on_report` is called with each `StashReport`, or `StashError`, as
+        it completes; the coroutine resolves to the list of all of them
+        other keyword arguments are passed on to `async_stash`
+    """
+    if conn is None:
+        conn = StashSession()
+    if kwargs.get('http_client') is None:
+        kwargs['http_client'] = tornado.httpclient.AsyncHTTPClient(
+            force_instance=True, max_clients=concurrency,
+            max_body_size=sys.maxsize)
+    limits = AsyncLimits(concurrency, per_host)
+    urls = iter(urls)
+    results = []
+
+    @tornado.gen.coroutine
+    def worker():
+        # every worker pulls its next url off the same iterator
+        for url in urls:
+            try:
+                report = yield async_stash(url, bucket_base, conn=conn,
+                                           limits=limits, **kwargs)
+            except Exception as e:
+                logging.getLogger('MD5S3:async_stash_many').exception(url)
+                metrics.add('errors_total')
+                report = StashError(url, e)
+            results.append(report)
+            if on_report is not None:
+                on_report(report)
+
+    yield [worker() for n in range(concurrency)]
+    raise tornado.gen.Return(results)
+
+
 # think about refactoring the next two functions
 
 def md5_to_s3_url(md5, bucket_base, bucket_scheme='multibucket'):
@@ -161,6 +1009,51 @@ def md5_to_http_url(md5, bucket_base, bucket_scheme='multibucket', s3_endpoint='
     return url
 
 
+def derivative_url(url, spec):
+    """ where the `spec` ('mode/WxH') thumbnail of the original at the s3 or
+        http `url` is stashed: right next to it, named after it """
+    return "{0}/{1}".format(url, spec)
+
+
+def derivative_list(text):
+    """ the list of 'mode/WxH' thumbnails in the comma separated `text` """
+    specs = [spec.strip().lower() for spec in text.split(',') if spec.strip()]
+    for spec in specs:
+        if not regex_derivative.match(spec):
+            raise argparse.ArgumentTypeError(
+                'not mode/WIDTHxHEIGHT: {0}'.format(spec))
+    return specs
+
+
+def stash_locations(bucket_base, bucket_scheme='multibucket'):
+    """ list the (bucket name, key prefix) pairs files are stashed under """
+    if bucket_scheme == 'simple':
+        parts = urlparse.urlsplit(md5_to_s3_url('', bucket_base, 'simple'))
+        return [(parts.netloc, parts.path)]
+    elif bucket_scheme == 'multibucket':
+        # the key prefix has to be worked out the same way `s3move` does it
+        return [
+            ('{0}.{1}'.format(shard, bucket_base), '/')
+            for shard in BUCKET_SHARDS
+        ]
+
+
+def list_stashed(bucket_base, conn=None, bucket_scheme='simple'):
+    """ the set of md5s stashed under `bucket_base`, from a bulk listing
+        of the bucket(s), to hand to `md5s3stash` as `stashed`
+    """
+    if conn is None:
+        conn = boto.connect_s3()
+    found = set()
+    for (bucket_name, prefix) in stash_locations(bucket_base, bucket_scheme):
+        bucket = conn.get_bucket(bucket_name, validate=False)
+        for key in bucket.list(prefix=prefix):
+            md5 = key.name[len(prefix):]
+            if regex_md5.match(md5):
+                found.add(md5)
+    return found
+
+
 def md5_to_bucket_shard(md5):
     """ calculate the shard label of the bucket name from md5 """
     # "Consider utilizing multiple buckets that start with different
@@ -173,7 +1066,7 @@ def md5_to_bucket_shard(md5):
     # start and end with a lowercase letter or a number. "
     #  -- http://docs.aws.amazon.com/AmazonS3/latest/dev/BucketRestrictions.html
     # see also:  http://en.wikipedia.org/wiki/Base_36
-    ALPHABET = "0123456789abcdefghijklmnopqrstuvwxyz"
+    ALPHABET = BUCKET_SHARDS
     # http://stats.stackexchange.com/a/70884/14900
     # take the first two digits of the hash and turn that into an inteter
     # this should be evenly distributed
@@ -182,6 +1075,273 @@ def md5_to_bucket_shard(md5):
     bucket = int_value % len(ALPHABET)
     return basin.encode(ALPHABET, bucket)
 
+def shard_prefixes(shard):
+    """ the two hex digit md5 prefixes `md5_to_bucket_shard` puts in the
+        bucket labelled `shard` """
+    return [prefix for prefix in MD5_PREFIXES
+            if md5_to_bucket_shard(prefix) == shard]
+
+
+def migrate(bucket_base, dest_base, conn=None, jobs=MIGRATE_JOBS,
+            list_jobs=MIGRATE_LIST_JOBS, checkpoint=None):
+    """ copy everything stashed under `bucket_base` with the `multibucket`
+        scheme to `dest_base` with the `simple` scheme, using server side
+        copies.  The 36 shard buckets are listed `list_jobs` at a time, and
+        the copies made `jobs` at a time.  A key that is already in place
+        (see `same_object`) is not copied again.
+        `conn` is an optional boto.connect_s3() or `StashSession`
+        `checkpoint` is an optional file to note progress in; run it again
+            with the same file and each shard is listed from where it was
+            left, while shards that were finished are skipped
+        yields a `MigrateReport` for each key as it completes, or a
+        `StashError` for a key (or a whole shard) that could not be copied
+    """
+    if conn is None:
+        conn = StashSession()
+    places = read_checkpoint(checkpoint) if checkpoint else {}
+    (dest_bucket, dest_prefix) = stash_locations(dest_base, 'simple')[0]
+    results = Queue.Queue()
+    lock = threading.Lock()
+    out = None
+    if checkpoint:
+        drop_torn_line(checkpoint)
+        out = io.open(checkpoint, 'a', encoding='utf-8')
+
+    def note(bucket_name, **place):
+        if out is None:
+            return
+        place['bucket'] = bucket_name
+        with lock:
+            out.write(json.dumps(place, sort_keys=True) + '\n')
+            out.flush()
+
+    def migrate_shard(shard, bucket_name, prefix, pool):
+        bucket = conn.get_bucket(bucket_name, validate=False)
+        # what is already there, in one listing rather than a HEAD a key
+        existing = {}
+        dest = conn.get_bucket(dest_bucket, validate=False)
+        for md5_prefix in shard_prefixes(shard):
+            for key in dest.list(prefix=dest_prefix + md5_prefix):
+                existing[key.name] = (key_etag(key), key.size)
+        # the marker only moves past keys that were copied, in the order
+        # they were listed in
+        listed = deque()
+        place = {'marker': places.get(bucket_name), 'since': 0,
+                 'stuck': False}
+
+        def advance():
+            while listed and listed[0][1].done():
+                (name, future) = listed.popleft()
+                if isinstance(future.result(), StashError):
+                    place['stuck'] = True
+                elif not place['stuck']:
+                    place['marker'] = name
+                    place['since'] += 1
+            if place['since'] >= MIGRATE_CHECKPOINT_EVERY:
+                note(bucket_name, marker=place['marker'])
+                place['since'] = 0
+
+        pending = set()
+        try:
+            for key in bucket.list(prefix=prefix,
+                                   marker=place['marker'] or ''):
+                name = key.name[len(prefix):]
+                (md5, rest) = (name[:32], name[32:])
+                if not regex_md5.match(md5) or rest[:1] not in ('', '/'):
+                    continue
+                dest_name = urlparse.urlsplit(
+                    md5_to_s3_url(md5, dest_base, 'simple')).path + rest
+                future = pool.submit(
+                    copy, key, dest_name, existing.get(dest_name),
+                    None if rest else md5)
+                listed.append((key.name, future))
+                pending.add(future)
+                if len(pending) >= jobs * 2:
+                    done, pending = wait(pending,
+                                         return_when=FIRST_COMPLETED)
+                    advance()
+        finally:
+            # every result is in before the shard is reported finished
+            wait(pending)
+        advance()
+        if not place['stuck']:
+            note(bucket_name, done=True)
+        elif place['since']:
+            note(bucket_name, marker=place['marker'])
+
+    def copy(key, dest_name, existing, md5):
+        result = migrate_key(conn, key, dest_bucket, dest_name, existing, md5)
+        results.put(result)
+        return result
+
+    def run_shard(*args):
+        try:
+            migrate_shard(*args)
+        except Exception as e:
+            logging.getLogger('MD5S3:migrate').exception(args[1])
+            results.put(StashError('s3://{0}/'.format(args[1]), e))
+        finally:
+            results.put(None)
+
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            with ThreadPoolExecutor(max_workers=list_jobs) as listers:
+                shards = [
+                    (shard, bucket_name, prefix)
+                    for (shard, (bucket_name, prefix)) in zip(
+                        BUCKET_SHARDS,
+                        stash_locations(bucket_base, 'multibucket'))
+                    if places.get(bucket_name) is not True
+                ]
+                for shard in shards:
+                    listers.submit(run_shard, *(shard + (pool,)))
+                finished = 0
+                while finished < len(shards):
+                    result = results.get()
+                    if result is None:
+                        finished += 1
+                    else:
+                        yield result
+    finally:
+        if out is not None:
+            out.close()
+
+
+def build_inventory(path, bucket_base, bucket_schemes=('simple',),
+                    conn=None, jobs=MIGRATE_LIST_JOBS, content_types=False):
+    """ list the originals stashed under `bucket_base` in each of the
+        `bucket_schemes` into a new `Inventory` at `path`, `jobs` listings
+        at a time (a `simple` bucket is listed in 256 pieces, by the first
+        two digits of the md5).  The listings give the size and ETag; with
+        `content_types` each file also gets a HEAD for its content type.
+        The file records `bucket_base` and the layout each md5 was found in.
+        The inventory is written under another name and moved into place
+        once it is complete, so anything that has the old one open keeps
+        a consistent snapshot.
+        `conn` is an optional boto.connect_s3() or `StashSession`
+        returns the new `Inventory`
+    """
+    if conn is None:
+        conn = StashSession()
+    listings = []
+    for bucket_scheme in bucket_schemes:
+        for (bucket_name, prefix) in stash_locations(bucket_base,
+                                                     bucket_scheme):
+            if bucket_scheme == 'simple':
+                listings.extend(
+                    (bucket_scheme, bucket_name, prefix, prefix + md5_prefix)
+                    for md5_prefix in MD5_PREFIXES)
+            else:
+                listings.append((bucket_scheme, bucket_name, prefix, prefix))
+
+    def list_entries(listing):
+        (bucket_scheme, bucket_name, prefix, md5_prefix) = listing
+        bucket = conn.get_bucket(bucket_name, validate=False)
+        entries = []
+        for key in bucket.list(prefix=md5_prefix):
+            md5 = key.name[len(prefix):]
+            if not regex_md5.match(md5):
+                continue
+            mime_type = None
+            if content_types:
+                mime_type = bucket.get_key(key.name).content_type
+            entries.append(InventoryEntry(md5, key.size, key_etag(key),
+                                          mime_type))
+        return bucket_scheme, entries
+
+    building = '{0}.building'.format(path)
+    if os.path.exists(building):
+        os.remove(building)
+    inventory = Inventory.create(building, bucket_base, bucket_schemes)
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        for (bucket_scheme, entries) in pool.map(list_entries, listings):
+            inventory.add(entries, bucket_scheme)
+    inventory.close()
+    os.rename(building, path)
+    return Inventory(path)
+
+
+def read_checkpoint(path):
+    """ {shard bucket name: the last key `migrate` is sure it copied, or
+        True once the shard is finished} from the checkpoint at `path` """
+    places = {}
+    if not os.path.exists(path):
+        return places
+    with io.open(path, encoding='utf-8') as checkpoint:
+        for line in checkpoint:
+            # a line without its newline was cut off by a crash
+            if line.endswith('\n') and line.strip():
+                place = json.loads(line)
+                places[place['bucket']] = place.get('done') or place['marker']
+    return places
+
+
+def migrate_key(conn, key, dest_bucket, dest_name, existing=None, md5=None):
+    """ copy the boto `key` (from a bucket listing) to `dest_name` in the
+        bucket `dest_bucket` server side, unless `existing`, the (etag,
+        size) of what is there already, shows it has been copied before.
+        `md5` is the md5 of the file, when `key` is an original.
+        returns a `MigrateReport`, or a `StashError` if the copy failed
+    """
+    source = 's3://{0}{1}'.format(key.bucket.name, key.name)
+    destination = 's3://{0}{1}'.format(dest_bucket, dest_name)
+    listed = (key_etag(key), key.size)
+    if existing is not None and same_object(listed, existing, md5):
+        return MigrateReport(source, destination, 'verified')
+    try:
+        bucket = conn.get_bucket(dest_bucket, validate=False)
+        if key.size > COPY_LIMIT:
+            etag = copy_in_parts(key, bucket, dest_name)
+        else:
+            etag = key_etag(
+                bucket.copy_key(dest_name, key.bucket.name, key.name))
+        if not same_object(listed, (etag, key.size), md5):
+            raise IOError('copy has ETag {0}'.format(etag))
+    except Exception as e:
+        logging.getLogger('MD5S3:migrate').exception(source)
+        return StashError(source, e)
+    return MigrateReport(source, destination, 'copied')
+
+
+def copy_in_parts(key, bucket, key_name, part_size=MIGRATE_PART_SIZE):
+    """ copy the boto `key`, too big for one copy request, to `key_name` in
+        the boto `bucket` as a multipart upload of copied ranges
+        returns the ETag of the copy
+    """
+    mime = key.bucket.get_key(key.name).content_type
+    metadata = {'Content-Type': mime} if mime else {}
+    mp = bucket.initiate_multipart_upload(key_name, metadata=metadata)
+    try:
+        for part_num, start in enumerate(range(0, key.size, part_size),
+                                         start=1):
+            end = min(start + part_size, key.size) - 1
+            mp.copy_part_from_key(key.bucket.name, key.name, part_num,
+                                  start, end)
+    except Exception:
+        mp.cancel_upload()
+        raise
+    return key_etag(mp.complete_upload())
+
+
+def same_object(listed, existing, md5=None):
+    """ whether `existing`, an (etag, size), looks like a copy of the
+        `listed` one; `md5` is the md5 of the file when it is known """
+    (etag, size) = listed
+    (existing_etag, existing_size) = existing
+    if size != existing_size:
+        return False
+    if existing_etag in (etag, md5):
+        return True
+    # the ETag of a file sent in parts is not its md5, so all there is to
+    # go on is the size
+    return '-' in existing_etag or (md5 is None and '-' in etag)
+
+
+def key_etag(key):
+    """ the ETag of the boto `key`, without the quotes s3 puts around it """
+    return (key.etag or '').strip('"')
+
+
 def is_s3_url(url):
     '''For s3 urls, if you send http authentication headers, S3 will
     send a "400 Bad Request" in response.
@@ -191,79 +1351,523 @@ def is_s3_url(url):
     match = regex_s3.search(url)
     return True if match else False
 
-def urlopen_with_auth(url, auth=None, cache={}):
-    '''Use urllib2 to open url if the auth is specified.
-    auth is tuple of (username, password)
+def request_headers(url, auth=None, cache={}):
+    '''headers to send with a GET of `url`;
+    `If-None-Match` and `If-Modified-Since` from `cache` for a conditional
+    get, and Basic auth when `auth` is given and `url` is not on s3
     '''
-    opener = urllib2.build_opener(DefaultErrorHandler())
-    req = urllib2.Request(url)
-    p = urlparse.urlparse(url)
-
+    headers = {}
     # try to set headers for conditional get request
     try:
         here = cache[url]
         if 'If-None-Match' in here:
-            req.add_header('If-None-Match', cache[url]['If-None-Match'],)
+            headers['If-None-Match'] = here['If-None-Match']
         if 'If-Modified-Since' in here:
-            req.add_header('If-Modified-Since', cache[url]['If-Modified-Since'],)
+            headers['If-Modified-Since'] = here['If-Modified-Since']
     except KeyError:
         pass
 
-    if not auth or is_s3_url(url):
-        if p.scheme not in ['http', 'https']:
-            return urllib.urlopen(url) # urllib works with normal file paths
-    else:
+    if auth and not is_s3_url(url):
         # make sure https
-        if p.scheme != 'https':
+        scheme = urlparse.urlparse(url).scheme
+        if scheme != 'https':
             raise urllib2.URLError('Basic auth not over https is bad idea! \
-                    scheme:{0}'.format(p.scheme))
+                    scheme:{0}'.format(scheme))
         # Need to add header so it gets sent with first request,
         # else redirected to shib
         b64authstr = base64.b64encode('{0}:{1}'.format(*auth))
-        req.add_header('Authorization', 'Basic {0}'.format(b64authstr))
+        headers['Authorization'] = 'Basic {0}'.format(b64authstr)
+    return headers
+
+
+def urlopen_with_auth(url, auth=None, cache={}):
+    '''Use urllib2 to open url if the auth is specified.
+    auth is tuple of (username, password)
+    '''
+    opener = urllib2.build_opener(DefaultErrorHandler())
+    p = urlparse.urlparse(url)
+    headers = request_headers(url, auth=auth, cache=cache)
+
+    if 'Authorization' not in headers and p.scheme not in ['http', 'https']:
+        return urllib.urlopen(url) # urllib works with normal file paths
 
     # return urllib2.urlopen(req)
-    return opener.open(req)
+    return opener.open(urllib2.Request(url, headers=headers))
+
+
+def uses_proxy(url):
+    ''' whether urllib2 would send a request for `url` through a proxy,
+        going by the http_proxy, https_proxy and no_proxy environment '''
+    p = urlparse.urlparse(url)
+    return (p.scheme in urllib.getproxies() and
+            not urllib.proxy_bypass(p.hostname or ''))
+
+
+class Downloader(object):
+    ''' opens urls the same way as `urlopen_with_auth`, but keeps the
+        http(s) connections open afterwards and reuses them for the next
+        url on the same host, rather than a new TCP/TLS handshake each time
+        `pool_size` is how many idle connections to keep per host
+        `scheduler` is the `HostScheduler` that says when each download may
+            start, by default one allowing up to `pool_size` per host
+        `retries` is how many more times to try a url the host throttles
+        one Downloader can be shared between threads.  A url that goes
+        through a proxy (see `uses_proxy`) is opened with
+        `urlopen_with_auth` instead, without the pool or the scheduler
+    '''
+    REDIRECTS = (301, 302, 303, 307, 308)
+
+    def __init__(self, pool_size=DOWNLOAD_POOL_SIZE, timeout=DOWNLOAD_TIMEOUT,
+                 max_redirects=10, scheduler=None, retries=DOWNLOAD_RETRIES):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        if scheduler is None:
+            scheduler = HostScheduler(max_concurrency=pool_size)
+        self.scheduler = scheduler
+        self.retries = retries
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def open(self, url, auth=None, cache={}):
+        ''' same arguments and return value as `urlopen_with_auth` '''
+        p = urlparse.urlparse(url)
+        headers = request_headers(url, auth=auth, cache=cache)
+        if ('Authorization' not in headers and
+                p.scheme not in ['http', 'https']):
+            return urllib.urlopen(url) # urllib works with normal file paths
+        if uses_proxy(url):
+            # the pooled connections only go direct; let urllib2 deal
+            return urlopen_with_auth(url, auth=auth, cache=cache)
+        headers['User-Agent'] = 'Python-urllib/{0}'.format(
+            urllib2.__version__)
+
+        for attempt in range(self.retries + 1):
+            (resp, location) = self._follow(url, dict(headers))
+            if resp.getcode() not in RETRY_CODES:
+                break
+            metrics.add('throttled_total')
+            # every download from the host waits this out, not just this one
+            self.scheduler.back_off(urlparse.urlparse(location).netloc,
+                                    attempt, retry_after(resp.info()))
+            if attempt < self.retries:
+                resp.close()
+        url = location
+
+        code = resp.getcode()
+        if code >= 400:
+            resp.close()
+            raise urllib2.HTTPError(url, code, resp.resp.reason, resp.info(),
+                                    None)
+        if code == 304:
+            resp.release()
+        return resp
+
+    def _follow(self, url, headers):
+        ''' (the response, the url it came from) for `url`, after redirects '''
+        for redirect in range(self.max_redirects + 1):
+            resp = self._request(url, headers)
+            if resp.getcode() not in self.REDIRECTS:
+                return (resp, url)
+            location = resp.info().get('Location')
+            resp.release()
+            url = urlparse.urljoin(url, location)
+            if is_s3_url(url):
+                # s3 answers "400 Bad Request" to http auth
+                headers.pop('Authorization', None)
+        raise urllib2.HTTPError(url, resp.getcode(), 'too many redirects',
+                                resp.info(), None)
+
+    def _request(self, url, headers):
+        p = urlparse.urlparse(url)
+        host = (p.scheme, p.netloc)
+        path = urlparse.urlunparse(
+            ('', '', p.path or '/', p.params, p.query, ''))
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        self.scheduler.acquire(p.netloc)
+        start = time.time()
+        while True:
+            (conn, reused) = self._checkout(host)
+            try:
+                conn.request('GET', path, headers=headers)
+                resp = conn.getresponse()
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                if reused:
+                    # the server closed an idle connection; try a fresh one
+                    continue
+                self.scheduler.finish(p.netloc)
+                raise urllib2.URLError(e)
+            return PooledResponse(self, host, conn, resp,
+                                  latency=time.time() - start)
+
+    def _checkout(self, host):
+        with self.lock:
+            idle = self.pools.get(host)
+            if idle:
+                return (idle.pop(), True)
+        if host[0] == 'https':
+            conn = httplib.HTTPSConnection(host[1], timeout=self.timeout)
+        else:
+            conn = httplib.HTTPConnection(host[1], timeout=self.timeout)
+        return (conn, False)
+
+    def checkin(self, host, conn):
+        with self.lock:
+            idle = self.pools.setdefault(host, [])
+            if len(idle) < self.pool_size:
+                idle.append(conn)
+                return
+        conn.close()
+
+
+class PooledResponse(object):
+    ''' the file like response from `Downloader.open`, the connection goes
+        back to the pool once the body has been read to the end; until then
+        it counts as a download from its host to the `HostScheduler`
+        `latency` is how long the response took to start coming back
+    '''
+    def __init__(self, downloader, host, conn, resp, latency=None):
+        self.downloader = downloader
+        self.host = host
+        self.conn = conn
+        self.resp = resp
+        self.latency = latency
+        self.finished = False
 
+    def getcode(self):
+        return self.resp.status
 
-def checkChunks(url, auth=None, cache={}):
+    def info(self):
+        return self.resp.msg
+
+    def read(self, amt=None):
+        try:
+            chunk = self.resp.read(amt)
+        except (httplib.HTTPException, socket.error):
+            self.finish(None)
+            self.close()
+            raise
+        if not chunk or amt is None:
+            self.release()
+        return chunk
+
+    def release(self):
+        ''' finish reading the body and give the connection back '''
+        if self.conn is None:
+            return
+        try:
+            self.resp.read()
+        except (httplib.HTTPException, socket.error):
+            self.finish(None)
+            self.close()
+            return
+        (conn, self.conn) = (self.conn, None)
+        self.downloader.checkin(self.host, conn)
+        self.finish(self.getcode())
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        self.finish(self.getcode())
+
+    def finish(self, code):
+        ''' tell the scheduler the download is over, once; `code` is None
+            when the connection failed '''
+        if not self.finished:
+            self.finished = True
+            self.downloader.scheduler.finish(self.host[1], self.latency, code)
+
+
+class HostScheduler(object):
+    ''' says when a download from each host may start.  Each host has a
+        limit on downloads at a time, adjusted as responses come back: up
+        by one for each round of quick responses, down a little while they
+        come back slower than LATENCY_FACTOR times the quickest, and by half
+        for errors and throttling.  A host that throttles (see
+        `back_off`) gets no new downloads until its wait is over.
+        `max_concurrency` is the most downloads from one host at a time
+        `rate` is the most downloads to start per second from one host,
+            with bursts of up to `burst`; no limit if None
+        one HostScheduler can be shared between threads
+    '''
+    def __init__(self, max_concurrency=DOWNLOAD_POOL_SIZE, rate=None,
+                 burst=1, start=HOST_CONCURRENCY):
+        self.max_concurrency = max_concurrency
+        self.rate = rate
+        self.burst = burst
+        self.start = min(start, max_concurrency)
+        self.hosts = {}
+        self.condition = threading.Condition()
+
+    def acquire(self, host):
+        ''' wait until a download from `host` may start, and count it
+            until `finish` '''
+        with self.condition:
+            while True:
+                wait = self._admit(host)
+                if wait == 0:
+                    return
+                # None waits for a download to finish
+                self.condition.wait(wait)
+
+    def _admit(self, host):
+        state = self.hosts.get(host)
+        if state is None:
+            state = self.hosts[host] = HostState(self.start, self.burst)
+        now = time.time()
+        if now < state.backoff_until:
+            return state.backoff_until - now
+        if state.active >= int(state.limit):
+            return None
+        if self.rate:
+            state.tokens = min(self.burst,
+                               state.tokens + (now - state.stamp) * self.rate)
+            state.stamp = now
+            if state.tokens < 1:
+                return (1 - state.tokens) / self.rate
+            state.tokens -= 1
+        state.active += 1
+        return 0
+
+    def finish(self, host, latency=None, code=None):
+        ''' a download from `host` is over; its response started after
+            `latency` seconds with the status `code`, None if it failed '''
+        with self.condition:
+            state = self.hosts[host]
+            state.active -= 1
+            if code in RETRY_CODES:
+                # `back_off` has dealt with it
+                pass
+            elif code is None or code >= 500:
+                state.limit = max(1.0, state.limit / 2)
+            elif latency is not None:
+                if state.latency is None:
+                    state.latency = latency
+                state.latency = 0.8 * state.latency + 0.2 * latency
+                state.best = min(state.best or state.latency, state.latency)
+                if state.latency > LATENCY_FACTOR * state.best:
+                    state.limit = max(1.0, state.limit - 1.0 / state.limit)
+                else:
+                    state.limit = min(self.max_concurrency,
+                                      state.limit + 1.0 / state.limit)
+            self.condition.notify_all()
+
+    def back_off(self, host, attempt, retry_after=None):
+        ''' `host` throttled a download, `attempt` counting from 0; halve its
+            limit and hold off its downloads for `retry_after` seconds, or
+            else BACKOFF_BASE doubled for each attempt.  returns the wait
+        '''
+        if retry_after is None:
+            retry_after = BACKOFF_BASE * 2 ** attempt
+        wait = min(retry_after, BACKOFF_MAX)
+        with self.condition:
+            state = self.hosts.get(host)
+            if state is None:
+                state = self.hosts[host] = HostState(self.start, self.burst)
+            state.limit = max(1.0, state.limit / 2)
+            state.backoff_until = max(state.backoff_until, time.time() + wait)
+        logging.getLogger('MD5S3:download').info(
+            '{0} is throttling, waiting {1}s'.format(host, wait))
+        return wait
+
+
+class HostState(object):
+    ''' what a `HostScheduler` knows about one host '''
+    def __init__(self, limit, tokens):
+        self.limit = float(limit)
+        self.active = 0
+        self.tokens = tokens
+        self.stamp = time.time()
+        self.backoff_until = 0
+        self.latency = None
+        self.best = None
+
+
+def retry_after(headers):
+    ''' the seconds the Retry-After in `headers` asks to wait, or None '''
+    value = (headers.get('Retry-After') or '').strip()
+    if value.isdigit():
+        return int(value)
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(email.utils.mktime_tz(parsed) - time.time(), 0)
+
+
+@tornado.gen.coroutine
+def async_check_chunks(url, auth=None, cache={}, probe=None, spool_size=None,
+                       http_client=None, max_redirects=10, timer=None,
+                       digests=None):
+    """ a tornado coroutine version of `checkChunks` for http(s) urls,
+        resolves to the same as `checkChunks` would return
+        `http_client` is an optional tornado AsyncHTTPClient
+    """
+    if timer is None:
+        timer = Timings()
+    started = time.time()
+    if http_client is None:
+        http_client = tornado.httpclient.AsyncHTTPClient()
+    status = {}
+    files = []
+
+    def on_header(line):
+        if line.startswith('HTTP/'):
+            status['code'] = int(line.split()[1])
+
+    def on_chunk(chunk):
+        # redirects have bodies too, only keep the one we are after
+        if status.get('code') != 200:
+            return
+        if not files:
+            files.append(download_file(spool_size))
+        hasher.update(chunk)
+        with timer.stage('write', len(chunk)):
+            if probe is not None:
+                probe.feed(chunk)
+            files[0].write(chunk)
+
+    try:
+        headers = request_headers(url, auth=auth, cache=cache)
+    except urllib2.URLError, e:
+        print "URL Error:", e.reason, url
+        raise tornado.gen.Return(False)
+    # on the IOLoop, so never waiting on the hasher's threads
+    hasher = Hasher(digests or [], threaded=False)
+    finished = False
+    try:
+        try:
+            location = url
+            for redirect in range(max_redirects + 1):
+                resp = yield http_client.fetch(
+                    tornado.httpclient.HTTPRequest(
+                        location, headers=headers, follow_redirects=False,
+                        header_callback=on_header,
+                        streaming_callback=on_chunk,
+                        request_timeout=ASYNC_REQUEST_TIMEOUT),
+                    raise_error=False)
+                if resp.code not in Downloader.REDIRECTS:
+                    break
+                location = urlparse.urljoin(location,
+                                            resp.headers['Location'])
+                if is_s3_url(location):
+                    # s3 answers "400 Bad Request" to http auth
+                    headers.pop('Authorization', None)
+        finally:
+            hashes = hasher.hexdigests()
+        # the time not spent hashing or writing went to the network
+        timer.add('hash', hasher.seconds, hasher.size)
+        timer.add('download', time.time() - started - hasher.seconds
+                  - timer.seconds.get('write', 0), hasher.size)
+
+        thisurl = cache.get(url, dict())
+        if resp.code == 599:
+            print "URL Error:", resp.error, url
+            raise tornado.gen.Return(False)
+        if resp.code == 304:
+            timer.count('url_cache_hits')
+            remembered_digests(thisurl, digests)
+            raise tornado.gen.Return((None, thisurl['md5'], None))
+        if resp.code != 200:
+            print "HTTP Error:", resp.code, url
+            raise tornado.gen.Return(False)
+        # an empty body never made a file
+        temp_file = files[0] if files else download_file(spool_size)
+        if not spool_size:
+            temp_file.close()
+        mime_type = resp.headers.get('Content-Type')
+        remember_validators(thisurl, resp.headers)
+        md5 = hashes.pop('md5')
+        thisurl['md5'] = md5
+        remember_digests(thisurl, digests, hashes)
+        cache[url] = thisurl
+        finished = True
+        if spool_size:
+            temp_file.seek(0)
+            raise tornado.gen.Return((temp_file, md5, mime_type))
+        raise tornado.gen.Return((temp_file.name, md5, mime_type))
+    finally:
+        if files and not finished:
+            # a partial download (599 mid-body, ...) is no use to anyone
+            files[0].close()
+            if not spool_size:
+                os.remove(files[0].name)
+
+
+def checkChunks(url, auth=None, cache={}, probe=None, downloader=None,
+                spool_size=None, timer=None, read_size=READ_SIZE,
+                digests=None):
     """
        Helper to download large files the only arg is a url this file
        will go to a temp directory the file will also be downloaded in
        chunks and md5 checksum is returned
 
+       `probe` is an optional `ChunkProbe` that gets to see each chunk
+       on its way to the temp file
+
+       `downloader` is an optional `Downloader` to fetch `url` with,
+       otherwise `urlopen_with_auth` is used
+
+       `spool_size` if given, the file is kept in memory unless it grows
+       past this many bytes, and the (rewound) file object is returned in
+       place of the temp file path
+
+       `timer` is an optional `Timings` to record the time spent on the
+       network ('download'), hashing and writing the temp file in
+
+       `read_size` is how many bytes to read at a time
+
+       `digests` is an optional dict keyed by the names of other hashlib
+       algorithms to compute along with the md5; their hex digests are
+       filled in, and kept in the url cache
+
        based on downloadChunks@https://gist.github.com/gourneau/1430932
        and http://www.pythoncentral.io/hashing-files-with-python/
     """
-    temp_file = tempfile.NamedTemporaryFile(delete=False, prefix='md5s3_')
-    logging.getLogger('MD5S3').info("temp file path %s" % temp_file.name)
-
-    hasher = hashlib.new('md5')
-    BLOCKSIZE = 1024 * hasher.block_size
+    hasher = Hasher(digests or [])
+    if timer is None:
+        timer = Timings()
 
     try:
-        req = urlopen_with_auth(url, auth=auth, cache=cache)
-        thisurl = cache.get(url, dict())
-        if req.getcode() == 304:
-            return None, thisurl['md5'], None
-        mime_type = req.info()['Content-type']
-        # record these headers, they will let us pretend like we are a cacheing
-        # proxy server, and send conditional GETs next time we see this file
-        etag = req.info().get('ETag', None);
-        if etag:
-            thisurl['If-None-Match'] = etag
-        lmod = req.info().get('Last-Modified', None);
-        if lmod:
-            thisurl['If-Modified-Since'] = lmod
-        downloaded = 0
-        with temp_file:
-            while True:
-                chunk = req.read(BLOCKSIZE)
-                hasher.update(chunk)
-                downloaded += len(chunk)
-                if not chunk:
-                    break
-                temp_file.write(chunk)
+        with timer.stage('download'):
+            if downloader is None:
+                req = urlopen_with_auth(url, auth=auth, cache=cache)
+            else:
+                req = downloader.open(url, auth=auth, cache=cache)
+        try:
+            thisurl = cache.get(url, dict())
+            if req.getcode() == 304:
+                timer.count('url_cache_hits')
+                remembered_digests(thisurl, digests)
+                return None, thisurl['md5'], None
+            mime_type = req.info().get('Content-type')
+            remember_validators(thisurl, req.info())
+            # only now, a 304 has nothing to write
+            temp_file = download_file(spool_size)
+            try:
+                while True:
+                    with timer.stage('download') as stage:
+                        chunk = req.read(read_size)
+                        stage.bytes = len(chunk)
+                    if not chunk:
+                        break
+                    # hashed on the hasher's threads while this goes on
+                    hasher.update(chunk)
+                    with timer.stage('write', len(chunk)):
+                        if probe is not None:
+                            probe.feed(chunk)
+                        temp_file.write(chunk)
+            finally:
+                if not spool_size:
+                    temp_file.close()
+        finally:
+            if isinstance(req, PooledResponse):
+                # give up the download slot even if something went wrong
+                req.close()
+            hashes = hasher.hexdigests()
+            timer.add('hash', hasher.seconds, hasher.size)
     except urllib2.HTTPError, e:
         print "HTTP Error:", e.code, url
         return False
@@ -271,13 +1875,70 @@ def checkChunks(url, auth=None, cache={}):
         print "URL Error:", e.reason, url
         return False
 
-    md5 = hasher.hexdigest()
+    md5 = hashes.pop('md5')
     thisurl['md5'] = md5
+    remember_digests(thisurl, digests, hashes)
     cache[url] = thisurl
+    if spool_size:
+        temp_file.seek(0)
+        return temp_file, md5, mime_type
     return temp_file.name, md5, mime_type
 
 
-def s3move(place1, place2, mime, s3):
+def download_file(spool_size=None):
+    """ a new file to download into; kept in memory until it grows past
+        `spool_size` bytes if that is given, otherwise a named temp file """
+    if spool_size:
+        return tempfile.SpooledTemporaryFile(max_size=spool_size,
+                                             prefix='md5s3_')
+    temp_file = tempfile.NamedTemporaryFile(delete=False, prefix='md5s3_')
+    logging.getLogger('MD5S3').info("temp file path %s" % temp_file.name)
+    return temp_file
+
+
+def remember_digests(thisurl, digests, hashes):
+    """ fill in the extra `digests` asked for from `hashes`, and keep them
+        in the url cache entry `thisurl` """
+    if digests is not None:
+        digests.update(hashes)
+        thisurl.update(hashes)
+
+
+def remembered_digests(thisurl, digests):
+    """ fill in the extra `digests` asked for from the url cache entry
+        `thisurl`, as far as it has them """
+    if digests is not None:
+        for name in digests:
+            digests[name] = thisurl.get(name)
+
+
+def remember_validators(thisurl, headers):
+    """ record the ETag and Last-Modified `headers` of a response in the
+        url cache entry `thisurl` """
+    # record these headers, they will let us pretend like we are a cacheing
+    # proxy server, and send conditional GETs next time we see this file
+    etag = headers.get('ETag', None);
+    if etag:
+        thisurl['If-None-Match'] = etag
+    lmod = headers.get('Last-Modified', None);
+    if lmod:
+        thisurl['If-Modified-Since'] = lmod
+
+
+def s3move(place1, place2, mime, s3, md5=None,
+           multipart_threshold=MULTIPART_THRESHOLD, timer=None, check=True):
+    """ upload the file at `place1` (a path, or a file object as returned
+        by `checkChunks` with a `spool_size`) to the s3 url `place2`
+        `md5` is the optional hex digest of the file, when it is known
+        boto doesn't have to read the whole file once more to compute it
+        `multipart_threshold` files bigger than this many bytes are sent
+        with `multipart_upload`
+        `timer` is an optional `Timings` to record the HEAD and PUT in
+        `check` False when the caller already knows there is nothing at
+            `place2`, which saves the HEAD
+    """
+    if timer is None:
+        timer = Timings()
     l = logging.getLogger('MD5S3:s3move')
     l.debug({
         'place1': place1,
@@ -294,36 +1955,783 @@ def s3move(place1, place2, mime, s3):
     except boto.exception.S3ResponseError:
         bucket = s3.create_bucket(parts.netloc)
         l.debug('bucket created')
-    if not(bucket.get_key(parts.path, validate=False)):
+    existing = None
+    if check:
+        # validate=False would skip the HEAD request and always find a key
+        with timer.stage('s3_head'):
+            existing = bucket.get_key(parts.path)
+    if not existing:
+        size = file_size(place1)
+        if size > multipart_threshold:
+            with timer.stage('s3_put', size):
+                multipart_upload(bucket, parts.path, place1, mime)
+            l.debug('file sent to s3 in parts')
+            return
         key = bucket.new_key(parts.path)
         # metadata has to be set before setting contents/creating object. 
         # See https://gist.github.com/garnaat/1791086
         key.set_metadata("Content-Type", mime)
-        key.set_contents_from_filename(place1)
+        if md5:
+            md5 = (md5, base64.b64encode(binascii.unhexlify(md5)))
+        with timer.stage('s3_put', size):
+            if hasattr(place1, 'read'):
+                key.set_contents_from_file(place1, md5=md5, rewind=True)
+            else:
+                key.set_contents_from_filename(place1, md5=md5)
         # key.set_acl('public-read')
         l.debug('file sent to s3')
     else:
+        timer.count('dedup_skips')
         l.info('key existed already')
 
 
+def multipart_upload(bucket, key_name, filepath, mime,
+                     part_size=MULTIPART_PART_SIZE, jobs=MULTIPART_JOBS,
+                     retries=MULTIPART_RETRIES):
+    """ upload the file at `filepath` (or the file object) to `key_name`
+        in the boto `bucket` as an s3 multipart upload, `jobs` parts at a
+        time.  A part that fails is tried again on its own `retries` times
+        before the whole upload is given up on (and cancelled).
+    """
+    l = logging.getLogger('MD5S3:multipart')
+    size = file_size(filepath)
+    lock = threading.Lock()
+
+    def open_part(offset, length):
+        if not hasattr(filepath, 'read'):
+            fp = open(filepath, 'rb')
+            fp.seek(offset)
+            return fp
+        # the parts all come out of the one file object
+        with lock:
+            filepath.seek(offset)
+            return io.BytesIO(filepath.read(length))
+    metadata = {'Content-Type': mime} if mime else {}
+    mp = bucket.initiate_multipart_upload(key_name, metadata=metadata)
+
+    def upload(part_num, offset):
+        for attempt in range(retries + 1):
+            length = min(part_size, size - offset)
+            try:
+                fp = open_part(offset, length)
+                try:
+                    mp.upload_part_from_file(fp, part_num, size=length)
+                finally:
+                    fp.close()
+                return
+            except Exception as e:
+                if attempt == retries:
+                    raise
+                l.warning('part {0} of {1} failed ({2}), retrying'.format(
+                    part_num, key_name, e))
+                time.sleep(2 ** attempt)
+
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = [
+                pool.submit(upload, part_num, offset)
+                for part_num, offset in enumerate(
+                    range(0, size, part_size), start=1)
+            ]
+            for future in as_completed(futures):
+                future.result()
+    except Exception:
+        mp.cancel_upload()
+        raise
+    mp.complete_upload()
+
+
+def file_size(filepath):
+    ''' size in bytes of the file at `filepath`, or of the file object '''
+    if hasattr(filepath, 'read'):
+        filepath.seek(0, os.SEEK_END)
+        return filepath.tell()
+    return os.path.getsize(filepath)
+
+
 def image_info(filepath):
     ''' get image info
-        `filepath` path to a file
+        `filepath` path to a file, or a file object
         returns
           a tuple of two values
             1. mime/type if an image; otherwise None
             2. a tuple of (height, width) if an image; otherwise (0,0)
+        see `ImageProbe`
+    '''
+    return image_probe.info(filepath)
+
+
+def draft_image(img, size):
+    ''' set up the not yet loaded PIL `img` to decode at a reduced
+        resolution that is still at least DRAFT_GAP times `size`: DCT
+        scaling for JPEG, a smaller page of a pyramidal TIFF
     '''
+    want = (size[0] * DRAFT_GAP, size[1] * DRAFT_GAP)
+    if img.format == "JPEG":
+        img.draft(None, want)
+    elif img.format == "TIFF":
+        (width, height) = img.size
+        (best, best_width) = (0, width)
+        for page in range(1, getattr(img, "n_frames", 1)):
+            img.seek(page)
+            (w, h) = img.size
+            # a reduced copy of the first page has the same aspect ratio
+            same_shape = abs(float(w) / h - float(width) / height) < 0.01
+            if (same_shape and w >= want[0] and h >= want[1]
+                    and w < best_width):
+                (best, best_width) = (page, w)
+        img.seek(best)
+
+
+def resize_size(img, width, height):
+    ''' the (width, height) pilbox's `Image.resize` makes of the PIL `img`
+        for `width` and `height`; an empty one keeps the aspect ratio '''
+    aspect = float(img.size[0]) / img.size[1]
+    if not width:
+        width = int((int(height) or img.size[1]) * aspect)
+    if not height:
+        height = int((int(width) or img.size[0]) / aspect)
+    return (int(width), int(height))
+
+
+def process_image(body, operations, save_options):
+    ''' decode `body`, apply the pilbox `Image` method calls in
+        `operations`, as (name, args, options), and encode it again
+        returns (format, bytes)
+    '''
+    image = pilbox.image.Image(io.BytesIO(body))
+    # offsets for rotate and region are in full size pixels
+    if operations and operations[0][0] == "resize":
+        draft_image(image.img, resize_size(image.img, *operations[0][1]))
+    for (name, args, opts) in operations:
+        getattr(image, name)(*args, **opts)
+    outfile = image.save(**save_options)
     try:
-        return (
-            magic.Magic(mime=True).from_file(filepath),
-            Image.open(filepath).size
-        )
-    except IOError as e:
-        if not e.message.startswith('cannot identify image file'):
-            raise e
+        return (image.img.format, outfile.read())
+    finally:
+        outfile.close()
+
+
+def render_derivatives(filepath, derivatives):
+    ''' yield (spec, mime/type, bytes) for each 'mode/WxH' in `derivatives`
+        rendered from the image at `filepath` (or the file object) as the
+        thumbnail server would with pilbox's default options.  The image
+        is only decoded once, at the size the biggest of them needs.
+    '''
+    if hasattr(filepath, 'read'):
+        filepath.seek(0)
+        stream = filepath
+    else:
+        stream = open(filepath, 'rb')
+    try:
+        original = pilbox.image.Image(stream).img
+        sizes = [regex_derivative.match(spec).groups() for spec in derivatives]
+        sizes = [resize_size(original, w, h) for (mode, w, h) in sizes]
+        draft_image(original, (max(w for (w, h) in sizes),
+                               max(h for (w, h) in sizes)))
+        original.load()
+        mime = 'image/{0}'.format(original.format.lower())
+        for (spec, size) in zip(derivatives, sizes):
+            # a fresh pilbox Image for each, as the thumbnail server has,
+            # so nothing one resize leaves set (fill skips the background)
+            # carries over; they share the decoded frame
+            stream.seek(0)
+            image = pilbox.image.Image(stream)
+            image.img = original.copy()
+            image.resize(size[0], size[1], mode=spec.split('/')[0])
+            outfile = image.save()
+            yield (spec, mime, outfile.read())
+    finally:
+        if stream is not filepath:
+            stream.close()
+
+
+def stash_derivatives(filepath, s3_url, derivatives, s3):
+    ''' render the `derivatives` that are not in s3 yet from the image at
+        `filepath` (or the file object) stashed at `s3_url`, and put them
+        next to it; an image pilbox can't handle gets none
+    '''
+    l = logging.getLogger('MD5S3:derivatives')
+    parts = urlparse.urlsplit(s3_url)
+    bucket = s3.get_bucket(parts.netloc, validate=False)
+    todo = [
+        spec for spec in derivatives
+        if not bucket.get_key(urlparse.urlsplit(
+            derivative_url(s3_url, spec)).path)
+    ]
+    if not todo:
+        return
+    try:
+        for (spec, mime, body) in render_derivatives(filepath, todo):
+            # `todo` is what the HEADs above did not find
+            s3move(io.BytesIO(body), derivative_url(s3_url, spec), mime, s3,
+                   check=False)
+    except (pilbox.errors.PilboxError, IOError) as e:
+        l.warning('no derivatives for {0}: {1}'.format(s3_url, e))
+
+
+class Hasher(object):
+    """ the md5, and the `extra` hashlib digests, of a stream of chunks.
+        Once there is more than one chunk, each digest is worked out on a
+        thread of its own; hashlib lets go of the GIL for big chunks, so
+        the hashing goes on alongside the reading and writing, and the
+        digests alongside each other.
+        With `threaded` False each chunk is hashed as it comes, on the
+        caller's thread; an IOLoop can't wait on a full queue, and has too
+        many transfers going to give each its own threads.
+    """
+    def __init__(self, extra=(), queue_size=HASH_QUEUE_SIZE, threaded=True):
+        self.names = ['md5'] + [name for name in extra if name != 'md5']
+        self.hashes = [hashlib.new(name) for name in self.names]
+        self.queue_size = queue_size
+        self.threaded = threaded
+        self.first = None
+        self.threads = None
+        self.queues = None
+        self.size = 0
+        self.seconds = 0
+        self.lock = threading.Lock()
+
+    def update(self, chunk):
+        self.size += len(chunk)
+        if not self.threaded:
+            start = time.time()
+            for h in self.hashes:
+                h.update(chunk)
+            self.seconds += time.time() - start
+            return
+        if self.threads is None:
+            if self.first is None:
+                # a file in one chunk is not worth a thread
+                self.first = chunk
+                return
+            self.start()
+        for queue in self.queues:
+            queue.put(chunk)
+
+    def start(self):
+        self.queues = [Queue.Queue(self.queue_size) for h in self.hashes]
+        self.threads = [
+            threading.Thread(target=self.work, args=(h, queue))
+            for (h, queue) in zip(self.hashes, self.queues)
+        ]
+        for (thread, queue) in zip(self.threads, self.queues):
+            thread.daemon = True
+            thread.start()
+            queue.put(self.first)
+
+    def work(self, h, queue):
+        seconds = 0
+        while True:
+            chunk = queue.get()
+            if chunk is None:
+                break
+            start = time.time()
+            h.update(chunk)
+            seconds += time.time() - start
+        with self.lock:
+            self.seconds += seconds
+
+    def hexdigests(self):
+        """ {algorithm: hex digest} once all the chunks are in """
+        if self.threads is None:
+            if self.first is not None:
+                start = time.time()
+                for h in self.hashes:
+                    h.update(self.first)
+                self.seconds += time.time() - start
+                self.first = None
+        else:
+            for queue in self.queues:
+                queue.put(None)
+            for thread in self.threads:
+                thread.join()
+            self.threads = []
+        return dict((name, h.hexdigest())
+                    for (name, h) in zip(self.names, self.hashes))
+
+
+class Timings(object):
+    """ the seconds and bytes spent in each stage of one `md5s3stash`
+        call, and counts of what happened along the way (cache hits, ...)
+    """
+    def __init__(self):
+        self.seconds = {}
+        self.bytes = {}
+        self.events = {}
+
+    def add(self, stage, seconds, nbytes=0):
+        self.seconds[stage] = self.seconds.get(stage, 0) + seconds
+        if nbytes:
+            self.bytes[stage] = self.bytes.get(stage, 0) + nbytes
+
+    @contextmanager
+    def stage(self, stage, nbytes=0):
+        """ time the block as `stage`; the bytes can be set on what it
+            yields when they are not known up front """
+        timed = TimedStage(nbytes)
+        start = time.time()
+        try:
+            yield timed
+        finally:
+            self.add(stage, time.time() - start, timed.bytes)
+
+    def count(self, event, n=1):
+        self.events[event] = self.events.get(event, 0) + n
+
+    def as_dict(self):
+        return dict(seconds=dict((stage, round(seconds, 6)) for
+                                 (stage, seconds) in self.seconds.items()),
+                    bytes=dict(self.bytes), events=dict(self.events))
+
+
+class TimedStage(object):
+    """ bytes moved in a `Timings.stage` """
+    def __init__(self, nbytes=0):
+        self.bytes = nbytes
+
+
+class Metrics(object):
+    """ cumulative counters and gauges for a whole run, or the life of a
+        server, to export in the Prometheus text format or as StatsD lines;
+        every name gets `prefix` in front of it
+    """
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.counters = {}
+        self.gauges = {}
+        self.exported = {}  # counter values last sent by `statsd`
+        self.lock = threading.Lock()
+
+    def add(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def record(self, timer):
+        """ add up the `Timings` of a call """
+        for (stage, seconds) in timer.seconds.items():
+            self.add('stage_seconds_total', seconds, stage=stage)
+        for (stage, nbytes) in timer.bytes.items():
+            self.add('stage_bytes_total', nbytes, stage=stage)
+        for (event, n) in timer.events.items():
+            self.add('{0}_total'.format(event), n)
+
+    def prometheus(self):
+        """ the Prometheus text exposition of everything so far """
+        with self.lock:
+            samples = ([(key, value, 'counter')
+                        for (key, value) in self.counters.items()] +
+                       [(key, value, 'gauge')
+                        for (key, value) in self.gauges.items()])
+        lines = []
+        typed = set()
+        for ((name, labels), value, kind) in sorted(samples):
+            name = '{0}_{1}'.format(self.prefix, name)
+            if name not in typed:
+                lines.append('# TYPE {0} {1}'.format(name, kind))
+                typed.add(name)
+            if labels:
+                name = '{0}{{{1}}}'.format(name, ','.join(
+                    '{0}="{1}"'.format(label, str(text).replace(
+                        '\\', '\\\\').replace('"', '\\"'))
+                    for (label, text) in labels))
+            lines.append('{0} {1}'.format(name, metric_value(value)))
+        return ''.join(line + '\n' for line in lines)
+
+    def statsd(self):
+        """ StatsD lines: counters as the change since the last call, and
+            gauges; label values become parts of the name """
+        lines = []
+        with self.lock:
+            for (key, value) in sorted(self.counters.items()):
+                change = value - self.exported.get(key, 0)
+                self.exported[key] = value
+                if change:
+                    lines.append('{0}:{1}|c'.format(
+                        self.statsd_name(key), metric_value(change)))
+            for (key, value) in sorted(self.gauges.items()):
+                lines.append('{0}:{1}|g'.format(
+                    self.statsd_name(key), metric_value(value)))
+        return ''.join(line + '\n' for line in lines)
+
+    def statsd_name(self, key):
+        (name, labels) = key
+        return '.'.join([self.prefix, name] + [str(text) for (label, text)
+                                                in labels])
+
+
+def metric_value(value):
+    """ a number as text, without a trailing L or exponent for ints """
+    if isinstance(value, float):
+        return repr(value)
+    return str(int(value))
+
+
+# the counters of everything `md5s3stash` has done in this process
+metrics = Metrics('md5s3stash')
+
+
+class StashSession(object):
+    ''' a long lived s3 connection that remembers the bucket handles it
+        has looked up, for a harvester to keep for the life of a worker;
+        use it anywhere a boto.connect_s3() is taken (`conn` in `md5s3stash`,
+        `s3` in `s3move`).  boto's connection pool is thread safe, so one
+        session can be shared by all of `stash_many`'s threads.
+        `conn` is an optional boto.connect_s3() to wrap
+    '''
+    def __init__(self, conn=None):
+        self.conn = conn if conn is not None else boto.connect_s3()
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def get_bucket(self, bucket_name, validate=False):
+        with self.lock:
+            if bucket_name in self.buckets:
+                return self.buckets[bucket_name]
+        bucket = self.conn.get_bucket(bucket_name, validate=validate)
+        with self.lock:
+            return self.buckets.setdefault(bucket_name, bucket)
+
+    def create_bucket(self, bucket_name, *args, **kwargs):
+        bucket = self.conn.create_bucket(bucket_name, *args, **kwargs)
+        with self.lock:
+            self.buckets[bucket_name] = bucket
+        return bucket
+
+    def warm(self, bucket_base, bucket_scheme='simple'):
+        ''' look up all the buckets for `bucket_base` ahead of time (all 36
+            of them for `multibucket`)
+        '''
+        for (bucket_name, prefix) in stash_locations(bucket_base,
+                                                     bucket_scheme):
+            self.get_bucket(bucket_name)
+
+    def __getattr__(self, name):
+        # anything else goes straight to the boto connection
+        return getattr(self.conn, name)
+
+
+class ChunkProbe(object):
+    ''' sniff the mime/type and image dimensions of a file from the chunks
+        of it that stream by during the download, so the file does not have
+        to be opened again to find out what it is
+        `header_size` is how much of the start of the file to hold on to
+    '''
+    def __init__(self, header_size=PROBE_HEADER_SIZE):
+        self.header_size = header_size
+        self.header = b''
+        self.size = None
+        self.truncated = False
+
+    def feed(self, chunk):
+        if self.size is not None:
+            return
+        room = self.header_size - len(self.header)
+        if len(chunk) > room:
+            self.truncated = True
+        if room <= 0:
+            return
+        self.header += chunk[:room]
+        try:
+            # Image.open is lazy, it only parses far enough to get the size
+            self.size = Image.open(io.BytesIO(self.header)).size
+        except Exception:
+            # not an image, or not enough of one yet
+            pass
+
+    def info(self, filepath):
+        ''' same return value as `image_info`
+            `filepath` is the downloaded file, it is only looked at if the
+            image header did not fit in `header_size`
+        '''
+        if self.size is not None:
+            return (image_probe.mime_type(self.header), self.size)
+        if self.truncated:
+            return image_probe.info(filepath)
+        # saw the whole file, and it is not an image
+        return (None, (0, 0))
+
+
+class ImageProbe(object):
+    ''' the mime/type and image dimensions of files, from the first
+        `header_size` bytes of them.  libmagic takes a while to load its
+        database, so each thread makes its `magic.Magic` once and keeps
+        it; one probe can be shared by all the threads of a batch, as the
+        module's `image_probe` is by `image_info` and `ChunkProbe`.
+    '''
+    def __init__(self, header_size=PROBE_HEADER_SIZE):
+        self.header_size = header_size
+        self.local = threading.local()
+
+    def magic(self):
+        # a libmagic handle is not safe to share between threads
+        if not hasattr(self.local, 'magic'):
+            self.local.magic = magic.Magic(mime=True)
+        return self.local.magic
+
+    def mime_type(self, header):
+        return self.magic().from_buffer(header)
+
+    def info(self, filepath):
+        ''' same return value as `image_info` '''
+        if hasattr(filepath, 'read'):
+            filepath.seek(0)
+            header = filepath.read(self.header_size)
+            filepath.seek(0)
+        else:
+            with open(filepath, 'rb') as f:
+                header = f.read(self.header_size)
+        if len(header) < self.header_size:
+            # that was all of it
+            filepath = None
+        return self.header_info(header, filepath)
+
+    def header_info(self, header, filepath=None):
+        ''' same return value as `image_info`, for the file that starts with
+            `header`; the whole file at `filepath` (a path or a file object)
+            is only opened if the image header does not fit in `header`
+        '''
+        try:
+            # Image.open is lazy, it only parses far enough to get the size
+            size = Image.open(io.BytesIO(header)).size
+        except Exception:
+            if filepath is None:
+                return (None, (0, 0))
+            if hasattr(filepath, 'read'):
+                filepath.seek(0)
+            try:
+                size = Image.open(filepath).size
+            except IOError as e:
+                if not e.message.startswith('cannot identify image file'):
+                    raise e
+                return (None, (0, 0))
+        return (self.mime_type(header), size)
+
+
+# the probe `md5s3stash` shares between all its threads
+image_probe = ImageProbe()
+
+
+class SqliteCache(MutableMapping):
+    ''' a dict that lives in the sqlite file at `path`, so `url_cache` and
+        `hash_cache` survive between runs on the same machine
+        `table` lets more than one cache share a file
+        `max_entries` when there are more than this many, the least
+        recently used are dropped, CACHE_EVICT_FRACTION of them at a time
+        reads are noted as uses in memory and written CACHE_TOUCH_BATCH at
+        a time; `flush` writes out the rest
+        values are pickled; as with redis_collections, changing a value
+        you got out of the cache does not change the cache, set it again
+    '''
+    def __init__(self, path, table='cache', max_entries=CACHE_SIZE):
+        self.table = table
+        self.max_entries = max_entries
+        self.lock = threading.RLock()
+        # stash_many shares one cache between its threads
+        self.db = sqlite3.connect(path, check_same_thread=False,
+                                  isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS "{0}" '
+            '(key TEXT PRIMARY KEY, value BLOB, used INTEGER)'.format(table))
+        self.db.execute(
+            'CREATE INDEX IF NOT EXISTS "{0}_used" ON "{0}" (used)'.format(
+                table))
+        self.clock = self._one('SELECT MAX(used) FROM "{0}"') or 0
+        self.count = len(self)
+        self.touched = {}
+
+    def _one(self, sql, *args):
+        with self.lock:
+            row = self.db.execute(sql.format(self.table), args).fetchone()
+        return row[0] if row else None
+
+    def _tick(self):
+        self.clock += 1
+        return self.clock
+
+    def __getitem__(self, key):
+        with self.lock:
+            value = self._one('SELECT value FROM "{0}" WHERE key=?', key)
+            if value is None:
+                raise KeyError(key)
+            self.touched[key] = self._tick()
+            if len(self.touched) >= CACHE_TOUCH_BATCH:
+                self.flush()
+        return pickle.loads(bytes(value))
+
+    def flush(self):
+        ''' write out the uses noted since last time, in one transaction '''
+        with self.lock:
+            if not self.touched:
+                return
+            self.db.execute('BEGIN')
+            try:
+                self.db.executemany(
+                    'UPDATE "{0}" SET used=? WHERE key=?'.format(self.table),
+                    [(used, key) for (key, used) in self.touched.items()])
+            except:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+            self.touched = {}
+
+    def __setitem__(self, key, value):
+        blob = sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        with self.lock:
+            if key not in self:
+                self.count += 1
+            self.touched.pop(key, None)
+            self.db.execute(
+                'INSERT OR REPLACE INTO "{0}" (key, value, used) '
+                'VALUES (?, ?, ?)'.format(self.table),
+                (key, blob, self._tick()))
+            if self.count > self.max_entries:
+                self._evict()
+
+    def _evict(self):
+        self.flush()
+        # another process might be sharing the file, so count again; this
+        # only happens once every CACHE_EVICT_FRACTION of `max_entries`
+        self.count = len(self)
+        keep = self.max_entries - int(self.max_entries * CACHE_EVICT_FRACTION)
+        extra = self.count - keep
+        if self.count > self.max_entries and extra > 0:
+            self.db.execute(
+                'DELETE FROM "{0}" WHERE key IN (SELECT key FROM "{0}" '
+                'ORDER BY used LIMIT ?)'.format(self.table), (extra,))
+            self.count -= extra
+
+    def __delitem__(self, key):
+        with self.lock:
+            if key not in self:
+                raise KeyError(key)
+            self.touched.pop(key, None)
+            self.db.execute(
+                'DELETE FROM "{0}" WHERE key=?'.format(self.table), (key,))
+            self.count -= 1
+
+    def __contains__(self, key):
+        # checking does not count as a use
+        return self._one('SELECT 1 FROM "{0}" WHERE key=?', key) is not None
+
+    def __iter__(self):
+        with self.lock:
+            keys = self.db.execute(
+                'SELECT key FROM "{0}"'.format(self.table)).fetchall()
+        return iter([row[0] for row in keys])
+
+    def __len__(self):
+        return self._one('SELECT COUNT(*) FROM "{0}"')
+
+
+class Inventory(object):
+    ''' a snapshot of what is stashed, in the sqlite file at `path` made by
+        `build_inventory`: an `InventoryEntry` for each md5 and layout,
+        looked up by its primary key index without going to s3.  It
+        answers `md5 in inventory`, so it can be given to `md5s3stash` as
+        `stashed`.  The file records the `bucket_base` it was listed from;
+        opening it for another one is a ValueError, and with
+        `bucket_scheme` only the files listed in that layout count.
+        It can be shared between threads.  The file has to exist, a
+        mistyped path is an IOError rather than an empty inventory.
+    '''
+    def __init__(self, path, bucket_base=None, bucket_scheme=None):
+        if not os.path.exists(path):
+            raise IOError(errno.ENOENT, 'no inventory', path)
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        try:
+            row = self.db.execute(
+                "SELECT value FROM about WHERE key='bucket_base'").fetchone()
+        except sqlite3.DatabaseError:
+            row = None
+        if row is None:
+            self.db.close()
+            raise ValueError(
+                '{0} is not an inventory, make it again with '
+                '`md5s3stash inventory`'.format(path))
+        self.bucket_base = row[0]
+        if bucket_base is not None and bucket_base != self.bucket_base:
+            self.db.close()
+            raise ValueError('{0} lists {1}, not {2}'.format(
+                path, self.bucket_base, bucket_base))
+        self.bucket_schemes = set(value for (value,) in self.db.execute(
+            "SELECT value FROM about WHERE key='bucket_scheme'"))
+        if bucket_scheme is not None and (
+                bucket_scheme not in self.bucket_schemes):
+            self.db.close()
+            raise ValueError('{0} does not list the {1} layout'.format(
+                path, bucket_scheme))
+        self.bucket_scheme = bucket_scheme
+
+    @classmethod
+    def create(cls, path, bucket_base, bucket_schemes=('simple',)):
+        ''' a new, empty Inventory at `path` for `bucket_base` as laid out
+            in each of the `bucket_schemes` '''
+        db = sqlite3.connect(path)
+        with db:
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS inventory (md5 TEXT, '
+                'bucket_scheme TEXT, size INTEGER, etag TEXT, mime_type TEXT, '
+                'PRIMARY KEY (md5, bucket_scheme))')
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS about (key TEXT, value TEXT)')
+            db.execute('DELETE FROM about')
+            db.execute('INSERT INTO about VALUES (?, ?)',
+                       ('bucket_base', bucket_base))
+            db.executemany('INSERT INTO about VALUES (?, ?)',
+                           (('bucket_scheme', bucket_scheme)
+                            for bucket_scheme in bucket_schemes))
+        db.close()
+        return cls(path)
+
+    def get(self, md5, default=None):
+        if self.bucket_scheme is None:
+            where, args = 'md5=?', (md5,)
+        else:
+            where, args = 'md5=? AND bucket_scheme=?', (md5,
+                                                        self.bucket_scheme)
+        with self.lock:
+            row = self.db.execute(
+                'SELECT md5, size, etag, mime_type FROM inventory '
+                'WHERE {0} LIMIT 1'.format(where), args).fetchone()
+        return InventoryEntry(*row) if row else default
+
+    def add(self, entries, bucket_scheme='simple'):
+        ''' put the `InventoryEntry`s `entries`, listed in the
+            `bucket_scheme` layout, in the inventory '''
+        with self.lock:
+            with self.db:
+                self.db.executemany(
+                    'INSERT OR REPLACE INTO inventory '
+                    '(md5, bucket_scheme, size, etag, mime_type) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    ((md5, bucket_scheme, size, etag, mime_type)
+                     for (md5, size, etag, mime_type) in entries))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def __contains__(self, md5):
+        return self.get(md5) is not None
+
+    def __len__(self):
+        if self.bucket_scheme is None:
+            where, args = '', ()
         else:
-            return (None, (0,0))
+            where, args = ' WHERE bucket_scheme=?', (self.bucket_scheme,)
+        with self.lock:
+            return self.db.execute(
+                'SELECT COUNT(DISTINCT md5) FROM inventory' + where,
+                args).fetchone()[0]
 
 
 # example 11.7 Defining URL handlers
@@ -10,7 +10,7 @@ set -o errtrace  # trace ERR through 'time command' and other functions
 set -o nounset   ## set -u : exit the script if you try to use an uninitialised variable
 set -o errexit   ## set -e : exit the script if any statement returns a non-true return value
 
-for letter in 0 1 2 3 4 5 6 7 8 9 a b c d e f g h i j k l m n o p q r s t u v w x y z
-  do 
-    aws s3 sync "s3://$letter.$BUCKET_BASE_1" "s3://$BUCKET_BASE_2"
-done
+# copies server side, 36 buckets listed a few at a time; run it again with the
+# same checkpoint to pick up where an interrupted run left off
+md5s3stash migrate -b "$BUCKET_BASE_1" --to "$BUCKET_BASE_2" \
+  --checkpoint "${CHECKPOINT:-migrate.checkpoint}"
@@ -28,7 +28,8 @@ setup(
             'https://pypi.python.org/packages/source/p/pilbox/pilbox-1.0.3.tar.gz#md5=514a99f784a4c06242144a005322fe52#egg=pilbox', 
             'https://github.com/mredar/redis-collections/archive/master.zip#egg=redis-collections',
             ],
-    install_requires=['boto', 'basin', 'pilbox', 'python-magic'],
+    install_requires=['boto', 'basin', 'futures', 'pilbox', 'python-magic',
+                      'tornado'],
     url='https://github.com/tingletech/md5s3stash',
     py_modules=['md5s3stash','thumbnail'],
     entry_points={
@@ -1,9 +1,13 @@
 import os, sys
+import json
+import hashlib
 import shutil # for cleanup
+import tempfile
+import time
 from cStringIO import StringIO
 from contextlib import contextmanager
 from urllib2 import HTTPError, URLError
-from mock import patch
+from mock import patch, MagicMock
 import md5s3stash
 import urllib2
 from collections import namedtuple
@@ -17,6 +21,14 @@ if not hasattr(unittest, 'skip'):
 
 import httpretty
 import redis_collections
+import tornado.gen
+import tornado.httpserver
+import tornado.testing
+import tornado.web
+
+os.environ.setdefault('BUCKET_BASE', 'test')
+import thumbnail
+import benchmark
 
 DIR_THIS_FILE = os.path.abspath(os.path.split(__file__)[0])
 DIR_FIXTURES = os.path.join(DIR_THIS_FILE, 'fixtures')
@@ -176,6 +188,283 @@ class URLOpenWithAuthTestCase(unittest.TestCase):
         self.assertEqual(test_str, f.read())
         #what else can i test?
 
+class DownloaderTestCase(unittest.TestCase):
+    def setUp(self):
+        super(DownloaderTestCase, self).setUp()
+        httpretty.enable()
+        self.downloader = md5s3stash.Downloader()
+
+    def tearDown(self):
+        httpretty.disable()
+        httpretty.reset()
+
+    def test_open(self):
+        httpretty.register_uri(httpretty.GET, 'https://example.edu/a',
+                               body='test body', content_type='text/plain',
+                               adding_headers={'ETag': 'nice etag'})
+        cache = {'https://example.edu/a': {'If-Modified-Since': 'since'}}
+        resp = self.downloader.open('https://example.edu/a',
+                                    auth=('user', 'password'), cache=cache)
+        self.assertEqual(resp.getcode(), 200)
+        self.assertEqual(resp.info()['content-type'], 'text/plain')
+        self.assertEqual(resp.read(4), 'test')
+        self.assertEqual(resp.read(100), ' body')
+        self.assertEqual(resp.read(100), '')
+        headers = httpretty.last_request().headers
+        self.assertEqual(headers['If-Modified-Since'], 'since')
+        self.assertTrue(headers['Authorization'].startswith('Basic '))
+        # connection went back in the pool for the next request
+        self.assertEqual(
+            len(self.downloader.pools[('https', 'example.edu')]), 1)
+
+    def test_redirect_to_s3(self):
+        httpretty.register_uri(
+            httpretty.GET, 'https://example.edu/nuxeo/', status=302,
+            location='https://s3.amazonaws.com/bucket/file')
+        httpretty.register_uri(httpretty.GET,
+                               'https://s3.amazonaws.com/bucket/file',
+                               body='from s3')
+        resp = self.downloader.open('https://example.edu/nuxeo/',
+                                    auth=('user', 'password'))
+        self.assertEqual(resp.read(), 'from s3')
+        self.assertFalse('Authorization' in httpretty.last_request().headers)
+
+    def test_http_error(self):
+        httpretty.register_uri(httpretty.GET, 'http://example.edu/gone',
+                               status=404)
+        self.assertRaises(HTTPError, self.downloader.open,
+                          'http://example.edu/gone')
+        with capture(md5s3stash.checkChunks, 'http://example.edu/gone',
+                     downloader=self.downloader) as output:
+            self.assertTrue(output.startswith('HTTP Error: 404'))
+
+    def test_checkChunks(self):
+        httpretty.register_uri(httpretty.GET, 'http://example.edu/b',
+                               body='test resp', content_type='text/html')
+        cache = {}
+        (temp_file, md5, mime_type) = md5s3stash.checkChunks(
+            'http://example.edu/b', cache=cache, downloader=self.downloader)
+        os.remove(temp_file)
+        self.assertEqual(md5, '85b5a0deaa11f3a5d1762c55701c03da')
+        self.assertEqual(mime_type, 'text/html')
+
+    def test_checkChunks_gives_back_slot(self):
+        httpretty.register_uri(httpretty.GET, 'http://example.edu/b',
+                               body='test resp')
+        with patch('md5s3stash.download_file',
+                   side_effect=OSError(28, 'No space left on device')):
+            # more than the host's limit, none of them may hang
+            for n in range(md5s3stash.HOST_CONCURRENCY + 1):
+                self.assertRaises(OSError, md5s3stash.checkChunks,
+                                  'http://example.edu/b',
+                                  downloader=self.downloader)
+        self.assertEqual(self.downloader.scheduler.hosts['example.edu'].active,
+                         0)
+
+    @patch('md5s3stash.urlopen_with_auth')
+    def test_proxy(self, mock_urlopen):
+        mock_urlopen.return_value = FakeReq('via proxy')
+        with patch.dict(os.environ, {'http_proxy': 'http://proxy:3128',
+                                     'no_proxy': 'inside.example.edu'}):
+            self.assertTrue(md5s3stash.uses_proxy('http://example.edu/b'))
+            resp = self.downloader.open('http://example.edu/b')
+            self.assertEqual(resp.read(100), 'via proxy')
+            self.assertFalse(
+                md5s3stash.uses_proxy('http://inside.example.edu/b'))
+            self.assertFalse(md5s3stash.uses_proxy('https://example.edu/b'))
+        mock_urlopen.assert_called_once_with('http://example.edu/b',
+                                             auth=None, cache={})
+        self.assertEqual(self.downloader.scheduler.hosts, {})
+
+    def test_local_file(self):
+        resp = self.downloader.open(os.path.join(DIR_FIXTURES, '1x1.png'))
+        self.assertEqual(len(resp.read()), 95)
+
+    @patch('md5s3stash.BACKOFF_BASE', 0)
+    def test_throttled(self):
+        httpretty.register_uri(httpretty.GET, 'http://example.edu/busy',
+                               responses=[
+            httpretty.Response('slow down', status=429,
+                               adding_headers={'Retry-After': '0'}),
+            httpretty.Response('come back later', status=503),
+            httpretty.Response('test body'),
+        ])
+        resp = self.downloader.open('http://example.edu/busy')
+        self.assertEqual(resp.read(), 'test body')
+        self.assertEqual(len(httpretty.latest_requests()), 3)
+        host = self.downloader.scheduler.hosts['example.edu']
+        self.assertEqual(host.active, 0)
+        # halved (to no less than 1) twice, then a step back up
+        self.assertEqual(host.limit, 2)
+
+    def test_throttled_gives_up(self):
+        httpretty.register_uri(httpretty.GET, 'http://example.edu/busy',
+                               status=503, adding_headers={'Retry-After': '0'})
+        downloader = md5s3stash.Downloader(retries=1)
+        with self.assertRaises(HTTPError) as raised:
+            downloader.open('http://example.edu/busy')
+        self.assertEqual(raised.exception.code, 503)
+        self.assertEqual(len(httpretty.latest_requests()), 2)
+        self.assertEqual(downloader.scheduler.hosts['example.edu'].active, 0)
+
+
+class HostSchedulerTestCase(unittest.TestCase):
+    def test_additive_increase(self):
+        scheduler = md5s3stash.HostScheduler(max_concurrency=4)
+        for n in range(20):
+            scheduler.acquire('example.edu')
+            scheduler.finish('example.edu', 0.1, 200)
+        self.assertEqual(scheduler.hosts['example.edu'].limit, 4)
+        # slower responses bring it down a step at a time
+        for n in range(5):
+            scheduler.acquire('example.edu')
+            scheduler.finish('example.edu', 5, 200)
+        self.assertTrue(2 < scheduler.hosts['example.edu'].limit < 3)
+        # errors halve it
+        scheduler.acquire('example.edu')
+        scheduler.finish('example.edu', None, None)
+        self.assertTrue(1 < scheduler.hosts['example.edu'].limit < 1.5)
+
+    def test_concurrency(self):
+        scheduler = md5s3stash.HostScheduler(max_concurrency=4, start=1)
+        scheduler.acquire('example.edu')
+        self.assertEqual(scheduler._admit('example.edu'), None)
+        # other hosts have their own limit
+        self.assertEqual(scheduler._admit('example.org'), 0)
+        started = []
+        thread = md5s3stash.threading.Thread(
+            target=lambda: started.append(scheduler.acquire('example.edu')))
+        thread.start()
+        thread.join(0.1)
+        self.assertEqual(started, [])
+        scheduler.finish('example.edu', 0.1, 200)
+        thread.join(1)
+        self.assertEqual(started, [None])
+
+    def test_rate(self):
+        scheduler = md5s3stash.HostScheduler(rate=10)
+        self.assertEqual(scheduler._admit('example.edu'), 0)
+        self.assertTrue(0 < scheduler._admit('example.edu') <= 0.1)
+        start = time.time()
+        scheduler.acquire('example.edu')
+        self.assertTrue(time.time() - start > 0.05)
+
+    def test_back_off(self):
+        scheduler = md5s3stash.HostScheduler()
+        self.assertEqual(scheduler.back_off('example.edu', 3), 8)
+        self.assertTrue(7 < scheduler._admit('example.edu') <= 8)
+        self.assertEqual(scheduler.back_off('example.edu', 0, 1000),
+                         md5s3stash.BACKOFF_MAX)
+        self.assertEqual(scheduler.hosts['example.edu'].limit, 1)
+
+    def test_retry_after(self):
+        self.assertEqual(md5s3stash.retry_after({'Retry-After': '120'}), 120)
+        self.assertEqual(md5s3stash.retry_after({}), None)
+        later = format_date_time(time.time() + 60)
+        self.assertTrue(
+            55 < md5s3stash.retry_after({'Retry-After': later}) <= 60)
+        self.assertEqual(md5s3stash.retry_after(
+            {'Retry-After': format_date_time(0)}), 0)
+
+
+class FixtureHandler(tornado.web.RequestHandler):
+    def get(self, name):
+        if name == 'moved':
+            self.redirect('/fixtures/1x1.png')
+            return
+        with open(os.path.join(DIR_FIXTURES, name), 'rb') as f:
+            self.set_header('Content-Type', 'image/png')
+            self.set_header('ETag', '"fixture"')
+            if self.check_etag_header():
+                self.set_status(304)
+                return
+            self.write(f.read())
+
+
+class TornHandler(tornado.web.RequestHandler):
+    @tornado.gen.coroutine
+    def get(self):
+        # promise more than is sent, then hang up
+        self.set_header('Content-Length', 100000)
+        self.write('x' * 1000)
+        yield self.flush()
+        self.request.connection.close()
+
+
+class AsyncStashTestCase(tornado.testing.AsyncHTTPTestCase):
+    def get_app(self):
+        return tornado.web.Application([(r'/fixtures/(.*)', FixtureHandler),
+                                        (r'/torn', TornHandler)])
+
+    @tornado.testing.gen_test
+    def test_async_check_chunks(self):
+        cache = {}
+        url = self.get_url('/fixtures/moved')
+        (temp_file, md5, mime_type) = yield md5s3stash.async_check_chunks(
+            url, cache=cache, spool_size=1024)
+        self.assertEqual(md5, '71a50dbba44c78128b221b7df7bb51f1')
+        self.assertEqual(mime_type, 'image/png')
+        self.assertEqual(len(temp_file.read()), 95)
+        self.assertEqual(cache[url]['If-None-Match'], '"fixture"')
+
+    @tornado.testing.gen_test
+    def test_async_check_chunks_torn(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        with patch('tempfile.tempdir', tempdir):
+            with capture(lambda: None):
+                result = yield md5s3stash.async_check_chunks(
+                    self.get_url('/torn'), cache={})
+        self.assertFalse(result)
+        # the part that did arrive is not left behind
+        self.assertEqual(os.listdir(tempdir), [])
+
+    @tornado.testing.gen_test
+    def test_async_check_chunks_error(self):
+        with capture(lambda: None):
+            result = yield md5s3stash.async_check_chunks(
+                self.get_url('/fixtures/missing'), cache={})
+        self.assertFalse(result)
+
+    @patch('md5s3stash.s3move')
+    @tornado.testing.gen_test
+    def test_async_stash_many(self, mock_s3move):
+        reports = []
+        urls = [self.get_url('/fixtures/1x1.png'),
+                os.path.join(DIR_FIXTURES, '1x1.png'),
+                self.get_url('/fixtures/missing')]
+        with capture(lambda: None):
+            results = yield md5s3stash.async_stash_many(
+                urls, 'fake-bucket', concurrency=2, per_host=1,
+                on_report=reports.append, conn='FAKE CONN',
+                url_cache={}, hash_cache={})
+        self.assertEqual(results, reports)
+        errors = [r for r in results if isinstance(r, md5s3stash.StashError)]
+        self.assertEqual([e.url for e in errors], urls[2:])
+        for report in results:
+            if report not in errors:
+                self.assertEqual(report.md5,
+                                 '71a50dbba44c78128b221b7df7bb51f1')
+                self.assertEqual(report.dimensions, (1, 1))
+        self.assertEqual(mock_s3move.call_count, 1)
+
+    @patch('md5s3stash.s3move')
+    @tornado.testing.gen_test
+    def test_async_stash_not_modified(self, mock_s3move):
+        url = self.get_url('/fixtures/1x1.png')
+        url_cache = {}
+        report = yield md5s3stash.async_stash(
+            url, 'fake-bucket', conn='FAKE CONN', url_cache=url_cache,
+            hash_cache={})
+        # the server answers 304 to the ETag; the url cache has the rest
+        again = yield md5s3stash.async_stash(
+            url, 'fake-bucket', conn='FAKE CONN', url_cache=url_cache,
+            hash_cache={})
+        self.assertEqual(again, report)
+        self.assertEqual(again.dimensions, (1, 1))
+        self.assertEqual(mock_s3move.call_count, 1)
+
+
 class CacheTestCase(unittest.TestCase):
     def setUp(self):
         super(CacheTestCase, self).setUp()
@@ -192,6 +481,9 @@ class CacheTestCase(unittest.TestCase):
         "Mock urllib2.urlopen"
         self.patcher = patch('urllib2.urlopen')
         self.urlopen_mock = self.patcher.start()
+        # test_url_cache turns httpretty on; don't leave it on for others
+        self.addCleanup(httpretty.disable)
+        self.addCleanup(httpretty.reset)
 
 
     @patch('md5s3stash.urlopen_with_auth')
@@ -225,6 +517,18 @@ class CacheTestCase(unittest.TestCase):
         )
         mock_urlopen.reset_mock()
 
+    def test_hash_cache_removes_download(self):
+        temp = tempfile.NamedTemporaryFile(delete=False)
+        temp.write('test resp')
+        temp.close()
+        report = md5s3stash.stash_download(
+            'http://example.edu/',
+            (temp.name, '85b5a0deaa11f3a5d1762c55701c03da', 'text/html'),
+            md5s3stash.ChunkProbe(), 'fake-bucket',
+            hash_cache=self.hash_cache)
+        self.assertEqual(report.s3_url, 's3_url')
+        self.assertFalse(os.path.exists(temp.name))
+
     @patch('md5s3stash.s3move')
     def test_url_cache(
         self,
@@ -252,6 +556,82 @@ class CacheTestCase(unittest.TestCase):
         #mock_urlopen.return_value = FakeReq('test resp', 304)
 
 
+class RevalidateTestCase(unittest.TestCase):
+    md5 = '85b5a0deaa11f3a5d1762c55701c03da'
+
+    def setUp(self):
+        super(RevalidateTestCase, self).setUp()
+        self.url_cache = {'http://example.edu/': {
+            'md5': self.md5, 'If-None-Match': 'nice etag',
+            'mime_type': 'image/png', 'dimensions': (1, 1)}}
+
+    @patch('md5s3stash.ChunkProbe.info')
+    @patch('md5s3stash.download_file')
+    @patch('md5s3stash.urlopen_with_auth')
+    @patch('md5s3stash.s3move')
+    def test_not_modified(self, mock_s3move, mock_urlopen, mock_file,
+                          mock_info):
+        mock_urlopen.return_value = FakeReq('', code=304)
+        report = md5s3stash.md5s3stash('http://example.edu/', 'fake-bucket',
+                                       conn='FAKE CONN',
+                                       url_cache=self.url_cache,
+                                       hash_cache={})
+        self.assertEqual(report, (
+            'http://example.edu/', self.md5,
+            's3://fake-bucket/{0}'.format(self.md5), 'image/png', (1, 1)))
+        # no temp file, s3 or probe
+        self.assertFalse(mock_file.called)
+        self.assertFalse(mock_s3move.called)
+        self.assertFalse(mock_info.called)
+
+    @patch('md5s3stash.urlopen_with_auth')
+    @patch('md5s3stash.s3move')
+    def test_forgotten(self, mock_s3move, mock_urlopen):
+        del self.url_cache['http://example.edu/']['mime_type']
+        mock_urlopen.side_effect = [FakeReq('', code=304),
+                                    FakeReq('test resp')]
+        report = md5s3stash.md5s3stash('http://example.edu/', 'fake-bucket',
+                                       conn='FAKE CONN',
+                                       url_cache=self.url_cache,
+                                       hash_cache={})
+        # nothing knew what it was, so it was downloaded again in full
+        self.assertEqual(mock_urlopen.call_count, 2)
+        self.assertEqual(mock_s3move.call_count, 1)
+        self.assertEqual(report.md5, self.md5)
+        self.assertEqual(
+            self.url_cache['http://example.edu/']['mime_type'],
+            report.mime_type)
+
+    def test_needs_cache(self):
+        with patch('sys.argv', ['md5s3stash', '--revalidate_only',
+                                'http://example.edu/']):
+            with patch('sys.stderr', new_callable=StringIO) as stderr:
+                self.assertRaises(SystemExit, md5s3stash.main)
+        self.assertTrue('--revalidate_only needs --cache' in stderr.getvalue())
+
+    def test_revalidate_many(self):
+        httpretty.enable()
+        self.addCleanup(httpretty.disable)
+        self.addCleanup(httpretty.reset)
+        httpretty.register_uri(httpretty.GET, 'http://example.edu/',
+                               status=304)
+        httpretty.register_uri(httpretty.GET, 'http://example.edu/new',
+                               body='new body')
+        self.url_cache['http://example.edu/new'] = {
+            'md5': self.md5, 'If-Modified-Since': 'since'}
+        reports = md5s3stash.revalidate_many(
+            ['http://example.edu/', 'http://example.edu/new',
+             'http://example.edu/unknown'], jobs=2, url_cache=self.url_cache)
+        self.assertEqual(sorted(reports), [
+            ('http://example.edu/', False),
+            ('http://example.edu/new', True),
+            ('http://example.edu/unknown', True),
+        ])
+        # the url the cache has no validators for was not asked
+        self.assertEqual(
+            sorted(r.path for r in httpretty.latest_requests()), ['/', '/new'])
+
+
 @unittest.skipUnless(os.environ.get('LIVE_REDIS_TEST', False),
         'No Redis available for testing purposes')
 class LiveCacheTestCase(unittest.TestCase):
@@ -281,7 +661,8 @@ class LiveCacheTestCase(unittest.TestCase):
                                 url_cache=self.url_cache,
                                 hash_cache=self.hash_cache)
         self.assertEqual(self.url_cache['https://example.com/endinslash/'],
-                {u'If-None-Match': "you're it", u'md5': '85b5a0deaa11f3a5d1762c55701c03da'})
+                {u'If-None-Match': "you're it", u'md5': '85b5a0deaa11f3a5d1762c55701c03da',
+                 u'mime_type': None, u'dimensions': (0, 0)})
         self.assertEqual(self.hash_cache['85b5a0deaa11f3a5d1762c55701c03da'],
                     ('s3://m.fake-bucket/85b5a0deaa11f3a5d1762c55701c03da',
                         None,
@@ -328,6 +709,77 @@ class LiveCacheTestCase(unittest.TestCase):
                 'since test val')
 
 
+class SqliteCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        super(SqliteCacheTestCase, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'cache.sqlite')
+
+    def tearDown(self):
+        super(SqliteCacheTestCase, self).tearDown()
+        shutil.rmtree(self.tempdir)
+
+    def test_dict_interface(self):
+        cache = md5s3stash.SqliteCache(self.path)
+        cache['https://example.edu'] = {'If-None-Match': 'nice etag'}
+        self.assertEqual(cache['https://example.edu'],
+                         {'If-None-Match': 'nice etag'})
+        self.assertEqual(cache.get('nope', 'default'), 'default')
+        self.assertTrue('https://example.edu' in cache)
+        self.assertEqual(len(cache), 1)
+        del cache['https://example.edu']
+        self.assertEqual(len(cache), 0)
+        self.assertRaises(KeyError, cache.__getitem__, 'https://example.edu')
+
+    def test_persistent(self):
+        cache = md5s3stash.SqliteCache(self.path, 'hash_cache')
+        cache['85b5a0deaa11f3a5d1762c55701c03da'] = ('s3_url', None, (0, 0))
+        other = md5s3stash.SqliteCache(self.path, 'url_cache')
+        self.assertEqual(len(other), 0)
+        again = md5s3stash.SqliteCache(self.path, 'hash_cache')
+        self.assertEqual(again['85b5a0deaa11f3a5d1762c55701c03da'],
+                         ('s3_url', None, (0, 0)))
+
+    def test_lru(self):
+        cache = md5s3stash.SqliteCache(self.path, max_entries=2)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache['a']
+        cache['c'] = 3
+        self.assertEqual(sorted(cache), ['a', 'c'])
+
+    def test_batches(self):
+        cache = md5s3stash.SqliteCache(self.path, max_entries=10)
+        for n in range(10):
+            cache[str(n)] = n
+        cache['0']
+        # the read is only noted so far
+        self.assertEqual(cache._one('SELECT used FROM "{0}" WHERE key=?', '0'),
+                         1)
+        cache.flush()
+        self.assertEqual(cache._one('SELECT used FROM "{0}" WHERE key=?', '0'),
+                         11)
+        # one past full drops a tenth, least recently used first
+        cache['10'] = 10
+        self.assertEqual(len(cache), 9)
+        self.assertEqual(cache.count, 9)
+        self.assertEqual(sorted(cache, key=int),
+                         ['0', '3', '4', '5', '6', '7', '8', '9', '10'])
+
+    @patch('md5s3stash.s3move')
+    def test_stash_with_cache(self, mock_s3move):
+        url_cache = md5s3stash.SqliteCache(self.path, 'url_cache')
+        hash_cache = md5s3stash.SqliteCache(self.path, 'hash_cache')
+        testfilepath = os.path.join(DIR_FIXTURES, '1x1.png')
+        report = md5s3stash.md5s3stash(testfilepath, 'fake-bucket',
+                                       conn='FAKE CONN',
+                                       url_cache=url_cache,
+                                       hash_cache=hash_cache)
+        self.assertEqual(url_cache[testfilepath]['md5'], report.md5)
+        self.assertEqual(hash_cache[report.md5],
+                         (report.s3_url, 'image/png', (1, 1)))
+
+
 class Md5toURLTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -389,9 +841,12 @@ class md5s3stash_TestCase(unittest.TestCase):
         report = md5s3stash.md5s3stash(self.testfilepath, 'fake-bucket',
                                 conn='FAKE CONN',
                                 url_auth=('username', 'password'))
+        # the url cache also keeps what was reported, for a later 304
         tdict = {
-            self.testfilepath : {u'If-None-Match': "you're it", u'md5': '85b5a0deaa11f3a5d1762c55701c03da'},
-            'https://example.com/endinslash/': {u'If-None-Match': "you're it", u'md5': '85b5a0deaa11f3a5d1762c55701c03da'}, }
+            self.testfilepath : {u'If-None-Match': "you're it", u'md5': '85b5a0deaa11f3a5d1762c55701c03da',
+                                 u'mime_type': None, u'dimensions': (0, 0)},
+            'https://example.com/endinslash/': {u'If-None-Match': "you're it", u'md5': '85b5a0deaa11f3a5d1762c55701c03da',
+                                                u'mime_type': None, u'dimensions': (0, 0)}, }
 
         mock_urlopen.assert_called_once_with(
           os.path.join(DIR_FIXTURES, '1x1.png'),
@@ -418,6 +873,555 @@ class md5s3stash_TestCase(unittest.TestCase):
                                 url_auth=('username', 'password'))
 
 
+class TimingsTestCase(unittest.TestCase):
+    @patch('md5s3stash.urlopen_with_auth')
+    def test_timings(self, mock_urlopen):
+        mock_urlopen.side_effect = lambda *args, **kwargs: FakeReq('test resp')
+        conn = MagicMock()
+        conn.get_bucket.return_value.get_key.return_value = None
+        metrics = md5s3stash.Metrics('md5s3stash')
+        with patch('md5s3stash.metrics', metrics):
+            report = md5s3stash.md5s3stash(
+                'http://example.edu/', 'fake-bucket', conn=conn,
+                url_cache={}, hash_cache={}, timings=True)
+            plain = md5s3stash.md5s3stash(
+                'http://example.edu/', 'fake-bucket', conn=conn,
+                url_cache={}, hash_cache={'85b5a0deaa11f3a5d1762c55701c03da':
+                                          ('s3_url', None, (0, 0))})
+        self.assertEqual(plain.timings, None)
+        self.assertEqual(
+            sorted(report.timings['seconds']),
+            ['download', 'hash', 'probe', 's3_head', 's3_put', 'write'])
+        self.assertEqual(report.timings['bytes'], {
+            'download': 9, 'hash': 9, 'write': 9, 's3_put': 9})
+        self.assertEqual(report.timings['events'],
+                         {'hash_cache_misses': 1, 'stashes': 1})
+        row = md5s3stash.report_row(report).split('\t')
+        self.assertEqual(json.loads(row[4]), {'timings': report.timings})
+        self.assertEqual(metrics.counters[('stashes_total', ())], 1)
+        self.assertEqual(metrics.counters[('hash_cache_hits_total', ())], 1)
+        self.assertEqual(metrics.counters[
+            ('stage_bytes_total', (('stage', 'download'),))], 18)
+
+
+class DigestsTestCase(unittest.TestCase):
+    data = 'abcdefghij' * 1000
+    sha256 = hashlib.sha256(data).hexdigest()
+
+    def test_hasher(self):
+        for size in [len(self.data), 7, 4096]:
+            hasher = md5s3stash.Hasher(['sha256', 'sha1'], queue_size=2)
+            for start in range(0, len(self.data), size):
+                hasher.update(self.data[start:start + size])
+            self.assertEqual(hasher.hexdigests(), {
+                'md5': hashlib.md5(self.data).hexdigest(),
+                'sha1': hashlib.sha1(self.data).hexdigest(),
+                'sha256': self.sha256,
+            })
+            self.assertEqual(hasher.size, len(self.data))
+        # the same, hashed as the chunks come
+        hasher = md5s3stash.Hasher(['sha256'], threaded=False)
+        for start in range(0, len(self.data), 7):
+            hasher.update(self.data[start:start + 7])
+        self.assertEqual(hasher.threads, None)
+        self.assertEqual(hasher.hexdigests()['sha256'], self.sha256)
+        # nothing to hash
+        self.assertEqual(md5s3stash.Hasher().hexdigests(),
+                         {'md5': hashlib.md5('').hexdigest()})
+
+    @patch('md5s3stash.urlopen_with_auth')
+    def test_check_chunks(self, mock_urlopen):
+        mock_urlopen.return_value = FakeReq(self.data)
+        cache = {}
+        digests = {'sha256': None}
+        (path, md5, mime_type) = md5s3stash.checkChunks(
+            'http://example.edu/', cache=cache, read_size=1000,
+            digests=digests)
+        self.addCleanup(os.remove, path)
+        self.assertEqual(md5, hashlib.md5(self.data).hexdigest())
+        self.assertEqual(digests, {'sha256': self.sha256})
+        self.assertEqual(cache['http://example.edu/']['sha256'], self.sha256)
+        with open(path) as f:
+            self.assertEqual(f.read(), self.data)
+        # the url cache answers for a 304
+        mock_urlopen.return_value = FakeReq('', code=304)
+        digests = {'sha256': None}
+        md5s3stash.checkChunks('http://example.edu/', cache=cache,
+                               digests=digests)
+        self.assertEqual(digests, {'sha256': self.sha256})
+
+    @patch('md5s3stash.urlopen_with_auth')
+    def test_report(self, mock_urlopen):
+        mock_urlopen.side_effect = lambda *args, **kwargs: FakeReq(self.data)
+        conn = MagicMock()
+        conn.get_bucket.return_value.get_key.return_value = None
+        hash_cache = {}
+        report = md5s3stash.md5s3stash(
+            'http://example.edu/', 'fake-bucket', conn=conn, url_cache={},
+            hash_cache=hash_cache, digests=['sha256'])
+        self.assertEqual(report.digests, {'sha256': self.sha256})
+        self.assertEqual(hash_cache[report.md5][3], {'sha256': self.sha256})
+        row = md5s3stash.report_row(report).split('\t')
+        self.assertEqual(json.loads(row[4]),
+                         {'digests': {'sha256': self.sha256}})
+        # the hash cache answers too
+        again = md5s3stash.md5s3stash(
+            'http://example.edu/', 'fake-bucket', conn=conn, url_cache={},
+            hash_cache=hash_cache)
+        self.assertEqual(again, report)
+        self.assertEqual(again.digests, None)
+
+
+class MetricsTestCase(unittest.TestCase):
+    def test_export(self):
+        metrics = md5s3stash.Metrics('test')
+        metrics.add('stashes_total')
+        metrics.add('stashes_total', 2)
+        metrics.add('stage_seconds_total', 0.5, stage='download')
+        metrics.set('cache_bytes', 10)
+        self.assertEqual(metrics.prometheus(), '\n'.join([
+            '# TYPE test_cache_bytes gauge',
+            'test_cache_bytes 10',
+            '# TYPE test_stage_seconds_total counter',
+            'test_stage_seconds_total{stage="download"} 0.5',
+            '# TYPE test_stashes_total counter',
+            'test_stashes_total 3',
+        ]) + '\n')
+        self.assertEqual(metrics.statsd(), '\n'.join([
+            'test.stage_seconds_total.download:0.5|c',
+            'test.stashes_total:3|c',
+            'test.cache_bytes:10|g',
+        ]) + '\n')
+        # counters go out as the change since last time
+        metrics.add('stashes_total')
+        self.assertEqual(metrics.statsd(),
+                         'test.stashes_total:1|c\ntest.cache_bytes:10|g\n')
+
+
+class StashManyTestCase(unittest.TestCase):
+    '''stash_many runs md5s3stash over a pool of threads'''
+
+    @patch('md5s3stash.md5s3stash')
+    def test_stash_many(self, mock_stash):
+        def fake_stash(url, bucket_base, conn=None, **kwargs):
+            if url == 'http://bad/':
+                raise IOError('could not download {0}'.format(url))
+            return md5s3stash.StashReport(url, 'md5', 's3_url', None, (0, 0))
+        mock_stash.side_effect = fake_stash
+        urls = ['http://example.edu/{0}'.format(n) for n in range(10)]
+        results = list(md5s3stash.stash_many(
+            urls + ['http://bad/'], 'fake-bucket', jobs=3, conn='FAKE CONN'))
+        self.assertEqual(len(results), 11)
+        errors = [r for r in results if isinstance(r, md5s3stash.StashError)]
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0].url, 'http://bad/')
+        self.assertEqual(
+            sorted(r.url for r in results if r not in errors), sorted(urls))
+        for call in mock_stash.call_args_list:
+            self.assertEqual(call[1]['conn'], 'FAKE CONN')
+
+
+class MultipartUploadTestCase(unittest.TestCase):
+    def setUp(self):
+        super(MultipartUploadTestCase, self).setUp()
+        self.testfilepath = os.path.join(DIR_FIXTURES, '1x1.png')
+        self.bucket = MagicMock()
+        self.mp = self.bucket.initiate_multipart_upload.return_value
+        self.sent = {}
+        self.failures = set([2])
+
+        def upload_part(fp, part_num, size=None):
+            if part_num in self.failures:
+                self.failures.remove(part_num)
+                raise IOError('connection reset')
+            self.sent[part_num] = fp.read(size)
+        self.mp.upload_part_from_file.side_effect = upload_part
+
+    @patch('md5s3stash.time.sleep')
+    def test_multipart_upload(self, mock_sleep):
+        md5s3stash.multipart_upload(self.bucket, '/md5', self.testfilepath,
+                                    'image/png', part_size=40, jobs=2)
+        self.bucket.initiate_multipart_upload.assert_called_once_with(
+            '/md5', metadata={'Content-Type': 'image/png'})
+        with open(self.testfilepath, 'rb') as f:
+            data = f.read()
+        self.assertEqual(sorted(self.sent), [1, 2, 3])
+        self.assertEqual(b''.join(self.sent[n] for n in (1, 2, 3)), data)
+        # part 2 failed once and was retried on its own
+        self.assertEqual(self.mp.upload_part_from_file.call_count, 4)
+        self.mp.complete_upload.assert_called_once_with()
+
+    @patch('md5s3stash.time.sleep')
+    def test_multipart_upload_gives_up(self, mock_sleep):
+        self.mp.upload_part_from_file.side_effect = IOError('down')
+        self.assertRaises(IOError, md5s3stash.multipart_upload, self.bucket,
+                          '/md5', self.testfilepath, 'image/png',
+                          part_size=40, retries=1)
+        self.mp.cancel_upload.assert_called_once_with()
+        self.assertFalse(self.mp.complete_upload.called)
+
+
+class StashedTestCase(unittest.TestCase):
+    '''files already known to be in s3 are not sent again'''
+    def setUp(self):
+        super(StashedTestCase, self).setUp()
+        self.testfilepath = os.path.join(DIR_FIXTURES, '1x1.png')
+
+    @patch('md5s3stash.s3move')
+    def test_stashed(self, mock_s3move):
+        report = md5s3stash.md5s3stash(
+            self.testfilepath, 'fake-bucket', conn='FAKE CONN',
+            url_cache={}, hash_cache={},
+            stashed=set(['71a50dbba44c78128b221b7df7bb51f1']))
+        self.assertFalse(mock_s3move.called)
+        self.assertEqual(report.md5, '71a50dbba44c78128b221b7df7bb51f1')
+        self.assertEqual(report.mime_type, 'image/png')
+        self.assertEqual(report.dimensions, (1, 1))
+
+    @patch('md5s3stash.s3move')
+    def test_not_stashed(self, mock_s3move):
+        md5s3stash.md5s3stash(
+            self.testfilepath, 'fake-bucket', conn='FAKE CONN',
+            url_cache={}, hash_cache={}, stashed=set())
+        self.assertTrue(mock_s3move.called)
+
+    def test_list_stashed(self):
+        conn = MagicMock()
+        key = namedtuple('Key', 'name')
+        conn.get_bucket.return_value.list.return_value = [
+            key('/path/d68e763c825dc0e388929ae1b375ce18'),
+            key('/path/not-an-md5'),
+        ]
+        self.assertEqual(
+            md5s3stash.list_stashed('test/path', conn, 'simple'),
+            set(['d68e763c825dc0e388929ae1b375ce18']))
+        conn.get_bucket.assert_called_once_with('test', validate=False)
+        conn.get_bucket.return_value.list.assert_called_once_with(
+            prefix='/path/')
+
+    def test_stash_locations(self):
+        locations = md5s3stash.stash_locations('test', 'multibucket')
+        self.assertEqual(len(locations), 36)
+        self.assertEqual(locations[1], ('1.test', '/'))
+
+
+class ManifestTestCase(unittest.TestCase):
+    def setUp(self):
+        super(ManifestTestCase, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.manifest = os.path.join(self.tempdir, 'manifest')
+        self.journal = os.path.join(self.tempdir, 'manifest.journal')
+        with open(self.manifest, 'w') as f:
+            f.write('# harvest\n'
+                    'http://example.edu/1\tsome\tother\tcolumns\n'
+                    '\n'
+                    '{"url": "http://example.edu/2", "title": "two"}\n'
+                    'http://example.edu/3\n'
+                    'http://example.edu/bad\n')
+
+    def tearDown(self):
+        super(ManifestTestCase, self).tearDown()
+        shutil.rmtree(self.tempdir)
+
+    def test_read_manifest(self):
+        self.assertEqual(
+            list(md5s3stash.read_manifest(self.manifest)),
+            ['http://example.edu/1', 'http://example.edu/2',
+             'http://example.edu/3', 'http://example.edu/bad'])
+
+    @patch('md5s3stash.md5s3stash')
+    def test_resume(self, mock_stash):
+        def fake_stash(url, bucket_base, **kwargs):
+            if url.endswith('bad'):
+                raise IOError('could not download {0}'.format(url))
+            return md5s3stash.StashReport(url, 'md5', 's3_url', None, (0, 0))
+        mock_stash.side_effect = fake_stash
+        # 1 finished before the crash, 2 was being written out
+        with open(self.journal, 'w') as f:
+            f.write('http://example.edu/1\tmd5\ts3_url\tNone\n'
+                    'http://example.edu/2\tmd5')
+        reports = list(md5s3stash.stash_manifest(
+            self.manifest, self.journal, 'fake-bucket', conn='FAKE CONN'))
+        self.assertEqual(
+            sorted(call[0][0] for call in mock_stash.call_args_list),
+            ['http://example.edu/2', 'http://example.edu/3',
+             'http://example.edu/bad'])
+        self.assertEqual(len(reports), 3)
+        self.assertEqual(
+            md5s3stash.read_journal(self.journal),
+            set(['http://example.edu/1', 'http://example.edu/2',
+                 'http://example.edu/3']))
+        # nothing left to do but the one that keeps failing
+        mock_stash.reset_mock()
+        list(md5s3stash.stash_manifest(
+            self.manifest, self.journal, 'fake-bucket', conn='FAKE CONN'))
+        self.assertEqual(
+            [call[0][0] for call in mock_stash.call_args_list],
+            ['http://example.edu/bad'])
+
+    @patch('md5s3stash.md5s3stash')
+    def test_torn_row(self, mock_stash):
+        mock_stash.side_effect = IOError('down for the night')
+        with open(self.journal, 'w') as f:
+            f.write('http://example.edu/1\tmd5\ts3_url\tNone\n'
+                    'http://example.edu/2\t0123')
+        list(md5s3stash.stash_manifest(
+            self.manifest, self.journal, 'fake-bucket', conn='FAKE CONN'))
+        # 2 is still to do after a run that got nothing done
+        self.assertEqual(md5s3stash.read_journal(self.journal),
+                         set(['http://example.edu/1']))
+        with open(self.journal) as f:
+            self.assertEqual(f.read(),
+                             'http://example.edu/1\tmd5\ts3_url\tNone\n')
+
+    def test_drop_torn_line(self):
+        for (text, kept) in [('', ''), ('a\nb\n', 'a\nb\n'),
+                             ('a\nb', 'a\n'), ('torn', ''),
+                             ('a\n' + 'b' * 10000, 'a\n')]:
+            with open(self.journal, 'w') as f:
+                f.write(text)
+            md5s3stash.drop_torn_line(self.journal)
+            with open(self.journal) as f:
+                self.assertEqual(f.read(), kept)
+
+
+class FakeKey(object):
+    def __init__(self, bucket, name, etag, size):
+        self.bucket = bucket
+        self.name = name
+        self.etag = '"{0}"'.format(etag)
+        self.size = size
+        self.content_type = 'image/{0}'.format(bucket.name)
+
+
+class FakeBucket(object):
+    def __init__(self, conn, name):
+        self.conn = conn
+        self.name = name
+        self.keys = {}
+
+    def list(self, prefix='', marker=''):
+        return [FakeKey(self, name, etag, size)
+                for (name, (etag, size)) in sorted(self.keys.items())
+                if name.startswith(prefix) and name > marker]
+
+    def get_key(self, name):
+        self.conn.heads.append(name)
+        return FakeKey(self, name, *self.keys[name])
+
+    def copy_key(self, new_key_name, src_bucket_name, src_key_name):
+        if src_key_name in self.conn.broken:
+            raise IOError('copy failed')
+        self.conn.copies.append(src_key_name)
+        source = self.conn.get_bucket(src_bucket_name)
+        self.keys[new_key_name] = source.keys[src_key_name]
+        return FakeKey(self, new_key_name, *self.keys[new_key_name])
+
+
+class FakeConn(object):
+    def __init__(self):
+        self.buckets = {}
+        self.copies = []
+        self.heads = []
+        self.broken = set()
+
+    def get_bucket(self, name, validate=False):
+        return self.buckets.setdefault(name, FakeBucket(self, name))
+
+
+class MigrateTestCase(unittest.TestCase):
+    def setUp(self):
+        super(MigrateTestCase, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.checkpoint = os.path.join(self.tempdir, 'checkpoint')
+        self.conn = FakeConn()
+        self.md5s = [hashlib.md5(str(n)).hexdigest() for n in range(20)]
+        for md5 in self.md5s:
+            shard = md5s3stash.md5_to_bucket_shard(md5)
+            keys = self.conn.get_bucket('{0}.old'.format(shard)).keys
+            keys['/' + md5] = (md5, 10)
+            keys['/{0}/clip/150x150'.format(md5)] = ('thumb' + md5, 2)
+            keys['/not-an-md5'] = ('etag', 1)
+
+    def tearDown(self):
+        super(MigrateTestCase, self).tearDown()
+        shutil.rmtree(self.tempdir)
+
+    def migrate(self, **kwargs):
+        return list(md5s3stash.migrate(
+            'old', 'new/path', conn=self.conn, jobs=3, list_jobs=4,
+            checkpoint=self.checkpoint, **kwargs))
+
+    def test_shard_prefixes(self):
+        prefixes = [prefix for shard in md5s3stash.BUCKET_SHARDS
+                    for prefix in md5s3stash.shard_prefixes(shard)]
+        self.assertEqual(len(prefixes), 256)
+        self.assertEqual(len(set(prefixes)), 256)
+        self.assertTrue('00' in md5s3stash.shard_prefixes('0'))
+
+    def test_migrate(self):
+        new = self.conn.get_bucket('new').keys
+        (first, second) = self.md5s[:2]
+        # one copied before, one copy that went wrong
+        new['/path/' + first] = (first, 10)
+        new['/path/' + second] = ('garbled', 10)
+        reports = self.migrate()
+        self.assertEqual(len(reports), 40)
+        actions = dict((report.source, report.action) for report in reports)
+        self.assertEqual(
+            actions[md5s3stash.md5_to_s3_url(first, 'old')], 'verified')
+        self.assertEqual(
+            actions[md5s3stash.md5_to_s3_url(second, 'old')], 'copied')
+        self.assertEqual(len(self.conn.copies), 39)
+        self.assertEqual(len(new), 40)
+        self.assertEqual(new['/path/{0}/clip/150x150'.format(first)],
+                         ('thumb' + first, 2))
+        report = [r for r in reports if r.source.endswith(first)][0]
+        self.assertEqual(report.destination,
+                         md5s3stash.md5_to_s3_url(first, 'new/path', 'simple'))
+        # nothing left to do
+        self.conn.copies = []
+        self.assertEqual(self.migrate(), [])
+        self.assertEqual(self.conn.copies, [])
+
+    def test_resume(self):
+        broken = '/' + self.md5s[0]
+        self.conn.broken.add(broken)
+        with patch('md5s3stash.MIGRATE_CHECKPOINT_EVERY', 1):
+            reports = self.migrate()
+        errors = [r for r in reports
+                  if isinstance(r, md5s3stash.StashError)]
+        self.assertEqual(len(errors), 1)
+        shard = '{0}.old'.format(md5s3stash.md5_to_bucket_shard(broken[1:]))
+        places = md5s3stash.read_checkpoint(self.checkpoint)
+        self.assertEqual(len(places), 36)
+        self.assertNotEqual(places[shard], True)
+        self.assertEqual(
+            sorted(name for (name, place) in places.items() if place is True),
+            sorted(name for name in self.conn.buckets
+                   if name not in [shard, 'new']))
+        # only the shard that went wrong is listed again, from before the
+        # key that failed
+        self.conn.broken = set()
+        self.conn.copies = []
+        with patch.object(FakeBucket, 'list', autospec=True,
+                          side_effect=FakeBucket.list.im_func) as listing:
+            reports = self.migrate()
+        self.assertEqual(
+            set(call[0][0].name for call in listing.call_args_list),
+            set([shard, 'new']))
+        self.assertTrue(broken in self.conn.copies)
+        self.assertEqual(md5s3stash.read_checkpoint(self.checkpoint)[shard],
+                         True)
+
+    def test_torn_checkpoint(self):
+        with open(self.checkpoint, 'w') as f:
+            f.write('{"bucket": "0.old", "done": true}\n'
+                    '{"bucket": "1.old", "mar')
+        self.assertEqual(len(self.migrate()), 40)
+        # and again, over what the first restart left
+        self.conn.copies = []
+        self.assertEqual(self.migrate(), [])
+        self.assertEqual(
+            len(md5s3stash.read_checkpoint(self.checkpoint)), 36)
+
+    def test_same_object(self):
+        md5 = self.md5s[0]
+        self.assertTrue(md5s3stash.same_object(('x-2', 10), ('y-3', 10), md5))
+        self.assertTrue(md5s3stash.same_object(('x-2', 10), (md5, 10), md5))
+        self.assertFalse(md5s3stash.same_object(('x-2', 10), ('y', 10), md5))
+        self.assertFalse(md5s3stash.same_object((md5, 10), (md5, 9), md5))
+
+
+class InventoryTestCase(unittest.TestCase):
+    def setUp(self):
+        super(InventoryTestCase, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'inventory')
+        self.conn = FakeConn()
+        self.md5s = [hashlib.md5(str(n)).hexdigest() for n in range(10)]
+        # half way through a migration from multibucket to simple
+        for md5 in self.md5s[:5]:
+            keys = self.conn.get_bucket('stash').keys
+            keys['/' + md5] = (md5, 10)
+            keys['/{0}/clip/150x150'.format(md5)] = ('thumb', 2)
+        for md5 in self.md5s[4:]:
+            shard = md5s3stash.md5_to_bucket_shard(md5)
+            self.conn.get_bucket('{0}.stash'.format(shard)).keys[
+                '/' + md5] = ('x-2', 20)
+
+    def tearDown(self):
+        super(InventoryTestCase, self).tearDown()
+        shutil.rmtree(self.tempdir)
+
+    def test_build(self):
+        inventory = md5s3stash.build_inventory(
+            self.path, 'stash', conn=self.conn, jobs=4)
+        self.assertEqual(len(inventory), 5)
+        self.assertEqual(inventory.get(self.md5s[0]),
+                         (self.md5s[0], 10, self.md5s[0], None))
+        self.assertTrue(self.md5s[4] in inventory)
+        self.assertFalse(self.md5s[5] in inventory)
+        self.assertEqual(self.conn.heads, [])
+
+    def test_both_layouts(self):
+        # an older inventory is replaced
+        md5s3stash.Inventory.create(self.path, 'stash').add([
+            md5s3stash.InventoryEntry(
+                'd68e763c825dc0e388929ae1b375ce18', 1, 'etag', None)])
+        inventory = md5s3stash.build_inventory(
+            self.path, 'stash', ['simple', 'multibucket'], conn=self.conn,
+            content_types=True)
+        self.assertEqual(len(inventory), 10)
+        self.assertEqual(inventory.get(self.md5s[0]).mime_type,
+                         'image/stash')
+        self.assertEqual(len(self.conn.heads), 11)
+        self.assertFalse(os.path.exists(self.path + '.building'))
+        # each layout only counts what was listed in it
+        simple = md5s3stash.Inventory(self.path, 'stash', 'simple')
+        self.assertEqual(len(simple), 5)
+        self.assertTrue(self.md5s[4] in simple)
+        self.assertFalse(self.md5s[5] in simple)
+        multibucket = md5s3stash.Inventory(self.path, 'stash', 'multibucket')
+        self.assertEqual(multibucket.get(self.md5s[4]).etag, 'x-2')
+        self.assertFalse(self.md5s[0] in multibucket)
+
+    def test_multibucket(self):
+        md5s3stash.build_inventory(
+            self.path, 'stash', ['multibucket'], conn=self.conn)
+        inventory = md5s3stash.Inventory(self.path)
+        self.assertEqual(len(inventory), 6)
+        self.assertEqual(inventory.get(self.md5s[9]).etag, 'x-2')
+        self.assertEqual(inventory.get(self.md5s[0]), None)
+
+    def test_missing(self):
+        # a typo is not an empty inventory
+        self.assertRaises(IOError, md5s3stash.Inventory, self.path)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_other_location(self):
+        md5s3stash.build_inventory(self.path, 'stash', conn=self.conn)
+        self.assertRaises(ValueError, md5s3stash.Inventory, self.path,
+                          'other')
+        self.assertRaises(ValueError, md5s3stash.Inventory, self.path,
+                          'stash', 'multibucket')
+        with patch('sys.argv', ['md5s3stash', '-b', 'other', '--inventory',
+                                self.path, 'http://example.edu/']):
+            with patch('sys.stderr', new_callable=StringIO) as stderr:
+                self.assertRaises(SystemExit, md5s3stash.main)
+        self.assertTrue('lists stash, not other' in stderr.getvalue())
+
+    @patch('md5s3stash.s3move')
+    def test_stashed(self, mock_s3move):
+        inventory = md5s3stash.Inventory.create(self.path, 'fake-bucket')
+        inventory.add([md5s3stash.InventoryEntry(
+            '71a50dbba44c78128b221b7df7bb51f1', 95, 'etag', 'image/png')])
+        md5s3stash.md5s3stash(
+            os.path.join(DIR_FIXTURES, '1x1.png'), 'fake-bucket',
+            conn='FAKE CONN', url_cache={}, hash_cache={}, stashed=inventory)
+        self.assertFalse(mock_s3move.called)
+
+
 class TestIsS3URL(unittest.TestCase):
     def test_is_s3_url(self):
         self.assertTrue(md5s3stash.is_s3_url('https://s3.amazonaws.com/adlkfj'))
@@ -442,5 +1446,698 @@ class ImageInfoTestCase(unittest.TestCase):
         self.assertRaises(IOError, md5s3stash.image_info, '')
 
 
+class ImageProbeTestCase(unittest.TestCase):
+    def setUp(self):
+        super(ImageProbeTestCase, self).setUp()
+        self.testfilepath = os.path.join(DIR_FIXTURES, '1x1.png')
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+
+    def test_info(self):
+        probe = md5s3stash.ImageProbe()
+        self.assertEqual(probe.info(self.testfilepath), ('image/png', (1, 1)))
+        with open(self.testfilepath, 'rb') as f:
+            self.assertEqual(probe.info(f), ('image/png', (1, 1)))
+            self.assertEqual(f.tell(), 0)
+        self.assertEqual(probe.info(os.path.join(DIR_FIXTURES, 'empty')),
+                         (None, (0, 0)))
+
+    def test_magic_per_thread(self):
+        probe = md5s3stash.ImageProbe()
+        with patch('magic.Magic', wraps=md5s3stash.magic.Magic) as made:
+            for n in range(3):
+                probe.info(self.testfilepath)
+            self.assertEqual(made.call_count, 1)
+            threads = [
+                md5s3stash.threading.Thread(
+                    target=probe.info, args=(self.testfilepath,))
+                for n in range(2)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(made.call_count, 3)
+
+    def test_big_header(self):
+        '''the file is opened again when the image header does not fit'''
+        path = os.path.join(self.tempdir, 'big.jpg')
+        md5s3stash.Image.new('RGB', (40, 30)).save(
+            path, 'JPEG', exif=b'Exif\x00\x00' + b'\x00' * 4096)
+        probe = md5s3stash.ImageProbe(header_size=1024)
+        self.assertEqual(probe.info(path), ('image/jpeg', (40, 30)))
+        with open(os.path.join(self.tempdir, 'text'), 'w') as f:
+            f.write('not an image ' * 1000)
+        self.assertEqual(probe.info(f.name), (None, (0, 0)))
+
+
+class SpoolTestCase(unittest.TestCase):
+    '''files under spool_size never get a temp file'''
+    def setUp(self):
+        super(SpoolTestCase, self).setUp()
+        self.testfilepath = os.path.join(DIR_FIXTURES, '1x1.png')
+
+    def test_checkChunks_spooled(self):
+        (temp_file, md5, mime_type) = md5s3stash.checkChunks(
+            self.testfilepath, cache={}, spool_size=1024)
+        self.assertFalse(temp_file._rolled)
+        self.assertEqual(md5, '71a50dbba44c78128b221b7df7bb51f1')
+        self.assertEqual(len(temp_file.read()), 95)
+        self.assertEqual(md5s3stash.image_info(temp_file),
+                         ('image/png', (1, 1)))
+        temp_file.close()
+
+    def test_checkChunks_spills(self):
+        (temp_file, md5, mime_type) = md5s3stash.checkChunks(
+            self.testfilepath, cache={}, spool_size=10)
+        self.assertTrue(temp_file._rolled)
+        self.assertEqual(len(temp_file.read()), 95)
+        temp_file.close()
+
+    @patch('md5s3stash.s3move')
+    def test_md5s3stash_spooled(self, mock_s3move):
+        report = md5s3stash.md5s3stash(self.testfilepath, 'fake-bucket',
+                                       conn='FAKE CONN', url_cache={},
+                                       hash_cache={}, spool_size=1024)
+        place1 = mock_s3move.call_args[0][0]
+        self.assertTrue(hasattr(place1, 'read'))
+        self.assertTrue(place1.closed)
+        self.assertEqual(report.dimensions, (1, 1))
+
+    def test_s3move_file_object(self):
+        conn = MagicMock()
+        bucket = conn.get_bucket.return_value
+        bucket.get_key.return_value = None
+        with open(self.testfilepath, 'rb') as f:
+            data = f.read()
+        md5s3stash.s3move(md5s3stash.io.BytesIO(data), 's3://test/md5',
+                          'image/png', conn)
+        key = bucket.new_key.return_value
+        self.assertTrue(key.set_contents_from_file.called)
+        self.assertFalse(key.set_contents_from_filename.called)
+
+    @patch('md5s3stash.time.sleep')
+    def test_multipart_file_object(self, mock_sleep):
+        bucket = MagicMock()
+        mp = bucket.initiate_multipart_upload.return_value
+        sent = {}
+
+        def upload_part(fp, part_num, size=None):
+            sent[part_num] = fp.read(size)
+        mp.upload_part_from_file.side_effect = upload_part
+        md5s3stash.multipart_upload(
+            bucket, '/md5', md5s3stash.io.BytesIO(b'0123456789' * 5),
+            'text/plain', part_size=20, jobs=3)
+        self.assertEqual(sent, {1: b'0123456789' * 2, 2: b'0123456789' * 2,
+                                3: b'0123456789'})
+
+
+class StashSessionTestCase(unittest.TestCase):
+    def setUp(self):
+        super(StashSessionTestCase, self).setUp()
+        self.conn = MagicMock()
+        self.session = md5s3stash.StashSession(self.conn)
+
+    def test_buckets_remembered(self):
+        bucket = self.session.get_bucket('test', validate=False)
+        self.assertEqual(self.session.get_bucket('test'), bucket)
+        self.conn.get_bucket.assert_called_once_with('test', validate=False)
+
+    def test_warm(self):
+        self.session.warm('test', 'multibucket')
+        self.assertEqual(self.conn.get_bucket.call_count, 36)
+        self.session.get_bucket('z.test')
+        self.assertEqual(self.conn.get_bucket.call_count, 36)
+
+    def test_s3move(self):
+        '''s3move creates a missing bucket through the session'''
+        import boto
+        self.conn.get_bucket.side_effect = boto.exception.S3ResponseError(
+            404, 'Not Found')
+        bucket = self.conn.create_bucket.return_value
+        bucket.get_key.return_value = None
+        testfilepath = os.path.join(DIR_FIXTURES, '1x1.png')
+        for n in range(2):
+            md5s3stash.s3move(testfilepath, 's3://test/md5', 'image/png',
+                              self.session)
+        self.conn.get_bucket.assert_called_once_with('test', validate=False)
+        self.conn.create_bucket.assert_called_once_with('test')
+        self.assertEqual(
+            bucket.new_key.return_value.set_contents_from_filename.call_count,
+            2)
+
+    def test_passthrough(self):
+        self.assertEqual(self.session.host, self.conn.host)
+
+
+class ChunkProbeTestCase(unittest.TestCase):
+    def setUp(self):
+        super(ChunkProbeTestCase, self).setUp()
+        self.testfilepath = os.path.join(DIR_FIXTURES, '1x1.png')
+        with open(self.testfilepath, 'rb') as f:
+            self.data = f.read()
+
+    def feed(self, probe, data, size=16):
+        for i in range(0, len(data), size):
+            probe.feed(data[i:i + size])
+
+    def test_image(self):
+        probe = md5s3stash.ChunkProbe()
+        self.feed(probe, self.data)
+        self.assertEqual(probe.info(self.testfilepath), ('image/png', (1, 1)))
+
+    def test_not_an_image(self):
+        probe = md5s3stash.ChunkProbe()
+        self.feed(probe, b'test resp')
+        self.assertEqual(probe.info(None), (None, (0, 0)))
+
+    def test_header_too_big(self):
+        '''falls back to image_info when the header does not fit'''
+        probe = md5s3stash.ChunkProbe(header_size=10)
+        self.feed(probe, self.data)
+        self.assertTrue(probe.truncated)
+        self.assertEqual(probe.info(self.testfilepath), ('image/png', (1, 1)))
+
+
+class FakeS3Handler(tornado.web.RequestHandler):
+    '''serves 1x1.png for any md5, and the (content type, body) in
+    `objects` for other keys (None for a 404), counting the GETs'''
+    requests = []
+    heads = []
+    objects = {}
+    ignore_range = False
+    fail_after = None
+
+    @tornado.gen.coroutine
+    def get(self, bucket, md5):
+        FakeS3Handler.requests.append(md5)
+        # give concurrent requests a chance to pile up
+        yield tornado.gen.sleep(0.01)
+        if (FakeS3Handler.fail_after is not None and
+                len(FakeS3Handler.requests) > FakeS3Handler.fail_after):
+            raise tornado.web.HTTPError(503)
+        body = self.lookup(md5)
+        byte_range = self.request.headers.get('Range')
+        if byte_range and not FakeS3Handler.ignore_range:
+            (start, end) = byte_range[len('bytes='):].split('-')
+            body = body[int(start):int(end) + 1]
+            self.set_status(206)
+            self.set_header('Content-Length', len(body))
+        self.write(body)
+
+    def head(self, bucket, md5):
+        FakeS3Handler.heads.append(md5)
+        self.lookup(md5)
+
+    def lookup(self, md5):
+        if md5 in FakeS3Handler.objects:
+            if FakeS3Handler.objects[md5] is None:
+                raise tornado.web.HTTPError(404)
+            (content_type, body) = FakeS3Handler.objects[md5]
+        elif '/' in md5:
+            raise tornado.web.HTTPError(404)
+        else:
+            content_type = 'image/png'
+            with open(os.path.join(DIR_FIXTURES, '1x1.png'), 'rb') as f:
+                body = f.read()
+        self.set_header('Content-Type', content_type)
+        self.set_header('ETag', '"{0}"'.format(md5))
+        self.set_header('Content-Length', len(body))
+        return body
+
+
+class ThumbnailServerTestCase(tornado.testing.AsyncHTTPTestCase):
+    '''thumbnail.py against a fake s3 on another port'''
+    md5 = '71a50dbba44c78128b221b7df7bb51f1'
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        sock, port = tornado.testing.bind_unused_port()
+        # before get_app, which may look at them
+        self.environ = patch.dict(os.environ, {
+            'BUCKET_SCHEME': 'simple',
+            'S3_ENDPOINT': '127.0.0.1:{0}'.format(port),
+        })
+        self.environ.start()
+        super(ThumbnailServerTestCase, self).setUp()
+        FakeS3Handler.requests = []
+        FakeS3Handler.heads = []
+        FakeS3Handler.objects = {}
+        FakeS3Handler.ignore_range = False
+        FakeS3Handler.fail_after = None
+        self.s3 = tornado.httpserver.HTTPServer(
+            tornado.web.Application([(r'/([^/]+)/(.*)', FakeS3Handler)]))
+        self.s3.add_sockets([sock])
+
+    def tearDown(self):
+        self.environ.stop()
+        self.s3.stop()
+        super(ThumbnailServerTestCase, self).tearDown()
+        shutil.rmtree(self.tempdir)
+
+
+class OriginalCacheTestCase(ThumbnailServerTestCase):
+    def get_app(self):
+        self.application = thumbnail.ThumbnailApplication(
+            original_cache_dir=os.path.join(self.tempdir, 'originals'),
+            original_cache_size=1, render_cache_size=0)
+        return self.application
+
+    @tornado.testing.gen_test
+    def test_original_cache(self):
+        client = self.http_client
+        url = self.get_url('/clip/1x1/{0}'.format(self.md5))
+        responses = yield [client.fetch(url), client.fetch(url)]
+        response = yield client.fetch(self.get_url(
+            '/fill/1x1/{0}'.format(self.md5)))
+        for resp in responses + [response]:
+            self.assertEqual(resp.code, 200)
+            self.assertEqual(resp.headers['Content-Type'], 'image/png')
+        # the two at once shared a fetch, the third came from disk
+        self.assertEqual(FakeS3Handler.requests, [self.md5])
+        self.assertTrue(os.path.exists(
+            os.path.join(self.tempdir, 'originals', self.md5)))
+
+
+class CoalescingTestCase(ThumbnailServerTestCase):
+    def get_app(self):
+        self.application = thumbnail.ThumbnailApplication(
+            render_cache_size=0)
+        return self.application
+
+    @tornado.testing.gen_test
+    def test_coalescing(self):
+        client = self.http_client
+        url = self.get_url('/clip/1x1/{0}'.format(self.md5))
+        other = self.get_url('/fill/1x1/{0}'.format(self.md5))
+        render = thumbnail.ThumbnailImageHandler.render
+        with patch.object(thumbnail.ThumbnailImageHandler, 'render',
+                          side_effect=render, autospec=True) as rendered:
+            responses = yield [client.fetch(url), client.fetch(url),
+                               client.fetch(url), client.fetch(other)]
+        self.assertEqual([r.code for r in responses], [200] * 4)
+        self.assertEqual(responses[0].body, responses[2].body)
+        # one fetch for the original, one render per variant
+        self.assertEqual(FakeS3Handler.requests, [self.md5])
+        self.assertEqual(rendered.call_count, 2)
+        self.assertFalse(self.application.fetching.running)
+        self.assertFalse(self.application.rendering.running)
+
+    @tornado.testing.gen_test
+    def test_shared_error(self):
+        flight = thumbnail.SingleFlight()
+        calls = []
+
+        @tornado.gen.coroutine
+        def fail():
+            calls.append(1)
+            yield tornado.gen.moment
+            raise ValueError('nope')
+        futures = [flight.run('k', fail), flight.run('k', fail)]
+        for future in futures:
+            with self.assertRaises(ValueError):
+                yield future
+        self.assertEqual(calls, [1])
+        self.assertNotIn('k', flight)
+
+
+class RenderCacheTestCase(ThumbnailServerTestCase):
+    def get_app(self):
+        self.application = thumbnail.ThumbnailApplication(
+            render_cache_size=1)
+        return self.application
+
+    @tornado.testing.gen_test
+    def test_render_cache(self):
+        url = self.get_url('/clip/1x1/{0}'.format(self.md5))
+        first = yield self.http_client.fetch(url)
+        second = yield self.http_client.fetch(url)
+        self.assertEqual(FakeS3Handler.requests, [self.md5])
+        self.assertEqual(first.body, second.body)
+        self.assertEqual(second.headers['Content-Type'], 'image/png')
+        self.assertEqual(first.headers['ETag'], second.headers['ETag'])
+        other = yield self.http_client.fetch(url + '?q=50')
+        self.assertNotEqual(other.headers['ETag'], first.headers['ETag'])
+
+    @tornado.testing.gen_test
+    def test_metrics(self):
+        url = self.get_url('/clip/1x1/{0}'.format(self.md5))
+        yield [self.http_client.fetch(url), self.http_client.fetch(url)]
+        yield self.http_client.fetch(url)
+        resp = yield self.http_client.fetch(self.get_url('/metrics'))
+        lines = resp.body.decode('utf-8').splitlines()
+        for line in ['thumbnail_requests_total{route="thumbnail"} 3',
+                     'thumbnail_render_cache_hits_total 1',
+                     'thumbnail_render_cache_misses_total 2',
+                     'thumbnail_coalesced_total{stage="render"} 1',
+                     'thumbnail_renders_total 1',
+                     'thumbnail_s3_fetches_total 1',
+                     'thumbnail_render_cache_entries 1']:
+            self.assertIn(line, lines)
+        resp = yield self.http_client.fetch(
+            self.get_url('/metrics?format=statsd'))
+        self.assertIn(b'thumbnail.renders_total:1|c', resp.body)
+
+    @tornado.testing.gen_test
+    def test_not_modified(self):
+        url = self.get_url('/clip/1x1/{0}'.format(self.md5))
+        first = yield self.http_client.fetch(url)
+        self.application.render_cache = None
+        FakeS3Handler.requests = []
+        resp = yield self.http_client.fetch(
+            url, headers={'If-None-Match': first.headers['ETag']},
+            raise_error=False)
+        self.assertEqual(resp.code, 304)
+        self.assertEqual(FakeS3Handler.requests, [])
+
+
+class DerivativesTestCase(ThumbnailServerTestCase):
+    def get_app(self):
+        self.application = thumbnail.ThumbnailApplication(
+            render_cache_size=0, derivatives=['clip/1x1'])
+        return self.application
+
+    @tornado.testing.gen_test
+    def test_derivatives(self):
+        stashed = '{0}/clip/1x1'.format(self.md5)
+        FakeS3Handler.objects[stashed] = ('image/jpeg', b'stashed')
+        url = self.get_url('/clip/1x1/{0}'.format(self.md5))
+        resp = yield self.http_client.fetch(url)
+        self.assertEqual(resp.body, b'stashed')
+        self.assertEqual(resp.headers['Content-Type'], 'image/jpeg')
+        self.assertEqual(FakeS3Handler.requests, [stashed])
+        # not stashed: a different size, query options, a missing one
+        other = 'a' * 32
+        for path in ['/fill/1x1/{0}'.format(self.md5),
+                     '/clip/1x1/{0}?q=50'.format(self.md5),
+                     '/clip/1x1/{0}'.format(other)]:
+            resp = yield self.http_client.fetch(self.get_url(path))
+            self.assertEqual(resp.headers['Content-Type'], 'image/png')
+        self.assertEqual(FakeS3Handler.requests, [
+            stashed, self.md5, self.md5, '{0}/clip/1x1'.format(other), other])
+
+
+class OriginalRouteTestCase(ThumbnailServerTestCase):
+    body = b'0123456789' * 1000
+
+    def get_app(self):
+        self.application = thumbnail.ThumbnailApplication(
+            original_cache_dir=os.path.join(self.tempdir, 'originals'))
+        return self.application
+
+    def setUp(self):
+        super(OriginalRouteTestCase, self).setUp()
+        FakeS3Handler.objects[self.md5] = ('audio/wav', self.body)
+        self.pieces = patch('thumbnail.ORIGINAL_PIECE_SIZE', 4096)
+        self.pieces.start()
+        self.addCleanup(self.pieces.stop)
+
+    @tornado.gen.coroutine
+    def fetch(self, byte_range=None, **kwargs):
+        headers = kwargs.pop('headers', {})
+        if byte_range:
+            headers['Range'] = byte_range
+        resp = yield self.http_client.fetch(
+            self.get_url('/original/{0}'.format(self.md5)),
+            headers=headers, raise_error=False, **kwargs)
+        raise tornado.gen.Return(resp)
+
+    @tornado.testing.gen_test
+    def test_original(self):
+        resp = yield self.fetch()
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(resp.body, self.body)
+        self.assertEqual(resp.headers['Content-Type'], 'audio/wav')
+        self.assertEqual(resp.headers['Accept-Ranges'], 'bytes')
+        # sent on a piece at a time
+        self.assertEqual(FakeS3Handler.requests, [self.md5] * 3)
+        resp = yield self.fetch(method='HEAD')
+        self.assertEqual(resp.headers['Content-Length'], '10000')
+        resp = yield self.fetch(
+            headers={'If-None-Match': '"{0}"'.format(self.md5)})
+        self.assertEqual(resp.code, 304)
+        self.assertEqual(FakeS3Handler.requests, [self.md5] * 3)
+
+    @tornado.testing.gen_test
+    def test_range(self):
+        resp = yield self.fetch('bytes=4000-4199')
+        self.assertEqual(resp.code, 206)
+        self.assertEqual(resp.body, self.body[4000:4200])
+        self.assertEqual(resp.headers['Content-Range'], 'bytes 4000-4199/10000')
+        resp = yield self.fetch('bytes=-10')
+        self.assertEqual(resp.body, self.body[-10:])
+        resp = yield self.fetch('bytes=0-')
+        self.assertEqual(resp.code, 200)
+        resp = yield self.fetch('bytes=10000-')
+        self.assertEqual(resp.code, 416)
+        self.assertEqual(resp.headers['Content-Range'], 'bytes */10000')
+
+    @tornado.testing.gen_test
+    def test_from_cache(self):
+        self.application.original_cache.put(self.md5, self.body)
+        resp = yield self.fetch()
+        self.assertEqual(resp.body, self.body)
+        resp = yield self.fetch('bytes=5000-')
+        self.assertEqual(resp.body, self.body[5000:])
+        self.assertEqual(FakeS3Handler.requests, [])
+
+    @tornado.testing.gen_test
+    def test_range_ignored(self):
+        # the whole file in answer to the first piece is not passed on
+        FakeS3Handler.ignore_range = True
+        resp = yield self.fetch('bytes=4000-4199')
+        self.assertEqual(resp.code, 502)
+        self.assertFalse(self.body in resp.body)
+
+    @tornado.testing.gen_test
+    def test_s3_error(self):
+        # after the first piece has gone, all that is left is to hang up
+        FakeS3Handler.fail_after = 1
+        resp = yield self.fetch()
+        self.assertEqual(resp.code, 599)
+        self.assertEqual(FakeS3Handler.requests, [self.md5] * 2)
+        self.assertEqual(
+            self.application.metrics.counters[('original_errors_total', ())],
+            1)
+
+    @tornado.testing.gen_test
+    def test_missing(self):
+        FakeS3Handler.objects[self.md5] = None
+        resp = yield self.fetch()
+        self.assertEqual(resp.code, 404)
+        self.assertEqual(FakeS3Handler.requests, [])
+
+
+class InventoryRouteTestCase(ThumbnailServerTestCase):
+    body = OriginalRouteTestCase.body
+    other = 'd68e763c825dc0e388929ae1b375ce18'
+
+    def setUp(self):
+        super(InventoryRouteTestCase, self).setUp()
+        FakeS3Handler.objects[self.md5] = ('audio/wav', self.body)
+
+    def get_app(self):
+        path = os.path.join(self.tempdir, 'inventory')
+        inventory = md5s3stash.Inventory.create(
+            path, 'test', ['simple', 'multibucket'])
+        inventory.add([md5s3stash.InventoryEntry(
+            self.md5, len(self.body), self.md5, 'audio/x-wav')])
+        inventory.add([md5s3stash.InventoryEntry(
+            self.other, 1, 'stale', 'audio/x-wav')], 'multibucket')
+        self.application = thumbnail.ThumbnailApplication(inventory=path)
+        return self.application
+
+    @tornado.testing.gen_test
+    def test_original(self):
+        resp = yield self.http_client.fetch(
+            self.get_url('/original/{0}'.format(self.md5)),
+            headers={'Range': 'bytes=4000-4199'})
+        self.assertEqual(resp.body, self.body[4000:4200])
+        self.assertEqual(resp.headers['Content-Type'], 'audio/x-wav')
+        self.assertEqual(resp.headers['ETag'], '"{0}"'.format(self.md5))
+        self.assertEqual(FakeS3Handler.heads, [])
+        # only listed in the layout the server does not use
+        resp = yield self.http_client.fetch(
+            self.get_url('/original/{0}'.format(self.other)))
+        self.assertEqual(resp.headers['Content-Type'], 'image/png')
+        self.assertEqual(FakeS3Handler.heads, [self.other])
+
+    def test_other_bucket_base(self):
+        path = os.path.join(self.tempdir, 'other')
+        md5s3stash.Inventory.create(path, 'other')
+        application = thumbnail.ThumbnailApplication(inventory=path)
+        self.assertEqual(application.inventory, None)
+
+
+class RenderPoolTestCase(ThumbnailServerTestCase):
+    def get_app(self):
+        self.application = thumbnail.ThumbnailApplication(
+            render_cache_size=0, render_processes=1, render_backlog=0)
+        return self.application
+
+    def tearDown(self):
+        self.application.render_pool.close()
+        super(RenderPoolTestCase, self).tearDown()
+
+    @tornado.testing.gen_test
+    def test_render_pool(self):
+        resp = yield self.http_client.fetch(
+            self.get_url('/clip/1x1/{0}'.format(self.md5)))
+        with open(os.path.join(DIR_FIXTURES, '1x1.png'), 'rb') as f:
+            (image_format, body) = thumbnail.process_image(
+                f.read(), [('resize', ('1', '1'), {'mode': 'clip'})], {})
+        self.assertEqual(resp.headers['Content-Type'], 'image/png')
+        self.assertEqual(resp.body, body)
+        self.assertEqual(self.application.render_pool.pending, 0)
+        with self.assertRaises(thumbnail.errors.ImageFormatError):
+            yield self.application.render_pool.run(b'not an image', [], {})
+
+    @tornado.testing.gen_test
+    def test_backpressure(self):
+        self.application.render_pool.pending = 1
+        resp = yield self.http_client.fetch(
+            self.get_url('/clip/1x1/{0}'.format(self.md5)), raise_error=False)
+        self.assertEqual(resp.code, 503)
+        self.assertEqual(resp.headers['Retry-After'], '1')
+
+
+class DraftTestCase(unittest.TestCase):
+    def encode(self, sizes, format):
+        pages = [md5s3stash.Image.new(
+            'RGB', size, 'red') for size in sizes]
+        out = StringIO()
+        if len(pages) == 1:
+            pages[0].save(out, format)
+        else:
+            pages[0].save(out, format, save_all=True,
+                          append_images=pages[1:])
+        return out.getvalue()
+
+    def open(self, body):
+        return md5s3stash.pilbox.image.Image(StringIO(body)).img
+
+    def test_jpeg(self):
+        img = self.open(self.encode([(2000, 1500)], 'JPEG'))
+        md5s3stash.draft_image(img, (100, 100))
+        # 1/4 scale, as 1/8 would be less than twice the thumbnail
+        self.assertEqual(img.size, (500, 375))
+
+    def test_tiff(self):
+        sizes = [(2000, 1500), (300, 300), (1000, 750), (500, 375),
+                 (250, 188)]
+        img = self.open(self.encode(sizes, 'TIFF'))
+        md5s3stash.draft_image(img, (100, 100))
+        self.assertEqual(img.tell(), 3)
+        self.assertEqual(img.size, (500, 375))
+        img = self.open(self.encode(sizes, 'TIFF'))
+        md5s3stash.draft_image(img, (1500, 1500))
+        self.assertEqual(img.tell(), 0)
+
+    def test_process_image(self):
+        body = self.encode([(2000, 1500)], 'JPEG')
+        (image_format, thumb) = md5s3stash.process_image(
+            body, [('resize', ('150', '150'), {'mode': 'crop'})], {})
+        self.assertEqual(image_format, 'JPEG')
+        self.assertEqual(self.open(thumb).size, (150, 150))
+
+    def test_render_derivatives(self):
+        body = self.encode([(400, 300)], 'JPEG')
+        rendered = list(md5s3stash.render_derivatives(
+            StringIO(body), ['clip/150x150', 'crop/100x100']))
+        self.assertEqual([r[:2] for r in rendered], [
+            ('clip/150x150', 'image/jpeg'), ('crop/100x100', 'image/jpeg')])
+        self.assertEqual(self.open(rendered[0][2]).size, (150, 112))
+        self.assertEqual(self.open(rendered[1][2]).size, (100, 100))
+
+    def test_render_after_fill(self):
+        out = StringIO()
+        md5s3stash.Image.new('RGBA', (400, 300), (255, 0, 0, 0)).save(
+            out, 'PNG')
+        body = out.getvalue()
+        (after_fill, ) = list(md5s3stash.render_derivatives(
+            StringIO(body), ['fill/100x100', 'clip/150x150']))[1:]
+        (alone, ) = md5s3stash.render_derivatives(
+            StringIO(body), ['clip/150x150'])
+        # the background still goes on, as it would on its own
+        self.assertEqual(after_fill, alone)
+
+    @patch('md5s3stash.s3move')
+    def test_stash_derivatives(self, mock_s3move):
+        conn = MagicMock()
+        conn.get_bucket.return_value.get_key.side_effect = (
+            lambda name: name.endswith('crop/100x100'))
+        path = os.path.join(DIR_FIXTURES, '1x1.png')
+        probe = md5s3stash.ChunkProbe()
+        with open(path, 'rb') as f:
+            probe.feed(f.read())
+        temp = tempfile.NamedTemporaryFile(delete=False)
+        with open(path, 'rb') as f:
+            temp.write(f.read())
+        temp.close()
+        md5s3stash.stash_download(
+            'http://example.edu/1x1.png', (temp.name, 'md5', 'image/png'),
+            probe, 'bucket', conn=conn,
+            derivatives=['clip/150x150', 'crop/100x100'])
+        self.assertEqual(
+            [c[0][1:3] for c in mock_s3move.call_args_list],
+            [('s3://bucket/md5', 'image/png'),
+             ('s3://bucket/md5/clip/150x150', 'image/png')])
+        # one HEAD for each derivative, not another in s3move
+        self.assertEqual(mock_s3move.call_args_list[1][1], {'check': False})
+        self.assertFalse(os.path.exists(temp.name))
+        self.assertEqual(
+            md5s3stash.derivative_list('clip/150x150, FILL/300x300'),
+            ['clip/150x150', 'fill/300x300'])
+        with self.assertRaises(md5s3stash.argparse.ArgumentTypeError):
+            md5s3stash.derivative_list('clip/150')
+
+
+class DiskCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        super(DiskCacheTestCase, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super(DiskCacheTestCase, self).tearDown()
+        shutil.rmtree(self.tempdir)
+
+    def test_spill(self):
+        spill = thumbnail.DiskCache(self.tempdir, 100)
+        cache = thumbnail.RenderCache(6, spill)
+        cache.put('a', ('image/png', b'1234'))
+        cache.put('b', ('image/jpeg', b'5678'))
+        self.assertEqual(list(cache.entries), ['b'])
+        self.assertEqual(cache.get('a'), ('image/png', b'1234'))
+        self.assertEqual(list(cache.entries), ['a'])
+        self.assertEqual(cache.get('b'), ('image/jpeg', b'5678'))
+
+    def test_lru(self):
+        cache = thumbnail.DiskCache(self.tempdir, 10)
+        cache.put('a' * 32, b'1234')
+        cache.put('b' * 32, b'1234')
+        cache.get('a' * 32)
+        cache.put('c' * 32, b'1234')
+        self.assertEqual(cache.get('b' * 32), None)
+        self.assertEqual(cache.get('a' * 32), b'1234')
+        self.assertEqual(sorted(os.listdir(self.tempdir)),
+                         ['a' * 32, 'c' * 32])
+        # a new cache picks up what is on disk
+        again = thumbnail.DiskCache(self.tempdir, 10)
+        self.assertEqual(again.size, 8)
+        self.assertEqual(again.get('c' * 32), b'1234')
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    def test_run(self):
+        results = benchmark.run(benchmark.BENCHMARKS, [4], ['64x48'], 3, [2])
+        self.assertEqual([r['benchmark'] for r in results],
+                         benchmark.BENCHMARKS)
+        for result in results:
+            self.assertEqual(result['count'], 3)
+            self.assertTrue(result['bytes'])
+            self.assertTrue(0 < result['p50_ms'] <= result['p99_ms'])
+        self.assertEqual(benchmark.percentile(range(1, 101), 99), 99)
+
+
 if __name__=='__main__':
     unittest.main()
@@ -3,18 +3,124 @@
 extension to pilbox server http://agschwender.github.io/pilbox/#extension
 """
 import tornado.gen
+import tornado.httpclient
+import tornado.httputil
+import tornado.iostream
+import tornado.options
+import tornado.web
+from tornado.log import app_log
+from tornado.options import define, options
+from pilbox import errors
 from pilbox.app import PilboxApplication, ImageHandler, main
-from md5s3stash import md5_to_http_url
+from md5s3stash import (md5_to_http_url, derivative_url, process_image,
+                        Metrics, Inventory)
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+import functools
+import hashlib
 import os
+import time
 
 
 assert 'BUCKET_BASE' in os.environ, "`BUCKET_BASE` must be set"
 
+define("original_cache_dir",
+       help="directory to keep a local copy of originals fetched from s3")
+define("original_cache_size", help="MB of originals to keep (default 1024)",
+       type=int, default=1024)
+define("render_cache_size",
+       help="MB of thumbnails to keep in memory (default 64)",
+       type=int, default=64)
+define("render_cache_dir",
+       help="directory for thumbnails pushed out of memory to go to")
+define("render_cache_disk_size",
+       help="MB of thumbnails to keep in render_cache_dir (default 1024)",
+       type=int, default=1024)
+define("render_processes",
+       help="processes to decode and resize in, 0 for the server process "
+            "(default 0)",
+       type=int, default=0)
+define("render_backlog",
+       help="renders to queue for busy render_processes before answering "
+            "503 (default 32)",
+       type=int, default=32)
+define("derivatives",
+       help="mode/WxH thumbnails stashed next to the originals by "
+            "md5s3stash --derivatives, to fetch rather than render",
+       multiple=True, default=[])
+define("inventory",
+       help="sqlite file made by `md5s3stash inventory`, to answer for "
+            "originals in it without a HEAD to s3")
+
+# server settings that change what a thumbnail looks like
+RENDER_SETTINGS = ['background', 'expand', 'filter', 'format', 'mode',
+                   'operation', 'optimize', 'position', 'preserve_exif',
+                   'progressive', 'quality', 'retain']
+
+# /original/{md5} is sent on in ranges of this many bytes, fetched one at a
+# time as the client takes them, in chunks of ORIGINAL_CHUNK_SIZE from disk
+ORIGINAL_PIECE_SIZE = 4 * 1024 * 1024
+ORIGINAL_CHUNK_SIZE = 64 * 1024
+
 
 class ThumbnailApplication(PilboxApplication):
+    def __init__(self, **kwargs):
+        settings = dict(
+            original_cache_dir=options.original_cache_dir,
+            original_cache_size=options.original_cache_size,
+            render_cache_size=options.render_cache_size,
+            render_cache_dir=options.render_cache_dir,
+            render_cache_disk_size=options.render_cache_disk_size,
+            render_processes=options.render_processes,
+            render_backlog=options.render_backlog,
+            derivatives=options.derivatives,
+            inventory=options.inventory,
+        )
+        settings.update(kwargs)
+        super(ThumbnailApplication, self).__init__(**settings)
+        self.metrics = Metrics('thumbnail')
+        # concurrent requests for the same original or thumbnail share one
+        # fetch or render
+        self.fetching = SingleFlight()
+        self.rendering = SingleFlight()
+        self.original_cache = None
+        if self.settings.get('original_cache_dir'):
+            self.original_cache = DiskCache(
+                self.settings['original_cache_dir'],
+                self.settings['original_cache_size'] * 1024 * 1024,
+            )
+        self.render_cache = None
+        if self.settings.get('render_cache_size'):
+            spill = None
+            if self.settings.get('render_cache_dir'):
+                spill = DiskCache(
+                    self.settings['render_cache_dir'],
+                    self.settings['render_cache_disk_size'] * 1024 * 1024,
+                )
+            self.render_cache = RenderCache(
+                self.settings['render_cache_size'] * 1024 * 1024, spill)
+        self.inventory = None
+        if self.settings.get('inventory'):
+            # only what is listed where original_url looks can stand in
+            # for the HEAD
+            try:
+                self.inventory = Inventory(
+                    self.settings['inventory'], *original_location())
+            except ValueError as e:
+                app_log.warning('not using the inventory: %s', e)
+        self.render_pool = None
+        if self.settings.get('render_processes'):
+            self.render_pool = RenderPool(
+                self.settings['render_processes'],
+                self.settings['render_backlog'],
+            )
+
     def get_handlers(self):
         # URL regex to handler mapping
         return [
+            (r"^/metrics$", MetricsHandler),
+            (r"^/original/([a-fA-F\d]{32})$", OriginalHandler),
             (r"^/([^/]+)/(\d+)x(\d+)/([a-fA-F\d]{32})$", ThumbnailImageHandler),
             (r"^/([^/]+)/(\d+)x(\d+)/.*$", ThumbnailImageHandler)
         ]
@@ -23,27 +129,553 @@ class ThumbnailApplication(PilboxApplication):
 
 class ThumbnailImageHandler(ImageHandler):
     def prepare(self):
-        self.args = self.request.arguments.copy()
+        # one value per query argument, as pilbox expects from get_argument
+        self.args = dict(
+            (name, ImageHandler.get_argument(self, name))
+            for name in self.request.arguments
+        )
         self.settings['content_type_from_image'] = True
 
     @tornado.gen.coroutine
     def get(self, mode, w, h, md5='0d6cc125540194549459df758af868a8'):
-        url = md5_to_http_url(
-            md5,
-            os.environ['BUCKET_BASE'],
-            bucket_scheme=os.getenv('BUCKET_SCHEME', 'multibucket'),
-            s3_endpoint=os.getenv('S3_ENDPOINT'),
-        )
+        metrics = self.application.metrics
+        metrics.add('requests_total', route='thumbnail')
+        self.md5 = md5.lower()
+        url = original_url(md5)
+        self.spec = '{0}/{1}x{2}'.format(mode, w, h)
         self.args.update(dict(w=w, h=h, url=url, mode=mode))
         self.validate_request()
-        resp = yield self.fetch_image()
-        resp.headers["Cache-Control"] = "public, max-age=31536000"
-        self.render_image(resp)
+        key = self.render_key()
+        # a thumbnail never changes, so its key makes a strong ETag
+        self.set_header("ETag", '"{0}"'.format(key))
+        self.set_header("Cache-Control", "public, max-age=31536000")
+        if self.check_etag_header():
+            metrics.add('not_modified_total')
+            self.set_status(304)
+            return
+        cache = self.application.render_cache
+        rendered = cache.get(key) if cache is not None else None
+        if rendered is None:
+            metrics.add('render_cache_misses_total')
+            if key in self.application.rendering:
+                metrics.add('coalesced_total', stage='render')
+            rendered = yield self.application.rendering.run(
+                key, self.fetch_and_render)
+        else:
+            metrics.add('render_cache_hits_total')
+        (content_type, body) = rendered
+        if content_type:
+            self.set_header("Content-Type", content_type)
+        self.write(body)
+
+    def render_key(self):
+        ''' sha1 of everything that goes into the thumbnail for this request:
+            the md5, mode and size, the query options and the server's
+            default options
+        '''
+        parts = [self.md5]
+        for name in sorted(self.args):
+            if name != 'url':
+                parts.append('{0}={1}'.format(name, self.args[name]))
+        for name in RENDER_SETTINGS:
+            parts.append('{0}={1}'.format(name, self.settings.get(name)))
+        return hashlib.sha1('&'.join(parts).encode('utf-8')).hexdigest()
+
+    @tornado.gen.coroutine
+    def fetch_and_render(self):
+        metrics = self.application.metrics
+        rendered = None
+        # stashed ones are rendered with pilbox's defaults, no query options
+        if (self.spec in self.settings.get('derivatives', [])
+                and not self.request.arguments):
+            rendered = yield self.fetch_derivative()
+            metrics.add('derivatives_total',
+                        found='no' if rendered is None else 'yes')
+        if rendered is None:
+            resp = yield self.fetch_image()
+            start = time.time()
+            rendered = yield self.render(resp)
+            metrics.add('renders_total')
+            metrics.add('render_seconds_total', time.time() - start)
+        if self.application.render_cache is not None:
+            self.application.render_cache.put(self.render_key(), rendered)
+        raise tornado.gen.Return(rendered)
+
+    @tornado.gen.coroutine
+    def fetch_derivative(self):
+        ''' resolves to the (content type, bytes) of the thumbnail stashed
+            next to the original, or None if there isn't one
+        '''
+        client = tornado.httpclient.AsyncHTTPClient(
+            max_clients=self.settings.get("max_requests"))
+        resp = yield client.fetch(
+            derivative_url(self.get_argument("url"), self.spec),
+            request_timeout=self.settings.get("timeout"),
+            raise_error=False)
+        if resp.code != 200:
+            raise tornado.gen.Return(None)
+        raise tornado.gen.Return((resp.headers.get("Content-Type"), resp.body))
+
+    @tornado.gen.coroutine
+    def render(self, resp):
+        ''' resolves to the (content type, bytes) of the thumbnail that
+            `render_image` would have written for `resp`
+        '''
+        operations = self.operations()
+        if operations is None:
+            raise tornado.gen.Return(
+                (resp.headers.get("Content-Type"), resp.body))
+        pool = self.application.render_pool
+        if pool is None:
+            (image_format, body) = process_image(
+                resp.body, operations, self._get_save_options())
+        else:
+            (image_format, body) = yield pool.run(
+                resp.body, operations, self._get_save_options())
+        raise tornado.gen.Return(
+            (self._FORMAT_TO_MIME.get(image_format.lower()), body))
 
+    def operations(self):
+        ''' the pilbox `Image` method calls `_process_response` would make,
+            as (name, args, options), or None for "noop"
+        '''
+        operations = []
+        for operation in self._get_operations():
+            if operation == "noop":
+                return None
+            elif operation == "resize":
+                operations.append((
+                    "resize",
+                    (self.get_argument("w"), self.get_argument("h")),
+                    self._get_resize_options()))
+            elif operation == "rotate":
+                operations.append((
+                    "rotate",
+                    (self.get_argument("deg"),),
+                    self._get_rotate_options()))
+            elif operation == "region":
+                operations.append((
+                    "region",
+                    (self.get_argument("rect").split(","),),
+                    {}))
+        return operations
+
+    def write_error(self, status_code, **kwargs):
+        if status_code == 503:
+            self.set_header("Retry-After", "1")
+        super(ThumbnailImageHandler, self).write_error(status_code, **kwargs)
+
+    @tornado.gen.coroutine
+    def fetch_image(self):
+        cache = self.application.original_cache
+        metrics = self.application.metrics
+        if cache is not None and self.md5 in cache:
+            metrics.add('original_cache_hits_total')
+        elif self.md5 in (cache.fetching if cache is not None
+                          else self.application.fetching):
+            metrics.add('coalesced_total', stage='original')
+        if cache is None:
+            body = yield self.application.fetching.run(
+                self.md5, self.fetch_original)
+        else:
+            body = yield cache.fetch(self.md5, self.fetch_original)
+        # each request gets its own response to read the shared bytes from
+        raise tornado.gen.Return(tornado.httpclient.HTTPResponse(
+            tornado.httpclient.HTTPRequest(self.get_argument('url')),
+            200,
+            buffer=BytesIO(body),
+        ))
+
+    @tornado.gen.coroutine
+    def fetch_original(self):
+        resp = yield super(ThumbnailImageHandler, self).fetch_image()
+        self.application.metrics.add('s3_fetches_total')
+        self.application.metrics.add('s3_bytes_total', len(resp.body))
+        raise tornado.gen.Return(resp.body)
 
     def get_argument(self, name, default=None):
         return self.args.get(name, default)
 
 
+class OriginalHandler(tornado.web.RequestHandler):
+    ''' /original/{md5}: the stashed file itself, from the original cache
+        or s3, with Range support.  It is sent on a piece at a time as the
+        client takes it, so big audio and video masters are never held in
+        memory whole.
+    '''
+    @tornado.gen.coroutine
+    def get(self, md5):
+        yield self.send(md5.lower(), include_body=True)
+
+    @tornado.gen.coroutine
+    def head(self, md5):
+        yield self.send(md5.lower(), include_body=False)
+
+    @tornado.gen.coroutine
+    def send(self, md5, include_body):
+        self.application.metrics.add('requests_total', route='original')
+        url = original_url(md5)
+        client = tornado.httpclient.AsyncHTTPClient(
+            max_clients=self.settings.get("max_requests"))
+        inventory = self.application.inventory
+        entry = inventory.get(md5) if inventory is not None else None
+        if entry is not None and entry.mime_type:
+            # the inventory has all the HEAD would tell
+            self.application.metrics.add('inventory_hits_total')
+            headers = {
+                "Content-Type": entry.mime_type,
+                "ETag": '"{0}"'.format(entry.etag),
+                "Content-Length": entry.size,
+            }
+        else:
+            head = yield client.fetch(
+                url, method="HEAD", raise_error=False,
+                request_timeout=self.settings.get("timeout"))
+            if head.code != 200:
+                raise tornado.web.HTTPError(404 if head.code < 500 else 502)
+            headers = head.headers
+        for name in ["Content-Type", "ETag", "Last-Modified"]:
+            if name in headers:
+                self.set_header(name, headers[name])
+        self.set_header("Accept-Ranges", "bytes")
+        self.set_header("Cache-Control", "public, max-age=31536000")
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        size = int(headers["Content-Length"])
+
+        # as tornado's StaticFileHandler does it
+        request_range = None
+        if self.request.headers.get("Range"):
+            request_range = tornado.httputil._parse_request_range(
+                self.request.headers["Range"])
+        (start, end) = request_range or (None, None)
+        if (start is not None and start >= size) or end == 0:
+            self.set_status(416)
+            self.set_header("Content-Type", "text/plain")
+            self.set_header("Content-Range", "bytes */{0}".format(size))
+            return
+        if start is not None and start < 0:
+            start = max(start + size, 0)
+        (start, end) = (start or 0, min(end or size, size))
+        if end - start != size:
+            self.set_status(206)
+            self.set_header("Content-Range",
+                            tornado.httputil._get_content_range(
+                                start, end, size))
+        self.set_header("Content-Length", end - start)
+        if not include_body:
+            return
+
+        cache = self.application.original_cache
+        local = cache.open(md5) if cache is not None else None
+        try:
+            for offset in range(start, end, ORIGINAL_PIECE_SIZE):
+                stop = min(offset + ORIGINAL_PIECE_SIZE, end)
+                if local is not None:
+                    local.seek(offset)
+                    while local.tell() < stop:
+                        chunk = local.read(
+                            min(ORIGINAL_CHUNK_SIZE, stop - local.tell()))
+                        if not chunk:
+                            break
+                        self.write(chunk)
+                        self.application.metrics.add(
+                            'original_bytes_total', len(chunk), source='disk')
+                        yield self.flush()
+                else:
+                    piece = yield self.fetch_piece(client, url, offset, stop)
+                    if piece != 206:
+                        self.application.metrics.add('original_errors_total')
+                        if not self._headers_written:
+                            raise tornado.web.HTTPError(502)
+                        # too late for an error status; hang up, so the
+                        # client sees a short body rather than a wrong one
+                        self.request.connection.close()
+                        return
+                    self.application.metrics.add(
+                        'original_bytes_total', stop - offset, source='s3')
+                    yield self.flush()
+        except tornado.iostream.StreamClosedError:
+            pass
+        finally:
+            if local is not None:
+                local.close()
+
+
+    @tornado.gen.coroutine
+    def fetch_piece(self, client, url, offset, stop):
+        ''' send bytes `offset` to `stop` of `url` on to the client as
+            they come from s3; resolves to the status s3 answered with.
+            Only a 206 is the piece asked for, nothing else gets through
+            (an error page, or the whole file from an endpoint that
+            ignores Range)
+        '''
+        status = {}
+
+        def on_header(line):
+            if line.startswith('HTTP/'):
+                status['code'] = int(line.split()[1])
+
+        def on_chunk(chunk):
+            if status.get('code') == 206:
+                self.write(chunk)
+
+        resp = yield client.fetch(
+            url,
+            headers={"Range": "bytes={0}-{1}".format(offset, stop - 1)},
+            header_callback=on_header, streaming_callback=on_chunk,
+            request_timeout=self.settings.get("timeout"), raise_error=False)
+        raise tornado.gen.Return(resp.code)
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    ''' /metrics: the server's counters in the Prometheus text format, or
+        as StatsD lines with ?format=statsd
+    '''
+    def get(self):
+        app = self.application
+        metrics = app.metrics
+        for (name, cache) in [('original_cache', app.original_cache),
+                              ('render_cache', app.render_cache)]:
+            if cache is not None:
+                metrics.set('{0}_bytes'.format(name), cache.size)
+                metrics.set('{0}_entries'.format(name), len(cache.entries))
+        if app.render_pool is not None:
+            metrics.set('render_pool_pending', app.render_pool.pending)
+        if self.get_argument('format', None) == 'statsd':
+            self.set_header('Content-Type', 'text/plain')
+            self.write(metrics.statsd())
+        else:
+            self.set_header('Content-Type', 'text/plain; version=0.0.4')
+            self.write(metrics.prometheus())
+
+
+def original_location():
+    ''' the (bucket base, bucket scheme) originals are served from '''
+    return (os.environ['BUCKET_BASE'],
+            os.getenv('BUCKET_SCHEME', 'multibucket'))
+
+
+def original_url(md5):
+    ''' where the thumbnail server gets the original `md5` from '''
+    (bucket_base, bucket_scheme) = original_location()
+    return md5_to_http_url(
+        md5,
+        bucket_base,
+        bucket_scheme=bucket_scheme,
+        s3_endpoint=os.getenv('S3_ENDPOINT'),
+    )
+
+
+class DiskCache(object):
+    ''' a directory of files that never change, such as originals fetched
+        from s3 named by md5.  When it holds more than `max_bytes`, the
+        least recently used are removed.  Requests for a key that is already
+        being fetched wait for that fetch rather than starting another.
+    '''
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # md5: size, least recently used first
+        self.size = 0
+        self.fetching = SingleFlight()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # pick up what an earlier run left behind
+        found = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if not name.endswith('.part'):
+                stat = os.stat(path)
+                found.append((stat.st_atime, name, stat.st_size))
+        for (atime, md5, size) in sorted(found):
+            self.entries[md5] = size
+            self.size += size
+        self.evict()
+
+    def path(self, md5):
+        return os.path.join(self.directory, md5)
+
+    def __contains__(self, md5):
+        return md5 in self.entries
+
+    def get(self, md5):
+        ''' the bytes of `md5`, or None if they are not here '''
+        if md5 not in self.entries:
+            return None
+        try:
+            with open(self.path(md5), 'rb') as f:
+                body = f.read()
+        except IOError:
+            self.remove(md5)
+            return None
+        self.entries[md5] = self.entries.pop(md5)
+        return body
+
+    def open(self, md5):
+        ''' the file holding `md5` opened for reading, or None '''
+        if md5 not in self.entries:
+            return None
+        try:
+            f = open(self.path(md5), 'rb')
+        except IOError:
+            self.remove(md5)
+            return None
+        self.entries[md5] = self.entries.pop(md5)
+        return f
+
+    def put(self, md5, body):
+        temp = '{0}.part'.format(self.path(md5))
+        with open(temp, 'wb') as f:
+            f.write(body)
+        os.rename(temp, self.path(md5))
+        if md5 in self.entries:
+            self.size -= self.entries.pop(md5)
+        self.entries[md5] = len(body)
+        self.size += len(body)
+        self.evict()
+
+    def remove(self, md5):
+        self.size -= self.entries.pop(md5)
+        try:
+            os.remove(self.path(md5))
+        except OSError:
+            pass
+
+    def evict(self):
+        while self.size > self.max_bytes and self.entries:
+            self.remove(next(iter(self.entries)))
+
+    @tornado.gen.coroutine
+    def fetch(self, md5, fetch):
+        ''' resolves to the bytes of `md5`; `fetch` is a coroutine function
+            to get them from s3 with when they are not already here
+        '''
+        body = self.get(md5)
+        if body is None:
+            body = yield self.fetching.run(
+                md5, functools.partial(self.fetch_and_put, md5, fetch))
+        raise tornado.gen.Return(body)
+
+    @tornado.gen.coroutine
+    def fetch_and_put(self, md5, fetch):
+        body = yield fetch()
+        self.put(md5, body)
+        raise tornado.gen.Return(body)
+
+
+class SingleFlight(object):
+    ''' one call at a time per key of a coroutine function; calls for a
+        key that is already running wait for it and share its result, or
+        its exception
+    '''
+    def __init__(self):
+        self.running = {}
+
+    def __contains__(self, key):
+        return key in self.running
+
+    def run(self, key, fn):
+        ''' a future for the result of `fn()`, or of the call of it for
+            `key` that is already running
+        '''
+        future = self.running.get(key)
+        if future is None:
+            future = self.call(key, fn)
+            # a call that finished without yielding has nothing to share
+            if not future.done():
+                self.running[key] = future
+        return future
+
+    @tornado.gen.coroutine
+    def call(self, key, fn):
+        try:
+            result = yield fn()
+        finally:
+            self.running.pop(key, None)
+        raise tornado.gen.Return(result)
+
+
+def pooled_process_image(body, operations, save_options):
+    ''' `process_image` in a worker process; pilbox errors do not survive
+        pickling, so they are returned as (class, message) instead
+    '''
+    try:
+        return (None, process_image(body, operations, save_options))
+    except errors.PilboxError as e:
+        return ((e.__class__, e.log_message), None)
+
+
+class RenderPool(object):
+    ''' runs `process_image` in `processes` worker processes so that large
+        decodes don't hold up the IOLoop.  Once `backlog` renders are
+        waiting for a process, more are refused with a 503 rather than
+        queued.
+    '''
+    def __init__(self, processes, backlog):
+        self.executor = ProcessPoolExecutor(processes)
+        self.limit = processes + backlog
+        self.pending = 0
+
+    @tornado.gen.coroutine
+    def run(self, body, operations, save_options):
+        if self.pending >= self.limit:
+            raise tornado.web.HTTPError(503, "all render processes are busy")
+        self.pending += 1
+        try:
+            (error, result) = yield self.executor.submit(
+                pooled_process_image, body, operations, save_options)
+        finally:
+            self.pending -= 1
+        if error is not None:
+            raise error[0](error[1])
+        raise tornado.gen.Return(result)
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class RenderCache(object):
+    ''' rendered (content type, bytes) thumbnails by
+        `ThumbnailImageHandler.render_key`; the most recently used
+        `max_bytes` of them are kept in memory, the ones pushed out of
+        memory go to the optional `spill` DiskCache
+    '''
+    def __init__(self, max_bytes, spill=None):
+        self.max_bytes = max_bytes
+        self.spill = spill
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def get(self, key):
+        if key in self.entries:
+            rendered = self.entries.pop(key)
+            self.entries[key] = rendered
+            return rendered
+        if self.spill is not None:
+            raw = self.spill.get(key)
+            if raw is not None:
+                (content_type, body) = raw.split(b'\n', 1)
+                rendered = (content_type.decode('ascii') or None, body)
+                self.put(key, rendered)
+                return rendered
+        return None
+
+    def put(self, key, rendered):
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key)[1])
+        self.entries[key] = rendered
+        self.size += len(rendered[1])
+        while self.size > self.max_bytes and self.entries:
+            (old, (content_type, body)) = self.entries.popitem(last=False)
+            self.size -= len(body)
+            if self.spill is not None and old not in self.spill:
+                self.spill.put(
+                    old, (content_type or '').encode('ascii') + b'\n' + body)
+
+
 if __name__ == "__main__":
+    # parse the command line before the app reads its settings from it
+    tornado.options.parse_command_line()
     main(app=ThumbnailApplication(timeout=30,))